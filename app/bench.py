@@ -0,0 +1,538 @@
+# bench: how fast is brayerpot, measured against a pretend Slack
+import argparse
+import logging
+import os
+import tempfile
+from time import perf_counter
+
+# Keep brayerpot from going anywhere near the real database
+os.environ.setdefault('BRAYERPOT_DB_DIR', tempfile.mkdtemp(prefix='brayerpot-bench-'))
+
+import brayerpot
+from fakeslack import FakeSlack
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples)*pct/100.0))]
+
+def report(name, samples, unit=1e3, suffix='ms'):
+    print("  %-28s n=%-6d p50=%8.3f%s  p95=%8.3f%s  max=%8.3f%s" % (
+        name, len(samples),
+        percentile(samples, 50)*unit, suffix,
+        percentile(samples, 95)*unit, suffix,
+        max(samples)*unit, suffix,
+    ))
+
+def use_fake_slack(args, num_users):
+    """
+    Point brayerpot at a brand new `FakeSlack` with `num_users` people in it,
+    and forget everything brayerpot has cached about the last one.
+    """
+    rate_limits = None
+    if args.fake_rate_limit:
+        rate_limits = {m: args.fake_rate_limit for m in (
+            'auth.test', 'users.info', 'users.list', 'im.list', 'mpim.open',
+            'chat.postMessage', 'chat.postEphemeral', 'groups.leave', 'files.upload',
+        )}
+    fake = FakeSlack(num_users, latency=args.latency, rate_limits=rate_limits)
+    return install_fake_slack(fake, args.respect_rate_limits)
+
+def install_fake_slack(fake, respect_rate_limits=False):
+    """
+    Point brayerpot at `fake`, as a brand new tenant that knows nothing about
+    whichever Slack it was talking to before.
+    """
+    brayerpot.set_default_tenant(brayerpot.Tenant('default', transport=fake))
+
+    # Unless asked otherwise, measure our own speed rather than Slack's limits
+    if not respect_rate_limits:
+        brayerpot.SLACK_TIERS = {tier: 10**9 for tier in brayerpot.SLACK_TIERS}
+        brayerpot.SLACK_METHOD_RATES = {m: 10**9 for m in brayerpot.SLACK_METHOD_RATES}
+    return fake
+
+def use_fresh_db(engine):
+    """
+    Point brayerpot at a brand new, empty database.
+    """
+    brayerpot.DB_DIR = tempfile.mkdtemp(prefix='brayerpot-bench-')
+    brayerpot.DB_ENGINE = engine
+    brayerpot.get_tenant().db = None
+    brayerpot.scheduler = brayerpot.TriggerScheduler()
+    return brayerpot.get_db()
+
+def bench_commands(args):
+    """
+    End-to-end latency of a message coming in, getting routed to its handler
+    and the reply going out.
+    """
+    print("Command latency (%s, %.1fms fake latency):" % (args.engine, args.latency*1e3))
+    fake = use_fake_slack(args, 50)
+    use_fresh_db(args.engine)
+
+    users = [u for u in fake.users if u != fake.bot_id]
+    ims = {u: fake.open_im(u) for u in users}
+    at_bot = "<@%s>" % (fake.bot_id)
+
+    messages = [
+        ('help (DM)', lambda u: {'type': 'message', 'channel': ims[u], 'user': u, 'text': 'help'}),
+        ('signup (DM)', lambda u: {'type': 'message', 'channel': ims[u], 'user': u, 'text': 'signup bench'}),
+        ('list (DM)', lambda u: {'type': 'message', 'channel': ims[u], 'user': u, 'text': 'list'}),
+        ('signup (mention)', lambda u: {'type': 'message', 'channel': 'C0', 'user': u, 'text': at_bot + ' signup other'}),
+        ('stop (mention)', lambda u: {'type': 'message', 'channel': 'C0', 'user': u, 'text': at_bot + ' stop other'}),
+        ('stop (DM)', lambda u: {'type': 'message', 'channel': ims[u], 'user': u, 'text': 'stop'}),
+    ]
+    for name, make_payload in messages:
+        samples = []
+        for idx in range(args.iterations):
+            payload = make_payload(users[idx % len(users)])
+            start = perf_counter()
+            brayerpot.handle_payload(payload)
+            samples.append(perf_counter() - start)
+        report(name, samples)
+
+def bench_trigger(args):
+    """
+    How long it takes to pair up and create chats for a whole group.
+    """
+    print("Trigger throughput (%s, %.1fms fake latency, %d workers):" % (
+        args.engine, args.latency*1e3, brayerpot.DISPATCH_WORKERS))
+    for size in args.sizes:
+        fake = use_fake_slack(args, size)
+        db = use_fresh_db(args.engine)
+        for user in fake.users:
+            if user != fake.bot_id:
+                db.add_user_to_group(user, 'bench')
+
+        start = perf_counter()
+        result = brayerpot.trigger_weekly_group_chats('bench', seed=0)['bench']
+        elapsed = perf_counter() - start
+
+        print("  %6d members: %4d pairings in %8.3fs (%8.1f pairings/s), %6d slack calls, %d failed" % (
+            size, result['pairings'], elapsed, result['pairings']/elapsed,
+            sum(fake.calls.values()), result['failures'],
+        ))
+
+def bench_batch(args):
+    """
+    Triggering a pile of overlapping groups, everybody in three of six, with
+    nobody's name cached yet: one group at a time, versus all of them as one
+    batch.
+    """
+    print("Batched triggers (%s, %.1fms fake latency):" % (args.engine, args.latency*1e3))
+    for size in args.sizes:
+        for name in ('one at a time', 'batched'):
+            fake = use_fake_slack(args, size)
+            db = use_fresh_db(args.engine)
+            users = [u for u in fake.users if u != fake.bot_id]
+            groups = ['bench%d' % (idx) for idx in range(6)]
+            with db.transaction():
+                for idx, user in enumerate(users):
+                    for offset in range(3):
+                        db.add_user_to_group(user, groups[(idx + offset) % len(groups)])
+
+            start = perf_counter()
+            if name == 'batched':
+                brayerpot.trigger_weekly_group_chats(groups, seed=0)
+            else:
+                for group in groups:
+                    brayerpot.trigger_weekly_group_chats(group, seed=0)
+            elapsed = perf_counter() - start
+
+            lookups = fake.calls['users.info'] + fake.calls['users.list']
+            print("  %6d members, %-13s %8.3fs, %6d slack calls (%5d of them looking people up)" % (
+                size, name + ':', elapsed, sum(fake.calls.values()), lookups))
+
+def bench_dump(args):
+    """
+    How long `dump_groups` takes with nobody's name cached yet, and how many
+    messages and Slack calls it takes to say everything.
+    """
+    print("dump_groups (%s, %.1fms fake latency):" % (args.engine, args.latency*1e3))
+    for size in args.sizes:
+        fake = use_fake_slack(args, size)
+        db = use_fresh_db(args.engine)
+        users = [u for u in fake.users if u != fake.bot_id]
+        with db.transaction():
+            for idx, user in enumerate(users):
+                db.add_user_to_group(user, 'group%d' % (idx // 50))
+
+        payload = {'type': 'message', 'channel': fake.open_im(users[0]), 'user': users[0], 'text': 'dump_groups'}
+        brayerpot.get_user_first_name(users[0])
+        calls = sum(fake.calls.values())
+        start = perf_counter()
+        brayerpot.handle_command('dump_groups', payload, [])
+        elapsed = perf_counter() - start
+
+        print("  %6d members: %8.3fs, %3d messages (longest %5d chars), %5d slack calls" % (
+            size, elapsed, len(fake.messages), max(len(m['text']) for m in fake.messages),
+            sum(fake.calls.values()) - calls,
+        ))
+
+def bench_db(args):
+    """
+    Cost of a single membership change, as a function of how many members the
+    database already holds.
+    """
+    print("DB mutation cost:")
+    for engine in ('shelve', 'sqlite'):
+        for size in args.sizes:
+            db = use_fresh_db(engine)
+            for idx in range(size):
+                db.add_user_to_group("U%08d" % (idx), 'bench')
+
+            adds, removes = [], []
+            for idx in range(args.iterations):
+                user = "X%08d" % (idx)
+                start = perf_counter()
+                db.add_user_to_group(user, 'bench')
+                adds.append(perf_counter() - start)
+
+                start = perf_counter()
+                db.remove_user_from_group(user, 'bench')
+                removes.append(perf_counter() - start)
+            report("%s add @ %d" % (engine, size), adds, 1e6, 'us')
+            report("%s remove @ %d" % (engine, size), removes, 1e6, 'us')
+
+            # The same again, but all in one transaction
+            start = perf_counter()
+            with db.transaction():
+                for idx in range(args.iterations):
+                    db.add_user_to_group("Y%08d" % (idx), 'bench')
+            report("%s batched add @ %d" % (engine, size),
+                   [(perf_counter() - start)/args.iterations], 1e6, 'us')
+
+def bench_members(args):
+    """
+    Cost of "who's in what" questions, with each size's worth of people spread
+    over a couple of hundred groups, everybody in five of them.
+    """
+    import random
+    import tracemalloc
+
+    print("Membership queries:")
+    for size in args.sizes:
+        rng = random.Random(0)
+        groups = {}
+        for idx in range(size):
+            for group in rng.sample(range(200), 5):
+                groups.setdefault("group%d" % (group), []).append("U%08d" % (idx))
+
+        tracemalloc.start()
+        index = brayerpot.MembershipIndex(groups)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("  %6d members: %8.1fKB for %d memberships" % (
+            size, memory/1024.0, index.stats()['memberships']))
+
+        users = ["U%08d" % (rng.randrange(size)) for _ in range(args.iterations)]
+        queries = [
+            ('contains', lambda u: index.contains(u, 'group0')),
+            ('groups_for', index.groups_for),
+            ('union of 10', lambda u: index.union("group%d" % (g) for g in range(10))),
+            ('snapshot', lambda u: index.snapshot()),
+        ]
+        for name, query in queries:
+            samples = []
+            for user in users:
+                start = perf_counter()
+                query(user)
+                samples.append(perf_counter() - start)
+            report("%s @ %d" % (name, size), samples, 1e6, 'us')
+
+def bench_backup(args):
+    """
+    How long exporting, importing, snapshotting and compacting take, and how
+    much memory the first two need on top of the database itself, with each
+    size's worth of people in five of a couple of hundred groups.  Somebody
+    keeps signing up and leaving while the snapshot is taken, to see how long
+    they get held up.
+    """
+    import random
+    import threading
+    import tracemalloc
+
+    def peak_memory(func):
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    print("Backups:")
+    for engine in ('shelve', 'sqlite'):
+        for size in args.sizes:
+            rng = random.Random(0)
+            db = use_fresh_db(engine)
+            with db.transaction():
+                for idx in range(size):
+                    for group in rng.sample(range(200), 5):
+                        db.add_user_to_group("U%08d" % (idx), "group%d" % (group))
+            export = os.path.join(brayerpot.DB_DIR, 'export.jsonl.gz')
+
+            start = perf_counter()
+            brayerpot.write_records(export, db.export_records())
+            elapsed = perf_counter() - start
+            memory = peak_memory(lambda: brayerpot.write_records(export, db.export_records()))
+            print("  %s export @ %d: %.3fs, %.1fKB peak, %.1fKB on disk" % (
+                engine, size, elapsed, memory/1024.0, os.path.getsize(export)/1024.0))
+
+            start = perf_counter()
+            use_fresh_db(engine).import_records(brayerpot.read_records(export))
+            elapsed = perf_counter() - start
+            memory = peak_memory(lambda: use_fresh_db(engine).import_records(brayerpot.read_records(export)))
+            print("  %s import @ %d: %.3fs, %.1fKB peak" % (engine, size, elapsed, memory/1024.0))
+            brayerpot.get_tenant().db = db
+
+            # Keep on writing while the snapshot gets taken
+            done, waits = threading.Event(), []
+            def churn():
+                while not done.is_set():
+                    start = perf_counter()
+                    db.add_user_to_group('Xchurn', 'group0')
+                    db.remove_user_from_group('Xchurn', 'group0')
+                    waits.append(perf_counter() - start)
+            writer = threading.Thread(target=churn)
+            writer.start()
+            start = perf_counter()
+            db.snapshot(os.path.join(brayerpot.DB_DIR, 'snapshot' + ('.sqlite' if engine == 'sqlite' else '.db')))
+            elapsed = perf_counter() - start
+            done.set()
+            writer.join()
+            print("  %s snapshot @ %d: %.3fs" % (engine, size, elapsed))
+            report("%s writes during snapshot @ %d" % (engine, size), waits)
+
+            for idx in range(args.iterations):
+                user = "U%08d" % (idx % size)
+                for group in db.list_groups(user):
+                    db.remove_user_from_group(user, group)
+                    db.add_user_to_group(user, group)
+            before = db.disk_usage()
+            start = perf_counter()
+            db.compact()
+            print("  %s compact @ %d: %.3fs, %.1fKB -> %.1fKB" % (
+                engine, size, perf_counter() - start, before/1024.0, db.disk_usage()/1024.0))
+
+def bench_startup(args):
+    """
+    How long it takes from starting up until we've answered somebody:
+    importing brayerpot, then for each size, `run_bot()` against a fake Slack
+    with that many people in it and a database with all of them in five of a
+    couple of hundred groups, with a DM asking for `list` waiting as soon as
+    we've connected, timed until our reply lands.  Opening the database and
+    connecting get timed on their own as well, connecting both the way we do
+    (`rtm.connect`) and the way we used to (`rtm.start`, which sends along
+    the whole workspace, then `auth.test` and `im.list`), over HTTP.
+    """
+    import asyncio
+    import random
+    import subprocess
+    import sys
+    from fakeslack import FakeRtmClient, serve_http
+
+    print("Startup (%.1fms fake latency):" % (args.latency*1e3))
+    code = "from time import perf_counter; start = perf_counter(); import brayerpot; print(perf_counter() - start)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(5):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True, text=True, check=True)
+        samples.append(float(out.stdout))
+    report("import", samples)
+
+    async def first_reply(fake):
+        start = perf_counter()
+        bot = asyncio.ensure_future(brayerpot.run_bot())
+        while not fake.messages:
+            if bot.done():
+                bot.result()
+            await asyncio.sleep(0.001)
+        elapsed = perf_counter() - start
+        bot.cancel()
+        await asyncio.gather(bot, return_exceptions=True)
+        return elapsed
+
+    brayerpot.MODE = 'rtm'
+    brayerpot.RUN_SCHEDULER = False
+    brayerpot.METRICS_PORT = None
+    brayerpot.HANDOFF_SOCKET = os.path.join(tempfile.mkdtemp(prefix='brayerpot-bench-'), 'handoff.sock')
+    for size in args.sizes:
+        fake = FakeSlack(size, latency=args.latency)
+        server = serve_http(fake)
+        http = brayerpot.SlackHTTP(url="http://127.0.0.1:%d/api/" % (server.server_port))
+        connect = {}
+        for name, methods in (('old', ['rtm.start', 'auth.test', 'im.list']), ('new', ['rtm.connect'])):
+            start = perf_counter()
+            for method in methods:
+                http.post('xoxb-bench', method, {})
+            connect[name] = perf_counter() - start
+        server.shutdown()
+
+        for idx, engine in enumerate(('shelve', 'sqlite')):
+            fake = install_fake_slack(FakeSlack(size, latency=args.latency), args.respect_rate_limits)
+            rng = random.Random(0)
+            db = use_fresh_db(engine)
+            with db.transaction():
+                for user in range(size):
+                    for group in rng.sample(range(200), 5):
+                        db.add_user_to_group("U%08d" % (user), "group%d" % (group))
+                for group in db.list_all_groups():
+                    members = db.get_group(group)
+                    db.record_pairings(group, [members[i:i + 2] for i in range(0, len(members), 2)], 0)
+            db.close()
+
+            tenant = brayerpot.get_tenant()
+            tenant.db = None
+            logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'), force=True)
+            start = perf_counter()
+            brayerpot.open_db(tenant).close()
+            opened = perf_counter() - start
+
+            user = 'U00000001'
+            payload = {'type': 'message', 'channel': fake.open_im(user), 'user': user,
+                       'text': 'list', 'ts': '%d.%06d' % (size, idx)}
+            tenant.token = 'xoxb-bench'
+            tenant.client = FakeRtmClient(fake, [payload])
+            replied = asyncio.run(first_reply(fake))
+            tenant.client.close()
+            logging.basicConfig(level=logging.ERROR, force=True)
+            tenant.db = None
+
+            print("  %s @ %d: open %.3fs, connect %.3fs (rtm.start %.3fs), first reply after %.3fs" % (
+                engine, size, opened, connect['new'], connect['old'], replied))
+
+def bench_http(args):
+    """
+    Per-call latency of talking to Slack over HTTP through our pool of
+    keep-alive connections, versus a fresh connection for every call the way
+    `SlackClient` does it, against the fake Slack served up locally.  There's
+    no TLS here, so real handshakes cost a good deal more than this shows.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+    from fakeslack import serve_http
+
+    fake = FakeSlack(100, latency=args.latency)
+    server = serve_http(fake)
+    url = "http://127.0.0.1:%d/api/" % (server.server_port)
+    users = [u for u in fake.users if u != fake.bot_id]
+    print("HTTP transport (%.1fms fake latency):" % (args.latency*1e3))
+
+    pooled = brayerpot.SlackHTTP(url=url)
+    transports = [
+        ('fresh', lambda user: requests.post(url + 'users.info', data={'user': user}).json()),
+        ('pooled', lambda user: pooled.post('xoxb-bench', 'users.info', {'user': user})),
+    ]
+    for workers in (1, brayerpot.DISPATCH_WORKERS):
+        for name, call in transports:
+            def timed(user):
+                start = perf_counter()
+                call(user)
+                return perf_counter() - start
+
+            with ThreadPoolExecutor(workers) as pool:
+                samples = list(pool.map(timed, (users[idx % len(users)] for idx in range(args.iterations))))
+            report("%s, %d threads" % (name, workers), samples)
+    print("  pooled: %s" % (", ".join("%s=%d" % item for item in sorted(pooled.stats().items()))))
+    server.shutdown()
+
+def parse_corpus(bot):
+    """
+    A pile of the sorts of things people say, in channels we're in (mostly not
+    to us) and in DMs to us.  Returns a list of `(text, direct)` pairs.
+    """
+    at_bot = "<@%s>" % (bot)
+    chatter = [
+        "morning all!",
+        "does anyone know if the potluck is still on for sunday?",
+        "<@U00000001> can you send me the slides from last week",
+        "lol :joy:",
+        "Reminder: small groups are meeting at the Smiths' this week, bring a snack " * 3,
+    ]
+    to_us = [
+        at_bot + " help",
+        at_bot + " signup LWGuys",
+        at_bot + " sign up LWGuys",
+        "hey " + at_bot + " stop LWGuys please",
+        at_bot + " list",
+        at_bot + " set_time LWGuys wednesday 19 1",
+    ]
+    dms = ["help", "signup LWGuys", "Sign Up LWGuys", "stop", "list", "trigger_chats LWGuys", "what is this?"]
+    return [(t, False) for t in chatter*4 + to_us] + [(t, True) for t in dms]
+
+def legacy_parse(text, direct, at_bot):
+    """
+    How messages used to get picked apart, kept around for comparison: split
+    out the mention, and then split again on the command name.
+    """
+    from re import split, IGNORECASE
+    if at_bot in text:
+        command = text.split(at_bot)[1].strip().split()[:1]
+    elif direct:
+        command = text.split()[:1]
+    else:
+        return None
+    if not command:
+        return None
+    command = command[0].lower()
+    splitted = split(command, text, flags=IGNORECASE)
+    return command, splitted[1].strip().split()
+
+def bench_parse(args):
+    """
+    Per-message cost of working out which command (if any) a message is.
+    """
+    print("Parse cost per message:")
+    router = brayerpot.CommandRouter("U00000000")
+    corpus = parse_corpus(router.bot_id)
+    parsers = [
+        ('router', router.parse),
+        ('legacy', lambda text, direct: legacy_parse(text, direct, router.mention)),
+    ]
+    for name, parse in parsers:
+        samples = []
+        for _ in range(args.iterations):
+            start = perf_counter()
+            for text, direct in corpus:
+                parse(text, direct)
+            samples.append((perf_counter() - start)/len(corpus))
+        report("%s (%d messages)" % (name, len(corpus)), samples, 1e9, 'ns')
+
+BENCHMARKS = {
+    'backup': bench_backup,
+    'batch': bench_batch,
+    'commands': bench_commands,
+    'dump': bench_dump,
+    'http': bench_http,
+    'parse': bench_parse,
+    'startup': bench_startup,
+    'trigger': bench_trigger,
+    'db': bench_db,
+    'members': bench_members,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark brayerpot against a fake Slack")
+    parser.add_argument('benchmarks', nargs='*',
+                        help="Which of %s to run (default: all of them)" % (", ".join(sorted(BENCHMARKS))))
+    parser.add_argument('--sizes', default='10,100,1000,10000',
+                        type=lambda s: [int(x) for x in s.split(',')],
+                        help="Group sizes for the trigger, batch, dump, db, members, backup and startup benchmarks")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds of pretend network latency per Slack call")
+    parser.add_argument('--fake-rate-limit', type=int, default=None,
+                        help="Calls per minute the fake Slack allows per method")
+    parser.add_argument('--respect-rate-limits', action='store_true',
+                        help="Keep brayerpot's own per-method rate limiting on")
+    parser.add_argument('--engine', default='shelve', choices=['shelve', 'sqlite'])
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % (name))
+
+    logging.basicConfig(level=logging.ERROR)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,571 @@
 # brayerpot: take THAT @britwuzhere
+import contextvars
+import datetime
 import logging
+import os
 import sys
 import shelve
+import socket
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+import pytz
 from slackclient import SlackClient
 
 try:
     from secret import *
 except ImportError:
-    logging.error("Could not read secret.py")
-    sys.exit(1)
+    # Not fatal at import time, so that benchmarks and the like can load us
+    # against a fake Slack; we'll complain again if we try to connect.
+    SLACK_API_TOKEN = os.environ.get('SLACK_API_TOKEN')
+    if SLACK_API_TOKEN is None and 'SLACK_TENANTS' not in os.environ:
+        logging.warn("Could not read secret.py")
+if 'SLACK_API_TOKEN' not in globals():
+    SLACK_API_TOKEN = os.environ.get('SLACK_API_TOKEN')
+
+# To serve more than one workspace, set `SLACK_TENANTS` (in secret.py, or in
+# the environment as `name:token,name:token`) to map a short name for each
+# of them to its bot token.  Otherwise we serve the one `SLACK_API_TOKEN` is
+# for, under the name `default`.
+if 'SLACK_TENANTS' not in globals():
+    SLACK_TENANTS = os.environ.get('SLACK_TENANTS')
+    if SLACK_TENANTS:
+        SLACK_TENANTS = dict(t.split(':', 1) for t in SLACK_TENANTS.split(','))
 
 # Global variables
 BOT_NAME = 'prayerbot'
-BOT_ID = None
-slack_client = SlackClient(SLACK_API_TOKEN)
+
+def set_slack_transport(transport):
+    """
+    Send the current tenant's Web API calls through `transport` instead of
+    the real Slack, e.g. a `fakeslack.FakeSlack`.
+    """
+    get_tenant().transport = transport
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms, each keyed by a metric name plus
+    a set of labels, that we can render in the Prometheus text format or boil
+    down into a log line.
+    """
+    # Upper bounds (in seconds) of our latency histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def add_gauge(self, name, amount, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        from bisect import bisect_left
+
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0]*len(self.BUCKETS), 0.0, 0]
+            hist[0][bisect_left(self.BUCKETS, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the body of a `with` block into histogram `name`, and count it in
+        `<name minus _seconds>_errors_total` if it raises.
+        """
+        from time import perf_counter
+
+        start = perf_counter()
+        try:
+            yield
+        except:
+            self.inc(name.replace('_seconds', '') + '_errors_total', **labels)
+            raise
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    @staticmethod
+    def quantile(hist, q):
+        """
+        Estimate quantile `q` of a histogram as the upper bound of the bucket
+        it falls into.
+        """
+        buckets, _, count = hist
+        seen = 0
+        for bound, n in zip(Metrics.BUCKETS, buckets):
+            seen += n
+            if seen >= q*count:
+                return bound
+        return float('inf')
+
+    def render(self):
+        """
+        Return everything in the Prometheus text exposition format
+        """
+        def fmt_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{%s}'%(','.join('%s="%s"'%(k, str(v).replace('"', '\\"')) for k, v in labels))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+
+        lines = []
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(set(name for (name, _), _ in items)):
+                lines.append('# TYPE %s %s'%(name, kind))
+                for (n, labels), value in items:
+                    if n == name:
+                        lines.append('%s%s %s'%(name, fmt_labels(labels), value))
+
+        for name in sorted(set(name for (name, _), _ in histograms)):
+            lines.append('# TYPE %s histogram'%(name))
+            for (n, labels), (buckets, total, count) in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, value in zip(self.BUCKETS, buckets):
+                    cumulative += value
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d'%(name, fmt_labels(labels, [('le', le)]), cumulative))
+                lines.append('%s_sum%s %f'%(name, fmt_labels(labels), total))
+                lines.append('%s_count%s %d'%(name, fmt_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Return a short, human-readable rundown of our histograms, slowest first
+        """
+        with self.lock:
+            histograms = [(k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items()]
+            gauges = dict(self.gauges)
+
+        histograms.sort(key=lambda kv: kv[1][1], reverse=True)
+        lines = []
+        for (name, labels), hist in histograms:
+            lines.append("%s%s: n=%d mean=%.3fs p95<=%ss"%(
+                name, dict(labels) or '', hist[2], hist[1]/max(hist[2], 1), self.quantile(hist, 0.95),
+            ))
+        for (name, labels), value in sorted(gauges.items()):
+            lines.append("%s%s: %s"%(name, dict(labels) or '', value))
+        return lines
+
+metrics = Metrics()
+
+def instrumented(metric):
+    """
+    Decorator that times every call of a method into histogram `metric`,
+    labelled with the method's name.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(metric, method=method.__name__):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, refilling at `rate` tokens per second and
+    holding at most `burst` of them.  With a `rate` of `None` it never runs
+    out, and only holds anybody up while it's paused.
+    """
+    def __init__(self, rate, burst):
+        from time import monotonic
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def idle(self):
+        """
+        Whether we've gone untouched long enough to have filled right back up,
+        so that we're no different from a brand new bucket.
+        """
+        from time import monotonic
+
+        with self.lock:
+            return self.rate is None or monotonic() - self.stamp >= self.burst/self.rate
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens at all for the next `seconds`, e.g. because Slack
+        told us to back off.
+        """
+        from time import monotonic
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = min(self.tokens, 1)
+
+    def acquire(self, reserve=0):
+        """
+        Take a token, sleeping until one is available.  Returns the number of
+        seconds we spent waiting.  With a `reserve`, we wait until we can take
+        our token and still leave that many behind for somebody else.
+        """
+        from time import monotonic, sleep
+
+        needed = 1 + min(reserve, self.burst - 1)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                if self.rate is not None:
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp)*self.rate)
+                self.stamp = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return waited
+                elif self.tokens >= needed:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (needed - self.tokens)/self.rate
+            sleep(wait)
+            waited += wait
+
+# Slack's published rate limit tiers, in calls per minute, and the tier each
+# method we use falls into.  `chat.postMessage` isn't tiered, but Slack asks
+# for no more than about one message per second in any one channel.
+SLACK_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+SLACK_METHOD_TIERS = {
+    'auth.test': 4,
+    'files.upload': 2,
+    'users.list': 2,
+    'im.list': 2,
+    'users.info': 4,
+    'mpim.open': 4,
+    'groups.leave': 3,
+    'chat.postEphemeral': 4,
+}
+
+# Methods with a rate of their own rather than a tier's.  A rate of `None`
+# means we don't hold back at all, and just do as we're told when Slack says
+# `ratelimited`: a trigger opens and leaves one chat per pairing, and those
+# tiers' limits would stretch a big group's trigger out over minutes, where
+# Slack lets short bursts like that through.
+SLACK_METHOD_RATES = {
+    'chat.postMessage': 60,
+    'mpim.open': None,
+    'groups.leave': None,
+}
+
+# Methods whose limit is per channel rather than per workspace, so that
+# posting into one chat doesn't hold up posting into any other
+SLACK_CHANNEL_METHODS = {'chat.postMessage'}
+SLACK_CHANNEL_BUCKETS = 512
+slack_buckets_lock = threading.Lock()
+
+def slack_bucket(api_name, channel=None):
+    """
+    Return the current tenant's token bucket for `api_name` (in `channel`, for
+    `SLACK_CHANNEL_METHODS`), creating it on first use, since Slack's limits
+    are per workspace.  We let each method burst up to a minute's worth of
+    calls, the same as Slack does.
+    """
+    buckets = get_tenant().buckets
+    key = (api_name, channel) if api_name in SLACK_CHANNEL_METHODS else api_name
+    with slack_buckets_lock:
+        if key not in buckets:
+            # There's a new chat every pairing, so forget the ones that have
+            # been quiet long enough that a fresh bucket would be just the same
+            if len(buckets) >= SLACK_CHANNEL_BUCKETS:
+                for old in [k for k, b in buckets.items() if isinstance(k, tuple) and b.idle()]:
+                    del buckets[old]
+
+            if api_name in SLACK_METHOD_RATES:
+                per_minute = SLACK_METHOD_RATES[api_name]
+            else:
+                per_minute = SLACK_TIERS[SLACK_METHOD_TIERS.get(api_name, 3)]
+            if per_minute is None:
+                buckets[key] = TokenBucket(None, 0)
+            else:
+                buckets[key] = TokenBucket(per_minute/60.0, per_minute)
+        return buckets[key]
+
+# Command handlers leave this fraction of every method's budget untouched,
+# so that a storm of messages can't eat the calls a trigger needs.  Threads
+# that should hold back set `slack_reserve.fraction`.
+SLACK_TRIGGER_RESERVE = float(os.environ.get('BRAYERPOT_TRIGGER_RESERVE', 0.25))
+slack_reserve = threading.local()
+
+# Errors that are worth retrying, since they usually go away on their own
+SLACK_TRANSIENT_ERRORS = {
+    'ratelimited', 'service_unavailable', 'internal_error', 'fatal_error',
+    'request_timeout',
+}
+SLACK_MAX_RETRIES = 5
+SLACK_BACKOFF_BASE = 1.0
+SLACK_BACKOFF_CAP = 30.0
+
+# Methods that are fine to call again when we can't tell whether Slack got
+# them the first time (a read timeout, say), since doing them twice is the
+# same as doing them once.  Anything else, like posting a message, only gets
+# tried again if we know it never got there.
+SLACK_IDEMPOTENT_METHODS = {'auth.test', 'users.info', 'users.list', 'im.list', 'mpim.open', 'rtm.connect'}
+
+# How hard we've been leaning on slack; see `slack_call_stats()`
+slack_stats = {
+    'calls': 0,
+    'retries': 0,
+    'ratelimited': 0,
+    'throttled_seconds': 0.0,
+}
+slack_stats_lock = threading.Lock()
+
+def count_slack_stat(name, amount=1):
+    with slack_stats_lock:
+        slack_stats[name] += amount
+
+def slack_call_stats():
+    with slack_stats_lock:
+        return dict(slack_stats)
+
+# How we send Web API calls: `pooled` keeps connections to Slack open and
+# reuses them, shared between every tenant, while `slackclient` leaves it to
+# `SlackClient.api_call`, which opens a fresh one every time.  Set
+# `BRAYERPOT_HTTP2=1` (and install `httpx[http2]`) to multiplex everything
+# over a single HTTP/2 connection instead.
+SLACK_TRANSPORT = os.environ.get('BRAYERPOT_SLACK_TRANSPORT', 'pooled')
+SLACK_API_URL = os.environ.get('BRAYERPOT_SLACK_API_URL', 'https://slack.com/api/')
+HTTP_POOL_SIZE = int(os.environ.get('BRAYERPOT_HTTP_POOL_SIZE', 24))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('BRAYERPOT_HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('BRAYERPOT_HTTP_READ_TIMEOUT', 30))
+HTTP2 = os.environ.get('BRAYERPOT_HTTP2', '0') == '1'
+
+class SlackConnectError(IOError):
+    """
+    We couldn't even connect to Slack, so whatever we were calling certainly
+    never happened, and it's safe to try again.
+    """
+
+class SlackHTTP:
+    """
+    A pool of keep-alive connections to the Slack Web API, for every tenant
+    to send their calls through.  Up to `pool_size` connections stay open
+    for reuse, which matters most when a trigger fires off dozens of calls in
+    a row and would otherwise pay for a TCP and TLS handshake on every one.
+
+    We keep track of every connection we've seen go by, so that `stats()` can
+    say how often we got to reuse one.
+    """
+    def __init__(self, url=SLACK_API_URL, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, http2=HTTP2):
+        from weakref import WeakKeyDictionary
+
+        self.url = url
+        self.http2 = http2
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.live = WeakKeyDictionary()
+        if http2:
+            import httpx
+
+            self.client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+        else:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            self.client.mount(url, adapter)
+            self.timeout = (connect_timeout, read_timeout)
+
+            # By the time `post()` returns, the connection has gone back in
+            # the pool, so catch it on the way past
+            self.client.hooks['response'].append(
+                lambda response, **kwargs: self.count(getattr(response.raw, 'connection', None)))
+
+    def post(self, token, method, data):
+        """
+        Call `method` with `data` as `token`, returning the parsed response
+        with its headers tucked into `headers`, the same as `SlackClient`
+        does.  Network trouble raises `IOError` (`SlackConnectError` if we
+        never got as far as sending anything), and a response that isn't JSON
+        raises `ValueError`.
+        """
+        import json
+
+        # Like `SlackClient`, anything that isn't a plain value goes as JSON
+        data = {k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in data.items()}
+        headers = {'Authorization': 'Bearer %s'%(token)}
+        if self.http2:
+            import httpx
+            try:
+                response = self.client.post(self.url + method, data=data, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                raise SlackConnectError("%s: %r"%(method, e)) from e
+            except httpx.TransportError as e:
+                raise IOError("%s: %r"%(method, e)) from e
+            self.count(response.extensions.get('network_stream'))
+        else:
+            import requests
+            from urllib3.exceptions import NewConnectionError
+            try:
+                response = self.client.post(self.url + method, data=data, headers=headers, timeout=self.timeout)
+            except requests.exceptions.ConnectTimeout as e:
+                raise SlackConnectError("%s: %r"%(method, e)) from e
+            except requests.exceptions.ConnectionError as e:
+                if isinstance(getattr(e.args[0] if e.args else None, 'reason', None), NewConnectionError):
+                    raise SlackConnectError("%s: %r"%(method, e)) from e
+                raise
+
+        result = response.json()
+        result['headers'] = dict(response.headers)
+        return result
+
+    def count(self, connection):
+        with self.lock:
+            self.requests += 1
+            if connection is None:
+                return
+            if connection not in self.live:
+                self.connections += 1
+                self.live[connection] = 0
+            self.live[connection] += 1
+
+    def stats(self):
+        with self.lock:
+            per_connection = list(self.live.values())
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections,
+                'connections_open': len(per_connection),
+                'reused': max(0, self.requests - self.connections),
+                'max_requests_per_connection': max(per_connection or [0]),
+            }
+
+slack_http = None
+slack_http_lock = threading.Lock()
+
+def get_slack_http():
+    """
+    The `SlackHTTP` everybody shares, set up the first time somebody needs it.
+    """
+    global slack_http
+    with slack_http_lock:
+        if slack_http is None:
+            slack_http = SlackHTTP()
+            logging.info("Talking to %s over %s, up to %d connections", slack_http.url,
+                         "HTTP/2" if slack_http.http2 else "HTTP/1.1", HTTP_POOL_SIZE)
+        return slack_http
+
+class SlackTransport:
+    """
+    Sends one tenant's Web API calls with their token, through the shared
+    `SlackHTTP` pool.
+    """
+    def __init__(self, token):
+        self.token = token
+
+    def api_call(self, method, **kwargs):
+        return get_slack_http().post(self.token, method, kwargs)
+
+def retry_after(api_call):
+    """
+    Return the `Retry-After` header of a failed api call in seconds, or `None`
+    """
+    headers = api_call.get("headers") or {}
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
 
 def slack_call(api_name, **kwargs):
-    global slack_client
-    api_call = slack_client.api_call(api_name, **kwargs)
-    if api_call.get("ok"):
-        return api_call
-    else:
-        logging.warn("Could not complete api call %s: %s", api_name, api_call)
-        raise RuntimeError("slack call %s failed"%(api_name))
+    """
+    Call `api_name`, waiting for our per-method call budget first.  Transient
+    failures (rate limiting, Slack having a bad day, network hiccups) get
+    retried with jittered exponential backoff, honoring `Retry-After` when
+    Slack gives us one, except that a network hiccup after we'd sent the call
+    only gets retried for `SLACK_IDEMPOTENT_METHODS`.  Anything else raises
+    `RuntimeError`.
+    """
+    from random import uniform
+    from time import perf_counter, sleep
+
+    transport = get_tenant().transport
+    bucket = slack_bucket(api_name, kwargs.get('channel'))
+    for attempt in range(SLACK_MAX_RETRIES + 1):
+        reserve = bucket.burst*getattr(slack_reserve, 'fraction', 0)
+        count_slack_stat('throttled_seconds', bucket.acquire(reserve))
+        count_slack_stat('calls')
+        start = perf_counter()
+        try:
+            api_call = transport.api_call(api_name, **kwargs)
+        except (IOError, ValueError) as e:
+            api_call = {"ok": False, "error": "request_failed", "exception": repr(e)}
+            if isinstance(e, SlackConnectError) or api_name in SLACK_IDEMPOTENT_METHODS:
+                error = "request_timeout"
+            else:
+                error = "request_failed"
+        else:
+            if api_call.get("ok"):
+                metrics.observe('brayerpot_slack_call_seconds', perf_counter() - start, method=api_name)
+                return api_call
+            error = api_call.get("error")
+        metrics.observe('brayerpot_slack_call_seconds', perf_counter() - start, method=api_name)
+        metrics.inc('brayerpot_slack_call_errors_total', method=api_name, error=error)
+
+        # On our way out there's no time to wait around for Slack
+        if error not in SLACK_TRANSIENT_ERRORS or attempt == SLACK_MAX_RETRIES or stopping.is_set():
+            break
+
+        delay = uniform(0, min(SLACK_BACKOFF_CAP, SLACK_BACKOFF_BASE*2**attempt))
+        if error == 'ratelimited':
+            count_slack_stat('ratelimited')
+            delay = retry_after(api_call) or delay
+
+            # Nobody else gets to call this method until Slack says so either
+            bucket.pause(delay)
+        else:
+            sleep(delay)
+            count_slack_stat('throttled_seconds', delay)
+
+        count_slack_stat('retries')
+        logging.info("Retrying api call %s after %s (%.1fs)", api_name, error, delay)
+
+    logging.warn("Could not complete api call %s: %s", api_name, api_call)
+    raise RuntimeError("slack call %s failed"%(api_name))
 
 def chat_type(payload):
     if not is_im_to_me(payload):
@@ -33,37 +576,125 @@ def chat_type(payload):
 
 def bot_id(force=False):
     """
-    Find our bot id on this particular Slack, cached in global `BOT_ID`, will
-    only search for it again if `force` is set to `True`.
+    Find our bot id on the current tenant's Slack, cached on the tenant, will
+    only ask again if `force` is set to `True`.  `auth.test` tells us who our
+    token belongs to, so there's no need to go looking through every user.
     """
-    global BOT_ID, BOT_NAME
+    tenant = get_tenant()
+    if tenant.bot_id is not None and not force:
+        return tenant.bot_id
 
-    if BOT_ID is None or force:
-        users = slack_call('users.list').get('members')
-        for user in users:
-            if 'name' in user and user.get('name') == BOT_NAME:
-                BOT_ID = user.get('id')
-                logging.info("Auto-discovered our BOT_ID as %s", BOT_ID)
+    # Several command workers can all find out they need this at once
+    with tenant.lookup_lock:
+        if tenant.bot_id is not None and not force:
+            return tenant.bot_id
+        identity = slack_call('auth.test')
 
         # If we completely failed to find ourselves, freak out
-        if BOT_ID is None:
+        if identity.get('user_id') is None:
             logging.error("Could not find BOT_ID!  Wigging out!")
             raise RuntimeError("Could not find BOT_ID")
 
-    return BOT_ID
+        tenant.bot_name = identity.get('user', tenant.bot_name)
+        tenant.team_id = identity.get('team_id')
+        tenant.bot_id = identity['user_id']
+        logging.info("Auto-discovered our BOT_ID on %s as %s (%s)", tenant.name,
+                     tenant.bot_id, tenant.bot_name)
+        return tenant.bot_id
+
+# How many members to ask for per `users.list` page.  Slack caps this at
+# 1000 but recommends no more than 200.
+USERS_PAGE_SIZE = 200
+
+# Paging through `users.list` only beats a `users.info` apiece when the
+# people we're after make up at least this much of the workspace
+USERS_WALK_FRACTION = 0.25
+
+def iter_users(page_size=USERS_PAGE_SIZE, max_pages=None):
+    """
+    Yield every member of the workspace (or of its first `max_pages` pages),
+    one `users.list` page at a time, so that we never hold more than a page
+    of them in memory at once.
+    """
+    cursor = None
+    pages = 0
+    while True:
+        kwargs = {'limit': page_size}
+        if cursor:
+            kwargs['cursor'] = cursor
+        page = slack_call('users.list', **kwargs)
+        for user in page.get('members', []):
+            yield user
+
+        pages += 1
+        cursor = (page.get('response_metadata') or {}).get('next_cursor')
+        if not cursor or pages == max_pages:
+            return
+
+def load_im_channels():
+    """
+    Fetch the full list of DM channels we're a part of into the current
+    tenant's `im_channels`.  This happens once at connect, and again only when
+    we see a DM channel we don't know about yet.
+    """
+    tenant = get_tenant()
+    tenant.im_channels = set(im['id'] for im in slack_call('im.list')['ims'])
+    logging.info("Loaded %d DM channels on %s", len(tenant.im_channels), tenant.name)
+    return tenant.im_channels
+
+def handle_im_event(payload):
+    """
+    Keep our set of DM channels up to date as DMs get opened and closed.  Note
+    that `im_created` gives us a whole channel object, while `im_open` and
+    `im_close` just give us the id.
+    """
+    im_channels = get_tenant().im_channels
+    if im_channels is None:
+        return
+
+    channel = payload.get('channel')
+    if isinstance(channel, dict):
+        channel = channel.get('id')
+    if not channel:
+        return
+
+    if payload['type'] == 'im_close':
+        im_channels.discard(channel)
+    else:
+        im_channels.add(channel)
 
 def is_im_to_me(payload):
     """
     Given a payload, look at the channel and see if it's in a DM to me.
     """
-    im_list = slack_call('im.list')['ims']
-    return any(payload['channel'] == im['id'] for im in im_list)
+    # The Events API tells us outright
+    if payload.get('channel_type') == 'im':
+        return True
+
+    channel = payload.get('channel', '')
+    tenant = get_tenant()
+    im_channels = tenant.im_channels
+    if im_channels is None:
+        with tenant.lookup_lock:
+            im_channels = tenant.im_channels
+            if im_channels is None:
+                im_channels = load_im_channels()
+
+    if channel in im_channels:
+        return True
+
+    # DM channel ids start with a `D`; if this looks like one we haven't heard
+    # about (e.g. we missed an event), go refresh our list.  Everything else
+    # can't possibly be a DM, so don't bother asking Slack.
+    if channel.startswith('D'):
+        return channel in load_im_channels()
+    return False
 
 def is_from_me(payload):
     """
     Given a payload, look at the user and see if it's a message from me.
     """
-    return payload['user'] == bot_id()
+    return payload.get('user') == bot_id()
 
 def day_to_int(day):
     mapping = {
@@ -86,62 +717,900 @@ def int_to_day(day):
     return mapping[day]
 
 def get_now():
-    import datetime
-    import pytz
+    return datetime.datetime.now(datetime.timezone.utc)
 
-    return datetime.datetime.now().astimezone(pytz.utc)
+# Trigger times are in Pacific time, wherever we happen to be running
+TRIGGER_TIMEZONE = pytz.timezone('US/Pacific')
 
-class DataBase:
-    def __init__(self, path):
-        self.db = shelve.open(path)
-        
-        # Initialize some data within the db if it doesn't already exist
-        if 'groups' not in self.db:
-            # If we need to migrate some old data, do so!
-            if len(self.db.keys()) > 0:
-                logging.info("Migrating old data...")
-                old_data = {k: self.db[k] for k in self.db}
-                self.db.clear()
-
-                self.db['groups'] = {}
-                self.db['group_times'] = {}
-
-                for group in old_data:
-                    for user in old_data[group]:
-                        self.add_user_to_group(user, group)
+def next_trigger_date(tinfo):
+    """
+    Given the trigger info stored for a group (`trigger_weeks`, `trigger_day`,
+    `trigger_hour` and `last_trigger`), return the next date it should trigger.
+    That's always after `last_trigger`, so a group only triggers once a period.
+    """
+    # Start from the last trigger point, converting to PST
+    dt = tinfo['last_trigger'].astimezone(TRIGGER_TIMEZONE)
+
+    # Go to the next week's day that we care about
+    skip_days = 7*tinfo['trigger_weeks']
+    dt += datetime.timedelta(days=(tinfo['trigger_day'] - dt.weekday()+skip_days)%skip_days)
+
+    # Set the hour and seconds and whatnot appropriately
+    dt = dt.replace(hour=tinfo['trigger_hour'], minute=0, second=0, microsecond=0)
+
+    # If that's the very day we last triggered, and we did so at (or after)
+    # that hour, it's this period's trigger and we've done it already
+    if dt <= tinfo['last_trigger']:
+        dt += datetime.timedelta(days=skip_days)
+
+    # Return that
+    return dt
+
+def trigger_is_due(tinfo, now=None):
+    """
+    Whether a group with trigger info `tinfo` hasn't been triggered yet this
+    period, and it's time it was.
+    """
+    return next_trigger_date(tinfo) <= (now or get_now())
+
+# Try not to pair up people who've met within this many weeks.  When looking
+# for someone's partner, we only consider `PAIRING_WINDOW` candidates, which
+# keeps planning linear in the size of the group.
+PAIRING_AVOID_WEEKS = int(os.environ.get('BRAYERPOT_PAIRING_AVOID_WEEKS', 8))
+PAIRING_WINDOW = 32
+
+def current_week():
+    """
+    The number of whole weeks since the epoch, which is all the resolution our
+    pairing history needs.
+    """
+    from time import time
+    return int(time()//(7*24*60*60))
+
+def pair_key(a, b):
+    return (a, b) if a < b else (b, a)
+
+def grouping_pair_keys(user_groupings):
+    """
+    Every `pair_key()` of people that end up in a chat together
+    """
+    for grouping in user_groupings:
+        for i in range(len(grouping)):
+            for j in range(i + 1, len(grouping)):
+                yield pair_key(grouping[i], grouping[j])
+
+def plan_pairings(users, history, week, seed=None):
+    """
+    Split `users` up into groups of 2 (if we have an uneven number, one group
+    will have 3 people), trying hard not to put people together who met
+    recently according to `history`, as returned by `get_pair_history()`.
+    Pass a `seed` to get the same pairings every time.
+
+    This is a greedy matching: everybody takes the least recently met of the
+    next `PAIRING_WINDOW` people in a shuffled line, followed by a pass that
+    swaps partners between pairs wherever that makes both of them better off.
+    """
+    from random import Random
+    rng = Random(seed)
+
+    def cost(grouping):
+        # Pairs that have met more recently cost more; strangers are free
+        total = 0
+        for key in grouping_pair_keys([grouping]):
+            last = history.get(key)
+            if last is not None:
+                total += max(0, PAIRING_AVOID_WEEKS - (week - last))
+        return total
+
+    remaining = list(users)
+    rng.shuffle(remaining)
+
+    user_groupings = []
+    while len(remaining) >= 2:
+        a = remaining.pop()
+        best_idx, best_cost = None, None
+        for idx in range(len(remaining) - 1, max(-1, len(remaining) - 1 - PAIRING_WINDOW), -1):
+            c = cost([a, remaining[idx]])
+            if best_cost is None or c < best_cost:
+                best_idx, best_cost = idx, c
+                if c == 0:
+                    break
+
+        # Swap our pick to the end so taking them out of line is O(1)
+        remaining[best_idx], remaining[-1] = remaining[-1], remaining[best_idx]
+        user_groupings.append([a, remaining.pop()])
+
+    # Swap partners between a repeat pair and some other pair if it helps
+    if len(user_groupings) > 1:
+        for idx, grouping in enumerate(user_groupings):
+            for _ in range(PAIRING_WINDOW if cost(grouping) > 0 else 0):
+                other_idx = rng.randrange(len(user_groupings))
+                if other_idx == idx:
+                    continue
+                (a, b), (c, d) = grouping, user_groupings[other_idx]
+                before = cost([a, b]) + cost([c, d])
+                if cost([a, c]) + cost([b, d]) < before:
+                    grouping[:], user_groupings[other_idx][:] = [a, c], [b, d]
+                elif cost([a, d]) + cost([b, c]) < before:
+                    grouping[:], user_groupings[other_idx][:] = [a, d], [b, c]
+                if cost(grouping) == 0:
+                    break
+
+    # Whoever is left over joins whichever pair minds the least
+    if remaining and user_groupings:
+        candidates = range(len(user_groupings) - 1, max(-1, len(user_groupings) - 1 - PAIRING_WINDOW), -1)
+        best_idx = min(candidates, key=lambda idx: cost(user_groupings[idx] + remaining))
+        user_groupings[best_idx] += remaining
+
+    return user_groupings
+
+def synchronized(method):
+    """
+    Decorator for methods that must hold `self.lock`, since the database gets
+    used from both the event loop and the trigger threads.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class MembershipIndex:
+    """
+    Who's in which group, kept compactly in memory.  Every user id gets
+    interned to a small integer the first time we see it, and each group is a
+    sorted `array` of those integers, so membership tests are a binary search
+    and a group costs four bytes per member rather than a list of strings.
+    Each user's groups are kept the same way, so "which groups am I in"
+    doesn't have to look at every group.
+
+    Arrays get replaced rather than modified in place, so reads never need a
+    lock and a `snapshot()` is just a shallow copy of a couple of dicts.
+    Writers should hold their database's lock.
+    """
+    def __init__(self, groups=None):
+        self.user_ids = {}
+        self.users = []
+        self.group_ids = {}
+        self.group_names = []
+        self.members = {}
+        self.memberships = {}
+        for group, users in (groups or {}).items():
+            self.add_all(users, group)
+
+    @staticmethod
+    def inserted(ids, i):
+        from array import array
+        from bisect import bisect_left
+
+        pos = bisect_left(ids, i)
+        if pos < len(ids) and ids[pos] == i:
+            return None
+        return ids[:pos] + array('I', [i]) + ids[pos:]
+
+    @staticmethod
+    def removed(ids, i):
+        from bisect import bisect_left
+
+        pos = bisect_left(ids, i)
+        if pos == len(ids) or ids[pos] != i:
+            return None
+        return ids[:pos] + ids[pos + 1:]
+
+    def intern(self, user):
+        uid = self.user_ids.get(user)
+        if uid is None:
+            uid = self.user_ids[user] = len(self.users)
+            self.users.append(user)
+        return uid
+
+    def intern_group(self, group):
+        gid = self.group_ids.get(group)
+        if gid is None:
+            gid = self.group_ids[group] = len(self.group_names)
+            self.group_names.append(group)
+        return gid
+
+    def add_group(self, group):
+        from array import array
+
+        if group not in self.members:
+            self.intern_group(group)
+            self.members[group] = array('I')
+
+    def add(self, user, group):
+        """
+        Put `user` in `group`, creating the group if need be.  Returns whether
+        anything changed.
+        """
+        from array import array
+
+        self.add_group(group)
+        uid, gid = self.intern(user), self.group_ids[group]
+        members = self.inserted(self.members[group], uid)
+        if members is None:
+            return False
+        self.members[group] = members
+        self.memberships[uid] = self.inserted(self.memberships.get(uid, array('I')), gid)
+        return True
+
+    def add_all(self, users, group):
+        """
+        Put all of `users` in `group`, creating the group if need be.  For a
+        big group, that's a lot cheaper than an `add()` at a time, since the
+        group's array only gets built the once.  Returns how many of them
+        weren't in it already.
+        """
+        from array import array
+
+        self.add_group(group)
+        gid, members = self.group_ids[group], self.members[group]
+
+        # `intern()`, spelled out, since this is most of the cost of loading
+        user_ids, names, new = self.user_ids, self.users, set()
+        for user in users:
+            uid = user_ids.get(user)
+            if uid is None:
+                uid = user_ids[user] = len(names)
+                names.append(user)
+            new.add(uid)
+        new.difference_update(members)
+        if not new:
+            return 0
+        self.members[group] = array('I', sorted(new.union(members)))
+
+        # When loading groups one after another, each one is newer than any
+        # group its members are in yet, so it just goes on the end
+        memberships, tail = self.memberships, array('I', [gid])
+        for uid in new:
+            ids = memberships.get(uid)
+            if not ids or ids[-1] < gid:
+                memberships[uid] = ids + tail if ids else tail
             else:
-                # Otherwise, just initialize to empty...
-                self.db['groups'] = {}
-                self.db['group_times'] = {}
+                memberships[uid] = self.inserted(ids, gid)
+        return len(new)
+
+    def remove(self, user, group):
+        """
+        Take `user` out of `group`, returning whether they were in it.
+        """
+        uid = self.user_ids.get(user)
+        if uid is None or group not in self.members:
+            return False
+        members = self.removed(self.members[group], uid)
+        if members is None:
+            return False
+        self.members[group] = members
+        self.memberships[uid] = self.removed(self.memberships[uid], self.group_ids[group])
+        return True
+
+    def drop_group(self, group):
+        members = self.members.pop(group, None)
+        if members is None:
+            return
+        gid = self.group_ids[group]
+        for uid in members:
+            self.memberships[uid] = self.removed(self.memberships[uid], gid)
+
+    def has_group(self, group):
+        return group in self.members
+
+    def contains(self, user, group):
+        from bisect import bisect_left
+
+        uid = self.user_ids.get(user)
+        members = self.members.get(group)
+        if uid is None or members is None:
+            return False
+        pos = bisect_left(members, uid)
+        return pos < len(members) and members[pos] == uid
+
+    def group_list(self):
+        return list(self.members)
+
+    def members_of(self, group):
+        """
+        Everybody in `group`, raising `KeyError` if there's no such group.
+        """
+        users = self.users
+        return [users[uid] for uid in self.members[group]]
+
+    def groups_for(self, user):
+        uid = self.user_ids.get(user)
+        if uid is None:
+            return []
+        names = self.group_names
+        return sorted(names[gid] for gid in self.memberships.get(uid, ()))
+
+    def union(self, groups):
+        """
+        Everybody who's in any of `groups`, each of them once.
+        """
+        uids = set()
+        for group in groups:
+            uids.update(self.members.get(group, ()))
+        users = self.users
+        return [users[uid] for uid in sorted(uids)]
+
+    def intersection(self, groups):
+        """
+        Everybody who's in all of `groups`.
+        """
+        groups = list(groups)
+        if not groups:
+            return []
+        uids = set(self.members.get(groups[0], ()))
+        for group in groups[1:]:
+            uids.intersection_update(self.members.get(group, ()))
+        users = self.users
+        return [users[uid] for uid in sorted(uids)]
+
+    def snapshot(self):
+        """
+        A copy that later changes to us won't show up in.  The interning
+        tables only ever get appended to, so we can share those.
+        """
+        copy = MembershipIndex.__new__(MembershipIndex)
+        copy.user_ids, copy.users = self.user_ids, self.users
+        copy.group_ids, copy.group_names = self.group_ids, self.group_names
+        copy.members = dict(self.members)
+        copy.memberships = dict(self.memberships)
+        return copy
+
+    def size(self, group):
+        return len(self.members.get(group, ()))
+
+    def to_dict(self):
+        return {group: self.members_of(group) for group in self.members}
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'groups': len(self.members),
+            'memberships': sum(len(m) for m in self.members.values()),
+        }
+
+def file_size(path):
+    """
+    How many bytes the database at `path` takes up on disk, counting every
+    file it's spread over (dbm's `.dat`/`.dir`, SQLite's `-wal`, and so on).
+    """
+    from glob import escape, glob
+
+    return sum(os.path.getsize(p) for p in glob(escape(path) + '*') if os.path.isfile(p))
+
+def fsync_files(path):
+    """
+    Make sure every file that the database at `path` is spread over has
+    really hit the disk.
+    """
+    from glob import escape, glob
+
+    for p in glob(escape(path) + '*'):
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class BaseDataBase:
+    """
+    The bits that every storage engine shares: computing trigger dates from
+    the stored trigger info, telling anyone who cares (e.g. the trigger
+    scheduler) when a group's schedule changes, and batching writes up into
+    as few commits as possible.
+
+    Mutations are visible to everybody as soon as they're made (or, inside a
+    `transaction()`, once it's done), but only hit the disk when `commit()`
+    gets called.  Outside of a `transaction()` that happens after every
+    mutation; inside one, once at the very end.  Set a `flush_interval` to go
+    further and commit at most that often, at the risk of losing that many
+    seconds' worth of changes in a crash.
+    """
+    def __init__(self, flush_interval=0):
+        from time import monotonic
+
+        self.lock = threading.RLock()
+        self.schedule_listeners = []
+        self.flush_interval = flush_interval
+        self.last_commit = monotonic()
+        self.dirty = set()
+        self.local = threading.local()
+
+    def add_schedule_listener(self, listener):
+        """
+        Call `listener(db, group)` whenever `group`'s schedule changes, or the
+        group goes away.
+        """
+        self.schedule_listeners.append(listener)
+
+    def schedule_changed(self, group):
+        if getattr(self.local, 'depth', 0):
+            self.local.rescheduled.add(group)
+        for listener in self.schedule_listeners:
+            listener(self, group)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Batch every mutation made within this block into a single commit at
+        the end.  Nobody else gets to look at the database until we're done,
+        so don't talk to Slack in here.
+
+        If an exception gets out of the outermost block, everything it did is
+        rolled back.  Anything still waiting on `flush_interval` gets
+        committed before we start, so that it doesn't go along with it.
+        """
+        with self.lock:
+            depth = getattr(self.local, 'depth', 0)
+            if depth == 0:
+                if self.dirty:
+                    self.commit()
+                self.local.rescheduled = set()
+            self.local.depth = depth + 1
+            try:
+                yield self
+            except:
+                # Plenty of transactions bail out (e.g. on a group that isn't
+                # there) before they've changed anything, and needn't reload
+                if depth == 0 and (self.dirty or self.local.rescheduled):
+                    self.local.depth = depth
+                    logging.warn("Rolling back a transaction that failed")
+                    self.rollback()
+                    for group in self.local.rescheduled:
+                        self.schedule_changed(group)
+                raise
+            finally:
+                self.local.depth = depth
+                if depth == 0:
+                    self.settle()
+                    self.commit_if_due()
+
+    def rollback(self):
+        """
+        Throw away everything since the last commit.
+        """
+        raise NotImplementedError
+
+    def settle(self):
+        """
+        Called whenever we're done changing things for now, i.e. at the end
+        of a transaction, or after a mutation outside of one.
+        """
+
+    def mutated(self, *keys):
+        """
+        Note that we've changed something (storage engines may care which
+        `keys`), committing right away unless we're in a transaction.
+        """
+        self.dirty.update(keys or ['*'])
+        if getattr(self.local, 'depth', 0) == 0:
+            self.settle()
+            self.commit_if_due()
+
+    def commit_if_due(self):
+        from time import monotonic
+
+        if self.dirty and monotonic() - self.last_commit >= self.flush_interval:
+            self.commit()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def commit(self):
+        """
+        Write out everything that's changed since the last commit.
+        """
+        from time import monotonic
+
+        if self.dirty:
+            self.write(self.dirty)
+            self.dirty = set()
+        self.last_commit = monotonic()
+
+    @instrumented('brayerpot_db_seconds')
+    def remove_user_from_all_groups(self, user):
+        """
+        Remove a user from all groups
+        """
+        with self.transaction():
+            for group in self.list_groups(user):
+                self.remove_user_from_group(user, group)
+
+    def membership(self):
+        """
+        The `MembershipIndex` to answer questions about who's in what from.
+        """
+        return self.members
+
+    def settled_membership(self):
+        """
+        The `MembershipIndex` for anybody who's only looking, which mustn't
+        show them a transaction that's only half done (or about to be rolled
+        back).  That's the live one here, for storage engines whose
+        `membership()` waits for the lock.
+        """
+        return self.membership()
+
+    @instrumented('brayerpot_db_seconds')
+    def list_groups(self, user):
+        """
+        List groups for a user
+        """
+        return self.settled_membership().groups_for(user)
+
+    @instrumented('brayerpot_db_seconds')
+    def list_all_groups(self):
+        """
+        List all groups
+        """
+        return self.settled_membership().group_list()
+
+    @instrumented('brayerpot_db_seconds')
+    def get_group(self, group):
+        """
+        Given a group ID, return the group.  Duh.  Raises `KeyError` if there's
+        no such group.
+        """
+        return self.settled_membership().members_of(group.lower())
+
+    @instrumented('brayerpot_db_seconds')
+    def get_groups_union(self, groups):
+        """
+        Everybody in any of `groups`, each of them just the once.
+        """
+        return self.settled_membership().union(g.lower() for g in groups)
+
+    @instrumented('brayerpot_db_seconds')
+    def get_groups_intersection(self, groups):
+        """
+        Everybody in all of `groups`.
+        """
+        return self.settled_membership().intersection(g.lower() for g in groups)
+
+    def snapshot_memberships(self):
+        """
+        A `MembershipIndex` of who's in what right now, that won't change
+        underneath you.
+        """
+        return self.settled_membership().snapshot()
+
+    def is_empty(self):
+        return not self.settled_membership().group_list()
+
+    def summary(self):
+        """
+        What's in here, in a line.  Just the numbers: printing everybody's
+        memberships on every boot gets slow once there are enough of them.
+        """
+        stats = self.membership().stats()
+        return "%d prayer groups, %d memberships, %d unfinished trigger jobs"%(
+            stats['groups'], stats['memberships'], len(self.list_trigger_jobs()))
+
+    def disk_usage(self):
+        return file_size(self.path)
+
+    def get_group_trigger_info(self, group):
+        tinfo = self.get_group_times(group)
+        if tinfo is not None:
+            weeks = tinfo['trigger_weeks']
+            day = int_to_day(tinfo['trigger_day'])
+            hour = tinfo['trigger_hour']
+            return day, hour, weeks
+
+    def get_group_trigger_date(self, group):
+        """
+        Return the next trigger date for a group
+        """
+        tinfo = self.get_group_times(group)
+        if tinfo is not None:
+            return next_trigger_date(tinfo)
+        else:
+            logging.warn("Group %s doesn't exist, can't get trigger date!", group)
+
+class LazyShelf(dict):
+    """
+    Top-level keys from a shelve, each only unpickled the first time somebody
+    asks for it, and `{}` if the shelve doesn't have it.
+    """
+    def __init__(self, shelf):
+        super().__init__()
+        self.shelf = shelf
+
+    def __missing__(self, key):
+        value = self[key] = self.shelf.get(key, {})
+        return value
+
+class DataBase(BaseDataBase):
+    # The top-level keys we keep in the shelve, each of which holds a dict.
+    # In memory, `groups` lives in `self.members` and the rest in `self.data`.
+    KEYS = ('groups', 'group_times', 'pair_history', 'trigger_jobs')
+
+    # Except that each trigger job gets a shelve key of its own, since a job
+    # changes with every chat we create, and when a whole batch of groups is
+    # triggering, re-pickling every job every time adds up
+    JOB_PREFIX = 'trigger_job:'
+
+    def __init__(self, path, flush_interval=0, readonly=False):
+        super().__init__(flush_interval)
+        self.path = path
+        self.readonly = readonly
+        self.db = self.open_readonly(path) if readonly else shelve.open(path)
+
+        # Initialize some data within the db if it doesn't already exist
+        if 'groups' not in self.db and not readonly:
+            # If we need to migrate some old data, do so!  That's one key per
+            # group, holding its members, which we read one at a time, and
+            # only delete once the new layout has safely hit the disk.
+            old_groups = list(self.db.keys())
+            self.data = LazyShelf(self.db)
+            self.data.update((k, {}) for k in self.KEYS if k != 'groups')
+            self.members = MembershipIndex()
+            if old_groups:
+                logging.info("Migrating %d old groups...", len(old_groups))
+                with self.transaction():
+                    for group in old_groups:
+                        for user in self.db[group]:
+                            self.add_user_to_group(user, group)
+            self.dirty.update(self.KEYS)
+            self.commit()
+            for group in old_groups:
+                if group not in self.KEYS and not group.startswith(self.JOB_PREFIX):
+                    del self.db[group]
+            self.db.sync()
+        else:
+            self.load()
+
+            # Only one process at a time ever has a shelve open, so any claims
+            # in here are left over from one that's gone
+            for job in self.data['trigger_jobs'].values():
+                job['claims'] = {}
+
+        self.settle()
+        logging.info("Loaded %s: %s", path, self.summary())
+
+    def load(self):
+        """
+        Everything lives in memory; the shelve only gets written on commit.
+        Pair history is only any use when triggering, and can be the biggest
+        thing in here, so it waits until then.
+        """
+        self.data = LazyShelf(self.db)
+        self.members = MembershipIndex(self.db.get('groups', {}))
+        for key in list(self.db.keys()):
+            if key.startswith(self.JOB_PREFIX):
+                self.data['trigger_jobs'][key[len(self.JOB_PREFIX):]] = self.db[key]
+
+    def rollback(self):
+        self.dirty = set()
+        self.load()
+
+    def settle(self):
+        self.settled = self.members.snapshot()
+
+    def settled_membership(self):
+        """
+        Readers don't take the lock here, so unless they're the ones in the
+        middle of a transaction, they get who was in what as of the end of
+        the last one.
+        """
+        if getattr(self.local, 'depth', 0):
+            return self.members
+        return self.settled
+
+    @staticmethod
+    def open_readonly(path):
+        """
+        Open the shelve at `path` without taking gdbm's lock on it, so that we
+        can look at it while some other process has it open for writing.
+        """
+        import dbm
 
-        num_groups = len(self.db['groups'])
-        logging.info("Loaded DB containing %d prayer groups"%(num_groups))
-        logging.info(self.db['groups'])
-        logging.info(self.db['group_times'])
+        if dbm.whichdb(path) == 'dbm.gnu':
+            import dbm.gnu
+            return shelve.Shelf(dbm.gnu.open(path, 'ru'))
+        return shelve.open(path, 'r')
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.db is None:
+            return
         logging.info("Gracefully closing database...")
+        if self.dirty:
+            self.write(self.dirty)
+        self.db.close()
+        self.db = None
+
+    def write(self, keys):
+        """
+        Re-pickle each top-level key that changed, once, then make sure it has
+        really hit the disk.
+        """
+        for key in ('groups', 'group_times', 'pair_history'):
+            if key in keys or '*' in keys:
+                self.db[key] = self.members.to_dict() if key == 'groups' else self.data[key]
+
+        jobs = self.data['trigger_jobs']
+        if 'trigger_jobs' in keys or '*' in keys:
+            # Everything, including whatever's left over from when all the
+            # jobs lived under the one key
+            groups = set(jobs)
+            groups.update(k[len(self.JOB_PREFIX):] for k in self.db.keys() if k.startswith(self.JOB_PREFIX))
+            if 'trigger_jobs' in self.db:
+                del self.db['trigger_jobs']
+        else:
+            groups = [k[len(self.JOB_PREFIX):] for k in keys if k.startswith(self.JOB_PREFIX)]
+        for group in groups:
+            if group in jobs:
+                self.db[self.JOB_PREFIX + group] = jobs[group]
+            elif self.JOB_PREFIX + group in self.db:
+                del self.db[self.JOB_PREFIX + group]
+        self.db.sync()
+
+        # Depending on the dbm flavor, our shelve may be spread over a few files
+        fsync_files(self.path)
+
+    def frozen(self):
+        """
+        A consistent copy of everything, as `(members, data)`.  We only hold
+        the lock for long enough to snapshot the `MembershipIndex` and pickle
+        the rest, which is quick, so writers barely notice.
+        """
+        import pickle
+
+        with self.lock:
+            members = self.members.snapshot()
+            data = {k: self.data[k] for k in self.KEYS if k != 'groups'}
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        return members, pickle.loads(data)
+
+    @classmethod
+    def write_shelve(cls, path, members, data):
+        """
+        Write `members` and `data` out to a brand new shelve at `path`, laid
+        out just like ours.
+        """
+        out = shelve.open(path, 'n')
+        try:
+            out['groups'] = members.to_dict()
+            out['group_times'] = data['group_times']
+            out['pair_history'] = data['pair_history']
+            for group, job in data['trigger_jobs'].items():
+                out[cls.JOB_PREFIX + group] = job
+        finally:
+            out.close()
+        fsync_files(path)
+
+    @instrumented('brayerpot_db_seconds')
+    def snapshot(self, path):
+        """
+        Write a point-in-time copy of the database to a new shelve at `path`.
+        Only taking the copy holds anybody up; writing it out doesn't.
+        """
+        members, data = self.frozen()
+        self.write_shelve(path, members, data)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def compact(self):
+        """
+        Get back the space that rewriting keys leaves behind in the shelve.
+        gdbm can do that in place; anything else gets written out afresh next
+        door, then moved over the top of the old one.  Writers have to wait
+        until we're done, but everything's in memory, so readers don't.
+        """
+        import dbm
+        from glob import escape, glob
+
+        self.commit()
+        if dbm.whichdb(self.path) == 'dbm.gnu':
+            self.db.dict.reorganize()
+            self.db.sync()
+            fsync_files(self.path)
+            return
+
+        fresh = self.path + '.compact'
+        self.write_shelve(fresh, self.members, self.data)
         self.db.close()
+        for path in glob(escape(fresh) + '*'):
+            os.replace(path, self.path + path[len(fresh):])
+        self.db = self.data.shelf = shelve.open(self.path)
 
+    def export_records(self):
+        """
+        Yield everything in the database as one dict per group and kind of
+        thing, the way `write_records()` wants them.
+        """
+        members, data = self.frozen()
+        for group in members.group_list():
+            yield {'kind': 'group', 'group': group, 'members': members.members_of(group)}
+
+            t = data['group_times'].get(group)
+            if t is not None:
+                yield {
+                    'kind': 'schedule',
+                    'group': group,
+                    'trigger_weeks': t['trigger_weeks'],
+                    'trigger_day': t['trigger_day'],
+                    'trigger_hour': t['trigger_hour'],
+                    'last_trigger': t['last_trigger'].isoformat(),
+                }
+
+            history = data['pair_history'].get(group)
+            if history:
+                pairs = [[a, b, week] for (a, b), week in history.items()]
+                yield {'kind': 'pair_history', 'group': group, 'pairs': pairs}
+
+            job = data['trigger_jobs'].get(group)
+            if job is not None:
+                yield {
+                    'kind': 'trigger_job',
+                    'group': group,
+                    'week': job['week'],
+                    'pairings': job['pairings'],
+                    'states': job['states'],
+                }
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def import_records(self, records):
+        """
+        Load `records` (as made by `export_records()`) into the database, all
+        in the one commit.  Meant for an empty database; anything already here
+        for the same group gets overwritten.
+        """
+        imported = set()
+        with self.transaction():
+            for record in records:
+                kind, group = record['kind'], record['group']
+                if kind == 'group':
+                    self.members.add_all(record['members'], group)
+                elif kind == 'schedule':
+                    self.data['group_times'][group] = {
+                        'trigger_weeks': record['trigger_weeks'],
+                        'trigger_day': record['trigger_day'],
+                        'trigger_hour': record['trigger_hour'],
+                        'last_trigger': datetime.datetime.fromisoformat(record['last_trigger']),
+                    }
+                elif kind == 'pair_history':
+                    self.data['pair_history'][group] = {(a, b): week for a, b, week in record['pairs']}
+                elif kind == 'trigger_job':
+                    self.data['trigger_jobs'][group] = {
+                        'week': record['week'],
+                        'pairings': record['pairings'],
+                        'states': record['states'],
+                        'claims': {},
+                    }
+                else:
+                    raise ValueError("Don't know what to do with a %r record"%(kind))
+                imported.add(group)
+            self.mutated(*self.KEYS)
+
+        for group in imported:
+            self.schedule_changed(group)
+        return len(imported)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
     def add_user_to_group(self, user, group):
         """
         Add a user to a group, returning the group afterward
         """
         group = group.lower()
-        if not group in self.db['groups']:
-            gs = self.db['groups']
-            gs[group] = [user]
-            self.db['groups'] = gs
-
-            # By default, trigger this group on Wednesday nights at 11pm every week
-            self.set_group_time(group, 1, day_to_int('Wednesday'), 23)
-        else:
-            if not user in self.db['groups'][group]:
-                gs = self.db['groups']
-                gs[group] += [user]
-                self.db['groups'] = gs
-        return self.db['groups'][group]
-
+        with self.transaction():
+            if not self.members.has_group(group):
+                self.members.add(user, group)
+                self.mutated('groups')
+
+                # By default, trigger this group on Wednesday nights at 11pm every week
+                self.set_group_time(group, 1, day_to_int('Wednesday'), 23)
+            elif self.members.add(user, group):
+                self.mutated('groups')
+        return self.members.members_of(group)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
     def remove_user_from_group(self, user, group):
         """
         Remove a user from a group, returning the group afterward. If the group
@@ -149,132 +1618,958 @@ class DataBase:
         group completely.
         """
         group = group.lower()
-        if not group in self.db:
+        if not self.members.has_group(group):
             return []
-        
-        if not user in self.db['groups'][group]:
-            return self.db['groups'][group]
-        
-        d = self.db['groups'][group]
-        d.remove(user)
-
-        # If that group is empty now, delete it
-        if not d:
-            gs = self.db['groups']
-            del gs[group]
-            self.db['groups'] = gs
 
-            gt = self.db['group_times']
-            del gt[group]
-            self.db['group_times'] = gt
+        if not self.members.remove(user, group):
+            return self.members.members_of(group)
 
+        # If that group is empty now, delete it
+        if not self.members.size(group):
+            self.members.drop_group(group)
+            self.data['group_times'].pop(group, None)
+            self.data['pair_history'].pop(group, None)
+            self.data['trigger_jobs'].pop(group, None)
+            self.mutated(*self.KEYS)
+
+            self.schedule_changed(group)
             return []
 
-        gs = self.db['groups']
-        gs[group] = d
-        self.db['groups'] = gs
-        return d
-
-    def remove_user_from_all_groups(self, user):
-        """
-        Remove a user from all groups
-        """
-        for group in self.db:
-            self.remove_user_from_group(user, group)
+        self.mutated('groups')
+        return self.members.members_of(group)
 
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
     def set_group_time(self, group, trigger_weeks, trigger_day, trigger_hour):
         """
         Set the time that chats get triggered, by passing in a trigger day
         (such that 0 == monday, 6 == sunday) and a trigger hour (15 == 3pm)
         """
         group = group.lower()
-        if group in self.db['groups']:
-            gt = self.db['group_times']
-            gt[group] = {
+        if self.members.has_group(group):
+            self.data['group_times'][group] = {
                 'trigger_weeks': trigger_weeks,
                 'trigger_day': trigger_day,
                 'trigger_hour': trigger_hour,
                 'last_trigger': get_now(),
             }
-            self.db['group_times'] = gt
+            self.mutated('group_times')
+            self.schedule_changed(group)
 
             logging.info("Set group %s to trigger on %s at %02d:00",
                          group, int_to_day(trigger_day), trigger_hour)
         else:
             logging.warn("Group %s doesn't exist, can't set time!", group)
 
-    def get_group_trigger_info(self, group):
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_group_times(self, group):
+        """
+        Return the stored trigger info for a group, or `None`.
+        """
+        tinfo = self.data['group_times'].get(group.lower())
+        if tinfo is not None:
+            return dict(tinfo)
+        return None
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def set_group_triggered(self, group):
         group = group.lower()
-        if group in self.db['group_times']:
-            tinfo = self.db['group_times'][group]
-            weeks = tinfo['trigger_weeks']
-            day = int_to_day(tinfo['trigger_day'])
-            hour = tinfo['trigger_hour']
-            return day, hour, weeks
+        if group in self.data['group_times']:
+            self.data['group_times'][group]['last_trigger'] = get_now()
+            self.mutated('group_times')
+            self.schedule_changed(group)
+        else:
+            logging.warn("Group %s doesn't exist, can't set triggered!", group)
 
-    def get_group_trigger_date(self, group):
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_pair_history(self, group):
         """
-        Return the next trigger date for a group
+        Return a dict mapping each `pair_key()` in `group` to the week that pair
+        last met.
         """
-        from datetime import timedelta
-        import pytz
+        return dict(self.data['pair_history'].get(group.lower(), {}))
 
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def record_pairings(self, group, user_groupings, week):
+        """
+        Remember that everybody within each of `user_groupings` met on `week`,
+        forgetting anything too old for `plan_pairings()` to care about.
+        """
+        group = group.lower()
+        history = self.data['pair_history'].get(group, {})
+        for key in grouping_pair_keys(user_groupings):
+            history[key] = week
+        self.data['pair_history'][group] = {
+            k: w for k, w in history.items() if week - w < PAIRING_AVOID_WEEKS
+        }
+        self.mutated('pair_history')
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def create_trigger_job(self, group, week, user_groupings):
+        """
+        Remember that we're about to create chats for `user_groupings` in
+        `group`, so that we can pick up where we left off if we die halfway.
+        """
         group = group.lower()
-        if group in self.db['group_times']:
-            t = self.db['group_times'][group]
+        self.data['trigger_jobs'][group] = {
+            'week': week,
+            'pairings': [list(g) for g in user_groupings],
+            'states': ['pending']*len(user_groupings),
+            'claims': {},
+        }
+        self.mutated(self.JOB_PREFIX + group)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_trigger_job(self, group):
+        """
+        Return the unfinished trigger job for `group` as a dict with the `week`
+        it was planned for, its `pairings` and each one's `state` (`pending`,
+        `done` or `failed`), or `None` if there isn't one.
+        """
+        job = self.data['trigger_jobs'].get(group.lower())
+        if job is None:
+            return None
+        return {
+            'week': job['week'],
+            'pairings': [list(g) for g in job['pairings']],
+            'states': list(job['states']),
+        }
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def list_trigger_jobs(self):
+        return list(self.data['trigger_jobs'])
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def claim_pairings(self, group, worker, limit, lease):
+        """
+        Claim up to `limit` pending pairings of `group`'s trigger job for
+        `worker` for the next `lease` seconds, returning `(index, users)` for
+        each one.  Pairings claimed by somebody else whose lease hasn't run
+        out yet are left alone.
+        """
+        from time import time
 
-            # Start from the last trigger point, converting to PST
-            dt = t['last_trigger'].astimezone(pytz.timezone('US/Pacific'))
+        job = self.data['trigger_jobs'].get(group.lower())
+        if job is None:
+            return []
 
-            # Go to the next week's day that we care about
-            skip_days = 7*t['trigger_weeks']
-            dt += timedelta(days=(t['trigger_day'] - dt.weekday()+skip_days)%skip_days)
+        now = time()
+        claimed = []
+        for idx, state in enumerate(job['states']):
+            if len(claimed) >= limit:
+                break
+            claim = job['claims'].get(idx)
+            if state == 'pending' and (claim is None or claim[1] < now):
+                job['claims'][idx] = (worker, now + lease)
+                claimed.append((idx, list(job['pairings'][idx])))
+        if claimed:
+            self.mutated(self.JOB_PREFIX + group.lower())
+        return claimed
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def set_pairing_state(self, group, idx, state):
+        job = self.data['trigger_jobs'].get(group.lower())
+        if job is not None:
+            job['states'][idx] = state
+            job['claims'].pop(idx, None)
+            self.mutated(self.JOB_PREFIX + group.lower())
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def release_claims(self, worker):
+        """
+        Let go of every pairing `worker` has claimed but not finished, so that
+        whoever comes next can have them straight away.  Returns how many.
+        """
+        released = 0
+        for group, job in self.data['trigger_jobs'].items():
+            mine = [idx for idx, claim in job['claims'].items() if claim[0] == worker]
+            for idx in mine:
+                del job['claims'][idx]
+            if mine:
+                self.mutated(self.JOB_PREFIX + group)
+                released += len(mine)
+        return released
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def claim_holders(self):
+        return set(claim[0] for job in self.data['trigger_jobs'].values() for claim in job['claims'].values())
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def finish_trigger_job(self, group):
+        if self.data['trigger_jobs'].pop(group.lower(), None) is not None:
+            self.mutated(self.JOB_PREFIX + group.lower())
+
+class SQLiteDataBase(BaseDataBase):
+    """
+    Same interface as `DataBase`, but backed by SQLite tables instead of a
+    couple of giant pickled dicts, so that adding or removing somebody only
+    touches their own row.  Who's in what gets answered from an in-memory
+    `MembershipIndex`, which we reload whenever another process (e.g. a
+    second replica) has changed the database.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS groups (
+            name TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS memberships (
+            grp TEXT NOT NULL REFERENCES groups(name) ON DELETE CASCADE,
+            user TEXT NOT NULL,
+            UNIQUE (grp, user)
+        );
+        CREATE INDEX IF NOT EXISTS memberships_user ON memberships(user);
+        CREATE TABLE IF NOT EXISTS schedules (
+            grp TEXT PRIMARY KEY REFERENCES groups(name) ON DELETE CASCADE,
+            trigger_weeks INTEGER NOT NULL,
+            trigger_day INTEGER NOT NULL,
+            trigger_hour INTEGER NOT NULL,
+            last_trigger TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pair_history (
+            grp TEXT NOT NULL REFERENCES groups(name) ON DELETE CASCADE,
+            user_a TEXT NOT NULL,
+            user_b TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            PRIMARY KEY (grp, user_a, user_b)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS trigger_jobs (
+            grp TEXT PRIMARY KEY REFERENCES groups(name) ON DELETE CASCADE,
+            week INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS trigger_pairings (
+            grp TEXT NOT NULL REFERENCES trigger_jobs(grp) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            users TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            claimed_by TEXT,
+            claimed_until REAL,
+            PRIMARY KEY (grp, idx)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
 
-            # Set the hour and seconds and whatnot appropriately
-            dt = dt.replace(hour=t['trigger_hour'], minute=0, second=0, microsecond=0)
+    def __init__(self, path, flush_interval=0, readonly=False):
+        super().__init__(flush_interval)
+        self.path = path
+        self.readonly = readonly
+        self.conn = self.connect()
+        if not readonly:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA foreign_keys=ON")
+            with self.conn:
+                self.conn.executescript(self.SCHEMA)
+
+        self.load_members()
+        logging.info("Loaded %s: %s", path, self.summary())
+
+    def connect(self):
+        """
+        A new connection to our database, read-only if we are.
+        """
+        if self.readonly:
+            from urllib.request import pathname2url
+            return sqlite3.connect("file:%s?mode=ro"%(pathname2url(self.path)), uri=True,
+                                   check_same_thread=False)
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        logging.info("Gracefully closing database...")
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+    def write(self, keys):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.dirty = set()
+        self.load_members()
+
+    @instrumented('brayerpot_db_seconds')
+    def snapshot(self, path):
+        """
+        Write a point-in-time copy of the database to a new file at `path`,
+        compacted as it goes.  That happens in a read transaction on a
+        connection of its own, so with WAL nobody has to wait for it.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("VACUUM INTO ?", (path,))
+        finally:
+            conn.close()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def compact(self):
+        """
+        Rebuild the database without its free pages, then fold the WAL back in
+        and truncate it.  Other writers wait until we're done; readers don't.
+        """
+        self.commit()
+        self.conn.execute("VACUUM")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def export_records(self):
+        """
+        Yield everything in the database as one dict per group and kind of
+        thing, the way `write_records()` wants them.  It all comes out of a
+        single read transaction on a connection of its own, so it's
+        consistent without getting in anybody's way, and only ever holds one
+        group's worth of rows at a time.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            groups = conn.execute("SELECT name FROM groups ORDER BY name")
+            for (group,) in groups:
+                members = conn.execute("SELECT user FROM memberships WHERE grp = ? ORDER BY rowid", (group,))
+                yield {'kind': 'group', 'group': group, 'members': [user for (user,) in members]}
+
+                row = conn.execute(
+                    "SELECT trigger_weeks, trigger_day, trigger_hour, last_trigger "
+                    "FROM schedules WHERE grp = ?", (group,)
+                ).fetchone()
+                if row is not None:
+                    yield {
+                        'kind': 'schedule',
+                        'group': group,
+                        'trigger_weeks': row[0],
+                        'trigger_day': row[1],
+                        'trigger_hour': row[2],
+                        'last_trigger': row[3],
+                    }
+
+                pairs = conn.execute("SELECT user_a, user_b, week FROM pair_history WHERE grp = ?", (group,))
+                pairs = [list(pair) for pair in pairs]
+                if pairs:
+                    yield {'kind': 'pair_history', 'group': group, 'pairs': pairs}
+
+                row = conn.execute("SELECT week FROM trigger_jobs WHERE grp = ?", (group,)).fetchone()
+                if row is not None:
+                    rows = conn.execute(
+                        "SELECT users, state FROM trigger_pairings WHERE grp = ? ORDER BY idx", (group,)
+                    ).fetchall()
+                    yield {
+                        'kind': 'trigger_job',
+                        'group': group,
+                        'week': row[0],
+                        'pairings': [users.split(",") for users, _ in rows],
+                        'states': [state for _, state in rows],
+                    }
+        finally:
+            conn.close()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def import_records(self, records):
+        """
+        Load `records` (as made by `export_records()`) into the database, in a
+        single transaction, a group at a time.  Meant for an empty database;
+        anything already here for the same group gets overwritten.
+        """
+        imported = set()
+        with self.transaction():
+            for record in records:
+                kind, group = record['kind'], record['group']
+                if kind == 'group':
+                    self.conn.execute("INSERT OR IGNORE INTO groups (name) VALUES (?)", (group,))
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO memberships (grp, user) VALUES (?, ?)",
+                        [(group, user) for user in record['members']],
+                    )
+                elif kind == 'schedule':
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO schedules VALUES (?, ?, ?, ?, ?)",
+                        (group, record['trigger_weeks'], record['trigger_day'], record['trigger_hour'],
+                         record['last_trigger']),
+                    )
+                elif kind == 'pair_history':
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO pair_history VALUES (?, ?, ?, ?)",
+                        [(group, a, b, week) for a, b, week in record['pairs']],
+                    )
+                elif kind == 'trigger_job':
+                    self.conn.execute("INSERT OR REPLACE INTO trigger_jobs VALUES (?, ?)", (group, record['week']))
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO trigger_pairings (grp, idx, users, state) VALUES (?, ?, ?, ?)",
+                        [(group, idx, ",".join(users), state)
+                         for idx, (users, state) in enumerate(zip(record['pairings'], record['states']))],
+                    )
+                else:
+                    raise ValueError("Don't know what to do with a %r record"%(kind))
+                imported.add(group)
+            self.mutated()
+        self.commit()
+        self.load_members()
+
+        for group in imported:
+            self.schedule_changed(group)
+        return len(imported)
+
+    @synchronized
+    def load_members(self):
+        members = MembershipIndex()
+        for (group,) in self.conn.execute("SELECT name FROM groups").fetchall():
+            rows = self.conn.execute("SELECT user FROM memberships WHERE grp = ? ORDER BY rowid", (group,))
+            members.add_all((user for (user,) in rows), group)
+        self.members = members
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @synchronized
+    def membership(self):
+        """
+        Our `MembershipIndex`, reloaded first if some other connection has
+        committed changes since we last looked.
+        """
+        if self.conn.execute("PRAGMA data_version").fetchone()[0] != self.data_version:
+            self.load_members()
+        return self.members
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM groups LIMIT 1").fetchone() is None
+
+    @synchronized
+    def get_meta(self, key):
+        """
+        Things we want to remember about the database itself, rather than
+        what's in it, like whether we've already brought an old shelve along.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    @synchronized
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self.mutated()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def group_exists(self, group):
+        return self.membership().has_group(group)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def add_user_to_group(self, user, group):
+        """
+        Add a user to a group, returning the group afterward
+        """
+        group = group.lower()
+        members = self.membership()
+        with self.transaction():
+            if not members.has_group(group):
+                self.conn.execute("INSERT INTO groups (name) VALUES (?)", (group,))
+                self.conn.execute("INSERT INTO memberships (grp, user) VALUES (?, ?)", (group, user))
+                members.add(user, group)
+                self.mutated()
+
+                # By default, trigger this group on Wednesday nights at 11pm every week
+                self.set_group_time(group, 1, day_to_int('Wednesday'), 23)
+            elif not members.contains(user, group):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO memberships (grp, user) VALUES (?, ?)",
+                    (group, user),
+                )
+                members.add(user, group)
+                self.mutated()
+        return members.members_of(group)
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def remove_user_from_group(self, user, group):
+        """
+        Remove a user from a group, returning the group afterward. If the group
+        did not exist, or the user was the last one in that group, delete the
+        group completely.
+        """
+        group = group.lower()
+        members = self.membership()
+        if not members.has_group(group):
+            return []
+        if not members.contains(user, group):
+            return members.members_of(group)
 
-            # Return that
-            return dt
+        with self.transaction():
+            self.conn.execute("DELETE FROM memberships WHERE grp = ? AND user = ?", (group, user))
+            members.remove(user, group)
+            d = members.members_of(group)
+
+            # If that group is empty now, delete it (and its schedule along with it)
+            if not d:
+                self.conn.execute("DELETE FROM groups WHERE name = ?", (group,))
+                members.drop_group(group)
+            self.mutated()
+
+        if not d:
+            self.schedule_changed(group)
+        return d
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def set_group_time(self, group, trigger_weeks, trigger_day, trigger_hour):
+        """
+        Set the time that chats get triggered, by passing in a trigger day
+        (such that 0 == monday, 6 == sunday) and a trigger hour (15 == 3pm)
+        """
+        group = group.lower()
+        if self.group_exists(group):
+            self.conn.execute(
+                "INSERT OR REPLACE INTO schedules VALUES (?, ?, ?, ?, ?)",
+                (group, trigger_weeks, trigger_day, trigger_hour, get_now().isoformat()),
+            )
+            self.mutated()
+            self.schedule_changed(group)
+
+            logging.info("Set group %s to trigger on %s at %02d:00",
+                         group, int_to_day(trigger_day), trigger_hour)
         else:
-            logging.warn("Group %s doesn't exist, can't get trigger date!", group)
+            logging.warn("Group %s doesn't exist, can't set time!", group)
 
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_group_times(self, group):
+        """
+        Return the stored trigger info for a group in the same shape as the
+        `group_times` entries of the shelve `DataBase`, or `None`.
+        """
+        row = self.conn.execute(
+            "SELECT trigger_weeks, trigger_day, trigger_hour, last_trigger "
+            "FROM schedules WHERE grp = ?", (group.lower(),)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'trigger_weeks': row[0],
+            'trigger_day': row[1],
+            'trigger_hour': row[2],
+            'last_trigger': datetime.datetime.fromisoformat(row[3]),
+        }
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
     def set_group_triggered(self, group):
         group = group.lower()
-        if group in self.db['group_times']:
-            gt = self.db['group_times']
-            gt[group]['last_trigger'] = get_now()
-            self.db['group_times'] = gt
+        updated = self.conn.execute(
+            "UPDATE schedules SET last_trigger = ? WHERE grp = ?",
+            (get_now().isoformat(), group),
+        ).rowcount
+        if updated:
+            self.mutated()
+            self.schedule_changed(group)
         else:
             logging.warn("Group %s doesn't exist, can't set triggered!", group)
 
-    def list_groups(self, user):
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_pair_history(self, group):
         """
-        List groups for a user
+        Return a dict mapping each `pair_key()` in `group` to the week that pair
+        last met.
         """
-        return [group for group in self.db if user in self.db['groups'][group]]
+        rows = self.conn.execute(
+            "SELECT user_a, user_b, week FROM pair_history WHERE grp = ?", (group.lower(),)
+        )
+        return {(a, b): week for a, b, week in rows}
 
-    def list_all_groups(self):
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def record_pairings(self, group, user_groupings, week):
         """
-        List all groups
+        Remember that everybody within each of `user_groupings` met on `week`,
+        forgetting anything too old for `plan_pairings()` to care about.
         """
-        return [group for group in self.db['groups']]
+        group = group.lower()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO pair_history VALUES (?, ?, ?, ?)",
+            [(group, a, b, week) for a, b in grouping_pair_keys(user_groupings)],
+        )
+        self.conn.execute(
+            "DELETE FROM pair_history WHERE grp = ? AND week <= ?",
+            (group, week - PAIRING_AVOID_WEEKS),
+        )
+        self.mutated()
 
-    def get_group(self, group):
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def create_trigger_job(self, group, week, user_groupings):
         """
-        Given a group ID, return the group.  Duh.
+        Remember that we're about to create chats for `user_groupings` in
+        `group`, so that we can pick up where we left off if we die halfway.
         """
         group = group.lower()
-        return self.db['groups'][group]
+        with self.transaction():
+            self.conn.execute("DELETE FROM trigger_jobs WHERE grp = ?", (group,))
+            self.conn.execute("INSERT INTO trigger_jobs VALUES (?, ?)", (group, week))
+            self.conn.executemany(
+                "INSERT INTO trigger_pairings (grp, idx, users) VALUES (?, ?, ?)",
+                [(group, idx, ",".join(g)) for idx, g in enumerate(user_groupings)],
+            )
+            self.mutated()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def get_trigger_job(self, group):
+        """
+        Return the unfinished trigger job for `group` as a dict with the `week`
+        it was planned for, its `pairings` and each one's `state` (`pending`,
+        `done` or `failed`), or `None` if there isn't one.
+        """
+        group = group.lower()
+        row = self.conn.execute("SELECT week FROM trigger_jobs WHERE grp = ?", (group,)).fetchone()
+        if row is None:
+            return None
+        rows = self.conn.execute(
+            "SELECT users, state FROM trigger_pairings WHERE grp = ? ORDER BY idx", (group,)
+        ).fetchall()
+        return {
+            'week': row[0],
+            'pairings': [users.split(",") for users, _ in rows],
+            'states': [state for _, state in rows],
+        }
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def list_trigger_jobs(self):
+        return [row[0] for row in self.conn.execute("SELECT grp FROM trigger_jobs")]
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def claim_pairings(self, group, worker, limit, lease):
+        """
+        Claim up to `limit` pending pairings of `group`'s trigger job for
+        `worker` for the next `lease` seconds, returning `(index, users)` for
+        each one.  Pairings claimed by somebody else whose lease hasn't run
+        out yet are left alone.  Several processes can share a job this way,
+        so claims get committed right away.
+        """
+        from time import time
+
+        group = group.lower()
+        now = time()
+        claimed = []
+        with self.transaction():
+            rows = self.conn.execute(
+                "SELECT idx, users FROM trigger_pairings WHERE grp = ? AND state = 'pending' "
+                "AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY idx LIMIT ?",
+                (group, now, limit),
+            ).fetchall()
+
+            # Somebody else may have snuck in since we looked, so only take
+            # the ones that are still up for grabs
+            for idx, users in rows:
+                updated = self.conn.execute(
+                    "UPDATE trigger_pairings SET claimed_by = ?, claimed_until = ? "
+                    "WHERE grp = ? AND idx = ? AND state = 'pending' "
+                    "AND (claimed_until IS NULL OR claimed_until < ?)",
+                    (worker, now + lease, group, idx, now),
+                ).rowcount
+                if updated:
+                    claimed.append((idx, users.split(",")))
+            self.mutated()
+            self.commit()
+        return claimed
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def set_pairing_state(self, group, idx, state):
+        self.conn.execute(
+            "UPDATE trigger_pairings SET state = ?, claimed_by = NULL, claimed_until = NULL "
+            "WHERE grp = ? AND idx = ?", (state, group.lower(), idx),
+        )
+        self.mutated()
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def release_claims(self, worker):
+        """
+        Let go of every pairing `worker` has claimed but not finished, so that
+        whoever comes next can have them straight away.  Returns how many.
+        """
+        with self.transaction():
+            released = self.conn.execute(
+                "UPDATE trigger_pairings SET claimed_by = NULL, claimed_until = NULL "
+                "WHERE claimed_by = ? AND state = 'pending'", (worker,),
+            ).rowcount
+            self.mutated()
+        return released
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def claim_holders(self):
+        return set(row[0] for row in self.conn.execute(
+            "SELECT DISTINCT claimed_by FROM trigger_pairings WHERE claimed_by IS NOT NULL"))
+
+    @instrumented('brayerpot_db_seconds')
+    @synchronized
+    def finish_trigger_job(self, group):
+        self.conn.execute("DELETE FROM trigger_jobs WHERE grp = ?", (group.lower(),))
+        self.mutated()
+
+    def import_shelve(self, shelve_db):
+        """
+        Copy everything out of a shelve `DataBase` into this one, in a single
+        transaction.
+        """
+        logging.info("Migrating shelve data into SQLite...")
+        with self.transaction():
+            # This goes in with the import itself, so it's both or neither
+            self.set_meta('shelve_migrated', get_now().isoformat())
+            num_groups = self.import_records(shelve_db.export_records())
+        logging.info("Migrated %d prayer groups", num_groups)
+
+class TriggerScheduler:
+    """
+    Keeps a heap of the next time each group should trigger, so that checking
+    whether anything is due is a peek at the top of the heap rather than a
+    walk over every group.  Deadlines get recomputed only when the database
+    tells us a group's schedule changed.
+
+    Stale heap entries (for groups that have since been rescheduled or
+    deleted) are left in place and skipped when they bubble up to the top.
+
+    One scheduler serves every tenant, so groups are keyed by `(tenant name,
+    group)`.
+    """
+    # If a due group doesn't get marked as triggered (e.g. it's too lonely),
+    # wait this many seconds before trying it again.
+    RETRY_DELAY = 60
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.lock = threading.RLock()
+
+        # Called whenever a deadline gets added, so a sleeping event loop can
+        # wake up and reconsider how long to sleep.
+        self.on_change = None
+
+    def attach(self, db, tenant):
+        """
+        Load deadlines for every group in `tenant`'s `db`, and keep them up to
+        date.  Whatever we had for `tenant` before, e.g. from a database it
+        has since reopened, gets forgotten.
+        """
+        with self.lock:
+            for key in [key for key in self.deadlines if key[0] == tenant.name]:
+                del self.deadlines[key]
+        for group in db.list_all_groups():
+            self.update(db, (tenant.name, group))
+        db.add_schedule_listener(lambda db, group: self.update(db, (tenant.name, group)))
+        logging.info("Scheduled %d prayer groups", len(self.deadlines))
+
+    def update(self, db, key):
+        group = key[1]
+        tinfo = db.get_group_times(group)
+        if tinfo is None:
+            self.unschedule(key)
+        elif db.get_trigger_job(group) is not None:
+            # We died partway through triggering this one; go finish it off
+            self.schedule(key, 0)
+        else:
+            self.schedule(key, next_trigger_date(tinfo).timestamp())
+
+    @synchronized
+    def unschedule(self, key):
+        self.deadlines.pop(key, None)
+
+    @synchronized
+    def schedule(self, key, deadline):
+        from heapq import heappush
+
+        self.deadlines[key] = deadline
+        heappush(self.heap, (deadline, key))
+        if self.on_change is not None:
+            self.on_change()
+
+    @synchronized
+    def next_deadline(self):
+        """
+        Return the earliest deadline we know of, or `None` if there are no
+        groups at all.
+        """
+        from heapq import heappop
+
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    @synchronized
+    def pop_due(self, now):
+        """
+        Return the `(tenant name, group)` of every group whose deadline is at
+        or before `now`.  Each of them gets provisionally pushed back by
+        `RETRY_DELAY`, which will be replaced by its real next deadline once
+        it's marked as triggered.
+        """
+        from heapq import heappop
+
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            key = heappop(self.heap)[1]
+            due.append(key)
+            self.schedule(key, now + self.RETRY_DELAY)
+        return due
+
+scheduler = TriggerScheduler()
+
+# Where we keep our data, and which engine we keep it in (`shelve` or
+# `sqlite`).  The `default` tenant lives right in `DB_DIR`, the same as
+# before we had tenants; everyone else gets a directory of their own in it.
+DB_DIR = os.environ.get('BRAYERPOT_DB_DIR', '/var/lib/brayerpot')
+DB_ENGINE = os.environ.get('BRAYERPOT_DB_ENGINE', 'shelve')
+DB_FLUSH_INTERVAL = float(os.environ.get('BRAYERPOT_DB_FLUSH_INTERVAL', 0))
+
+def tenant_db_dir(tenant):
+    if tenant.name == 'default':
+        return DB_DIR
+    return os.path.join(DB_DIR, tenant.name)
+
+def open_db(tenant, readonly=False):
+    """
+    Open `tenant`'s database.  A `readonly` one is for looking at while some
+    other process still has it open for writing (see `take_over()`), and is
+    `None` if there's nothing there to look at yet.
+    """
+    import dbm
+
+    db_dir = tenant_db_dir(tenant)
+    shelve_path = os.path.join(db_dir, "shelve.db")
+    if DB_ENGINE == 'sqlite':
+        sqlite_path = os.path.join(db_dir, "brayerpot.sqlite")
+        if readonly:
+            return SQLiteDataBase(sqlite_path, readonly=True) if os.path.exists(sqlite_path) else None
+
+        os.makedirs(db_dir, exist_ok=True)
+        db = SQLiteDataBase(sqlite_path, DB_FLUSH_INTERVAL)
+
+        # If we're starting fresh but there's an old shelve lying around,
+        # bring its contents along with us, but only ever the once: after
+        # everybody's left, an empty database doesn't mean we're new here.
+        # One that's in use but unmarked is from before we kept track, and
+        # has already been migrated (or started without a shelve).
+        if dbm.whichdb(shelve_path) and db.get_meta('shelve_migrated') is None:
+            if db.is_empty():
+                db.import_shelve(DataBase(shelve_path))
+            else:
+                db.set_meta('shelve_migrated', 'already in use')
+        return db
+
+    if readonly:
+        return DataBase(shelve_path, readonly=True) if dbm.whichdb(shelve_path) else None
+    os.makedirs(db_dir, exist_ok=True)
+    return DataBase(shelve_path, DB_FLUSH_INTERVAL)
 
-db = None
 def get_db():
-    global db
-    if db is None:
-        db = DataBase("/var/lib/brayerpot/shelve.db")
-    return db
+    """
+    Get the current tenant's database, opening it the first time around.
+    """
+    tenant = get_tenant()
+    if tenant.db is not None:
+        return tenant.db
+
+    with tenant.lock:
+        if tenant.db is None:
+            # Once we've let go of it, it's somebody else's
+            if stopping.is_set():
+                raise RuntimeError("Database for %s has been handed over"%(tenant.name))
+            db = open_db(tenant)
+            release_stale_claims(db)
+            scheduler.attach(db, tenant)
+            tenant.db = db
+    return tenant.db
+
+def close_db():
+    """
+    Commit and close the current tenant's database, if it's open.  The next
+    `get_db()` opens it again.
+    """
+    tenant = get_tenant()
+    with tenant.lock:
+        db, tenant.db = tenant.db, None
+    if db is not None:
+        db.close()
+
+# Bump this if `export_records()` ever changes shape
+EXPORT_VERSION = 1
+
+def open_records(path, mode):
+    import gzip
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def write_records(path, records):
+    """
+    Write `records` out to `path` a line of JSON at a time (gzipped, if
+    `path` ends in `.gz`), after a line saying what they are.  Nothing gets
+    held on to, so this works however big the database is.  Returns how many
+    records there were.
+    """
+    import json
+
+    count = 0
+    with open_records(path, 'w') as f:
+        f.write(json.dumps({'kind': 'brayerpot', 'version': EXPORT_VERSION}) + "\n")
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+def read_records(path):
+    """
+    Yield the records that `write_records()` put in `path`, one at a time.
+    """
+    import json
+
+    with open_records(path, 'r') as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('kind') != 'brayerpot':
+            raise ValueError("%s isn't a brayerpot export"%(path))
+        if header.get('version') != EXPORT_VERSION:
+            raise ValueError("%s is from version %s, but we only know version %d"%(
+                path, header.get('version'), EXPORT_VERSION))
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def snapshot_path(suffix):
+    """
+    A new file to keep a snapshot of the current tenant's database in, named
+    for when we took it.
+    """
+    snapshot_dir = os.path.join(tenant_db_dir(get_tenant()), 'snapshots')
+    os.makedirs(snapshot_dir, exist_ok=True)
+    return os.path.join(snapshot_dir, get_now().strftime('%Y%m%d-%H%M%S') + suffix)
 
 
-def handle_help(payload):
+def handle_help(payload, args):
     """
     Given a `@prayerbot help`, we will send them a direct message explaining
     our raison d'existence.  That one's for you, @yaup
@@ -306,17 +2601,21 @@ When you are a part of a prayer group, I will randomly pair participants of a gr
         as_user=True
     )
 
-def handle_secret_help(payload):
-    handle_help(payload)
+def handle_secret_help(payload, args):
+    handle_help(payload, args)
     help_msg = """
 Some secret commands:
 
-- `dump_groups`
+- `dump_groups [group ...] [page N] [file]`
 
 - `trigger_chats`
 
 - `set_time group day hour weeks`
 
+- `snapshot [export]`
+
+- `compact`
+
 - `secret_help`
     """
     slack_call(
@@ -328,15 +2627,12 @@ Some secret commands:
     )
 
 
-def handle_signup(payload):
+def handle_signup(payload, args):
     """
     Given a signup command, add the user to groups
     """
-    from re import split, IGNORECASE
-
     try:
-        splitted = split("signup", payload['text'], flags=IGNORECASE)
-        group = splitted[1].strip().split()[0]
+        group = args[0]
 
         group_list = get_db().add_user_to_group(payload['user'], group)
         msg = "Great, you've been added to the *%s* prayer group!"%(group)
@@ -354,16 +2650,14 @@ def handle_signup(payload):
         as_user=True
     )
 
-def handle_set_time(payload):
+def handle_set_time(payload, args):
     """
-    Given a signup command, add the user to groups
+    Given a set_time command, change when a group gets triggered
     """
-    from re import split, IGNORECASE
     db = get_db()
 
     try:
-        splitted = split("set_time", payload['text'], flags=IGNORECASE)
-        group, day, hour, weeks = splitted[1].strip().split()
+        group, day, hour, weeks = args
 
         try:
             day = int(day)
@@ -372,15 +2666,21 @@ def handle_set_time(payload):
         hour = int(hour)
         weeks = int(weeks)
 
-        db.set_group_time(group, weeks, day, hour)
+        # Check everything before storing any of it, since a day or hour that
+        # makes no sense would trip up everything that reads it back later
+        if not (0 <= day <= 6 and 0 <= hour <= 23 and weeks >= 1):
+            raise ValueError("Time out of range")
+
+        with db.transaction():
+            db.get_group(group)
+            db.set_group_time(group, weeks, day, hour)
+            next_date = db.get_group_trigger_date(group)
         msg = "Group *%s* will trigger on *%s* at *%d:00* every *%d* weeks"%(
             group, int_to_day(day), hour, weeks
         )
-        next_time = db.get_group_trigger_date(group).strftime("*%A*, *%B %d* at *%-I:%M* %p %Z")
+        next_time = next_date.strftime("*%A*, *%B %d* at *%-I:%M* %p %Z")
         msg += "\nNext scheduled trigger time: %s"%(next_time)
-    except IndexError:
-        msg = "You need to give me a group, day, hour and weeks. Look at `@prayerbot help`"
-    except AttributeError:
+    except (ValueError, KeyError, IndexError, AttributeError):
         msg = "You need to give me a group, day, hour and weeks. Look at `@prayerbot help`"
 
     slack_call(
@@ -391,38 +2691,19 @@ def handle_set_time(payload):
         as_user=True
     )
 
-def handle_sign(payload):
-    """
-    Check to see if someone said `sign up foo`, and make it "just work"
-    """
-    from re import split, IGNORECASE
-
-    splitted = split("sign up", payload['text'], flags=IGNORECASE)
-    if len(splitted) == 1:
-        # There was no `sign up` command at all
-        return handle_unknown(payload)
-
-    # Otherwise, just mash it up and call `handle_signup` again with our
-    # properly munged text
-    payload['text'] = 'signup ' + ' sign up '.join(splitted[1:])
-    return handle_signup(payload)
-
-
-
-def handle_stop(payload):
+def handle_stop(payload, args):
     """
     Given a stop command, remove the user from groups
     """
-    from re import split, IGNORECASE
     db = get_db()
     try:
-        splitted = split("stop", payload['text'], flags=IGNORECASE)
-        group = splitted[1].strip().split()[0]
+        group = args[0]
 
-        db.remove_user_from_group(payload['user'], group)
+        with db.transaction():
+            db.remove_user_from_group(payload['user'], group)
+            group_list = db.list_groups(payload['user'])
         msg = "You have been removed from the *%s* prayer group."%(group)
 
-        group_list = db.list_groups(payload['user'])
         if group_list:
             group_list_str = "*, *".join(group_list)
             msg += " You are still a part of the following prayer groups: *%s*"%(group_list_str)
@@ -438,101 +2719,568 @@ def handle_stop(payload):
         as_user=True
     )
 
-def handle_list(payload):
+def handle_list(payload, args):
+    """
+    Let the user figure out which prayer groups they are a part of.
+    """
+    group_list = get_db().list_groups(payload['user'])
+    if group_list:
+        group_list_str = "*, *".join(group_list)
+        msg = "You are a part of the following prayer groups: *%s*"%(group_list_str)
+    else:
+        msg = "You are not a part of any prayer groups. Use `@prayerbot signup` to join some, or try `@prayerbot help` to learn more!"
+
+    slack_call(
+        chat_type(payload),
+        channel=payload['channel'],
+        user=payload['user'],
+        text=msg,
+        as_user=True
+    )
+
+def handle_unknown(payload, args):
+    slack_call(
+        chat_type(payload),
+        channel=payload['channel'],
+        user=payload['user'],
+        text="Sorry, I don't what that means. Try `@prayerbot help`",
+        as_user=True
+    )
+
+def handle_secret_trigger_chats(payload, args):
+    name = get_user_first_name(payload['user'])
+    logging.info("RED ALERT! SHIELDS TO MAXIMUM! %s knows our secrets!", name)
+
+    trigger_in_background([g.lower() for g in args[:1]] or get_db().list_all_groups())
+
+# Slack starts folding messages up past about 4,000 characters (and cuts
+# them off entirely at 40,000), so each page of `dump_groups` stays under
+# `DUMP_PAGE_SIZE`, and we send at most `DUMP_MAX_PAGES` of them at once.
+DUMP_PAGE_SIZE = 3500
+DUMP_MAX_PAGES = 5
+
+def dump_lines(db, groups, members, names, limit=DUMP_PAGE_SIZE):
+    """
+    Yield a line per group listing its schedule and who's in it, splitting a
+    group over several lines if it won't fit in `limit` characters.  Groups
+    that have gone away since we took `members` get left out.
+    """
+    for g in groups:
+        info = db.get_group_trigger_info(g)
+        if info is None:
+            continue
+        day, hour, weeks = info
+        prefix = "*%s* on *%s* at *%d:00* every *%d* weeks: "%(g, day, hour, weeks)
+        chunk, size = [], len(prefix)
+        for user in members[g]:
+            name = "*%s*"%(names.get(user, user))
+            if chunk and size + len(name) + 2 > limit:
+                yield prefix + ", ".join(chunk)
+                prefix = "*%s* (continued): "%(g)
+                chunk, size = [], len(prefix)
+            chunk.append(name)
+            size += len(name) + 2
+        yield prefix + ", ".join(chunk)
+
+def paginate(lines, limit=DUMP_PAGE_SIZE):
+    """
+    Pack `lines` into pages of no more than `limit` characters each.
+    """
+    pages, page, size = [], [], 0
+    for line in lines:
+        if page and size + len(line) + 1 > limit:
+            pages.append("\n".join(page))
+            page, size = [], 0
+        page.append(line)
+        size += len(line) + 1
+    if page:
+        pages.append("\n".join(page))
+    return pages
+
+def handle_secret_dump_groups(payload, args):
+    """
+    List every group, its schedule and its members.  Takes any number of
+    group names to only list those, plus `page N` to get just the Nth page,
+    or `file` to get the whole thing as a file (in a DM) instead.
+    """
+    name = get_user_first_name(payload['user'])
+    logging.info("SET PHASERS TO 'WELL DONE'! %s knows our secrets!", name)
+
+    wanted, page, as_file = [], None, False
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.lower() == 'page' and args and args[0].isdigit():
+            page = int(args.pop(0))
+        elif arg.lower() == 'file':
+            as_file = True
+        else:
+            wanted.append(arg.lower())
+
+    db = get_db()
+    # Work from one snapshot, so nobody signing up halfway through muddles it
+    snapshot = db.snapshot_memberships()
+    groups = snapshot.group_list()
+    notes = []
+    if wanted:
+        unknown = [g for g in wanted if g not in groups]
+        if unknown:
+            notes.append("No such group(s): *%s*"%("*, *".join(unknown)))
+        groups = [g for g in wanted if g in groups]
+    members = {g: snapshot.members_of(g) for g in groups}
+
+    users, failed = get_users(u for g in groups for u in members[g])
+    names = {user: full_name(user_obj) for user, user_obj in users.items()}
+    if failed:
+        metrics.inc('brayerpot_dump_lookup_failures_total', len(failed))
+        notes.append("(I couldn't look up %d people, so they're listed by id)"%(len(failed)))
+    pages = paginate(dump_lines(db, groups, members, names)) or ["No groups to speak of"]
+
+    method = chat_type(payload)
+    def send(text):
+        slack_call(method, channel=payload['channel'], user=payload['user'], text=text, as_user=True)
+
+    if as_file:
+        if method != "chat.postMessage":
+            send("I'll only send the whole dump as a file in a DM")
+            return
+        slack_call(
+            'files.upload',
+            channels=payload['channel'],
+            content="\n".join(pages).replace("*", ""),
+            filename="groups.txt",
+            filetype="text",
+            title="Group memberships",
+        )
+    elif page is not None:
+        if page < 1 or page > len(pages):
+            send("There are only %d pages"%(len(pages)))
+            return
+        send("Group memberships (page %d of %d):\n%s"%(page, len(pages), pages[page - 1]))
+    else:
+        for idx, text in enumerate(pages[:DUMP_MAX_PAGES]):
+            send(("Group memberships:\n" if idx == 0 else "") + text)
+        if len(pages) > DUMP_MAX_PAGES:
+            notes.append("...and %d more pages. Ask for `dump_groups page %d` to see the next one, or `dump_groups file` in a DM for all of it"%(
+                len(pages) - DUMP_MAX_PAGES, DUMP_MAX_PAGES + 1))
+
+    if notes:
+        send("\n".join(notes))
+
+def handle_secret_snapshot(payload, args):
     """
-    Let the user figure out which prayer groups they are a part of.
+    Save a consistent copy of the database next to it, under `snapshots/`,
+    without holding anybody else up.  Pass `export` to get a gzipped JSON
+    lines export (see `write_records()`) rather than a copy of the files.
     """
-    group_list = db.list_groups(payload['user'])
-    if group_list:
-        group_list_str = "*, *".join(group_list)
-        msg = "You are a part of the following prayer groups: *%s*"%(group_list_str)
-    else:
-        msg = "You are not a part of any prayer groups. Use `@prayerbot signup` to join some, or try `@prayerbot help` to learn more!"
+    from time import perf_counter
 
-    slack_call(
-        chat_type(payload),
-        channel=payload['channel'],
-        user=payload['user'],
-        text=msg,
-        as_user=True
-    )
+    name = get_user_first_name(payload['user'])
+    logging.info("ENGAGE THE HOLODECK! %s knows our secrets!", name)
+
+    db = get_db()
+    start = perf_counter()
+    if [a.lower() for a in args[:1]] == ['export']:
+        path = snapshot_path('.jsonl.gz')
+        write_records(path, db.export_records())
+    else:
+        path = snapshot_path('.sqlite' if DB_ENGINE == 'sqlite' else '.db')
+        db.snapshot(path)
+    size = file_size(path)
+    logging.info("Saved a snapshot of %d bytes to %s", size, path)
 
-def handle_unknown(payload):
     slack_call(
         chat_type(payload),
         channel=payload['channel'],
         user=payload['user'],
-        text="Sorry, I don't what that means. Try `@prayerbot help`",
+        text="Saved `%s` (%.1f kB) in %.2fs"%(path, size/1000, perf_counter() - start),
         as_user=True
     )
 
-def handle_secret_trigger_chats(payload):
-    from re import split, IGNORECASE
-    name = get_user_first_name(payload['user'])
-    logging.info("RED ALERT! SHIELDS TO MAXIMUM! %s knows our secrets!", name)
-
-    try:
-        splitted = split("trigger_chats", payload['text'], flags=IGNORECASE)
-        group = splitted[1].strip().split()[0]
-
-        trigger_weekly_group_chats(group)
-    except:
-        trigger_weekly_group_chats()
+def handle_secret_compact(payload, args):
+    """
+    Give back the space the database has been leaving behind on disk.
+    """
+    from time import perf_counter
 
-def handle_secret_dump_groups(payload):
     name = get_user_first_name(payload['user'])
-    logging.info("SET PHASERS TO 'WELL DONE'! %s knows our secrets!", name)
+    logging.info("DUMP THE WARP CORE! %s knows our secrets!", name)
 
     db = get_db()
-    groups = db.list_all_groups()
-    listings = []
-    for g in groups:
-        names = [get_user_full_name(u) for u in db.get_group(g)]
-        names = "*%s*"%("*, *".join(names))
-        day, hour, weeks = db.get_group_trigger_info(g)
-        listings += ["*%s* on *%s* at *%d:00* every *%d* weeks: %s"%(g, day, hour, weeks, names)]
+    before = db.disk_usage()
+    start = perf_counter()
+    db.compact()
+    after = db.disk_usage()
+    logging.info("Compacted the database from %d to %d bytes", before, after)
 
     slack_call(
         chat_type(payload),
         channel=payload['channel'],
         user=payload['user'],
-        text="Group memberships:\n%s"%("\n".join(listings)),
+        text="Compacted the database from %.1f kB to %.1f kB in %.2fs"%(
+            before/1000, after/1000, perf_counter() - start),
         as_user=True
     )
 
+# Map from command name to behavior
+COMMANDS = {
+    'help': handle_help,
+    'signup': handle_signup,
+    'stop': handle_stop,
+    'list': handle_list,
+    'set_time': handle_set_time,
+
+    # Super secret commands
+    'trigger_chats': handle_secret_trigger_chats,
+    'dump_groups': handle_secret_dump_groups,
+    'snapshot': handle_secret_snapshot,
+    'compact': handle_secret_compact,
+    'secret_help': handle_secret_help,
+}
+
+# Other ways people spell commands; `sign up foo` should "just work"
+COMMAND_ALIASES = {
+    ('sign', 'up'): 'signup',
+}
+
+class CommandRouter:
+    """
+    Turns the text of a message into a command and its arguments.  Everything
+    that doesn't change from message to message (what a mention of us looks
+    like, the aliases) gets worked out once, up front, so that each message
+    costs a single pass over its text.
+    """
+    def __init__(self, bot_id, commands=COMMANDS, aliases=COMMAND_ALIASES):
+        self.bot_id = bot_id
+        self.mention = "<@%s>"%(bot_id)
+        self.commands = commands
+
+        # Aliases are keyed by their first word, so that most messages only
+        # need a single dict lookup to find out they don't use one
+        self.aliases = {}
+        for words, command in aliases.items():
+            self.aliases.setdefault(words[0], []).append((list(words[1:]), command))
+
+    def parse(self, text, direct=False):
+        """
+        Returns `(command, args)` if `text` is talking to us, or `None` if it
+        isn't.  Text that mentions us is talking to us, and the command is
+        whatever comes after the mention.  If `direct` is set (it was sent to
+        us in a DM) then the whole text is the command.
+        """
+        idx = text.find(self.mention)
+        if idx >= 0:
+            tokens = text[idx + len(self.mention):].split()
+        elif direct:
+            tokens = text.split()
+        else:
+            return None
+
+        # Only pay attention if there is a command
+        if not tokens:
+            return None
+
+        command = tokens[0].lower()
+        args = tokens[1:]
+        for rest, alias in self.aliases.get(command, ()):
+            if [a.lower() for a in args[:len(rest)]] == rest:
+                return alias, args[len(rest):]
+        return command, args
+
+    def route(self, payload):
+        """
+        Parse an RTM payload, only bothering to check whether it's a DM to us
+        if it doesn't mention us outright.
+        """
+        text = payload.get('text', '')
+        if not text:
+            return None
+
+        parsed = self.parse(text)
+        if parsed is None and payload.get('type', '') == 'message' and is_im_to_me(payload):
+            parsed = self.parse(text, direct=True)
+        return parsed
+
+def get_router():
+    """
+    Get the current tenant's command router, building it the first time
+    around (or if we've somehow changed who we are since).
+    """
+    tenant = get_tenant()
+    me = bot_id()
+    if tenant.router is None or tenant.router.bot_id != me:
+        tenant.router = CommandRouter(me)
+    return tenant.router
 
-def handle_command(command, payload):
+def handle_command(command, payload, args=()):
     """
     Given a command, fork off into different possible handlers.
     """
-    # First, make sure we're not responding to ourselves
-    if is_from_me(payload):
+    # First, make sure we're not responding to ourselves, or to a bot that
+    # isn't anybody (`bot_message`s come without a user)
+    if is_from_me(payload) or 'user' not in payload:
         return
 
     name = get_user_first_name(payload['user'])
     logging.info("Handling command %s from %s", command, name)
 
-    # Map from command name to behavior
-    commands = {
-        'help': handle_help,
-        'signup': handle_signup,
-        'sign': handle_sign,
-        'stop': handle_stop,
-        'list': handle_list,
-        'set_time': handle_set_time,
-
-        # Super secret commands
-        'trigger_chats': handle_secret_trigger_chats,
-        'dump_groups': handle_secret_dump_groups,
-        'secret_help': handle_secret_help,
-    }
+    handler = COMMANDS.get(command)
+    if handler is None:
+        handler, command = handle_unknown, 'unknown'
+    with metrics.timer('brayerpot_command_seconds', command=command):
+        handler(payload, args)
+
+# How many users each tenant keeps in its `UserCache`; this is most of what
+# a tenant costs us in memory.
+USER_CACHE_SIZE = int(os.environ.get('BRAYERPOT_USER_CACHE_SIZE', 2048))
+
+class UserCache:
+    """
+    A bounded cache of Slack user objects, so that we don't hit `users.info`
+    every time we want to know someone's name.  Entries expire after `ttl`
+    seconds, and once we hold more than `max_size` users, the least recently
+    used ones get kicked out.
+    """
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=6*60*60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    @synchronized
+    def get(self, user):
+        """
+        Return the cached user object for `user`, or `None` if we don't have a
+        fresh one.
+        """
+        from time import time
+
+        entry = self.entries.get(user)
+        if entry is None or time() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(user)
+        return entry[1]
+
+    @synchronized
+    def put(self, user_obj):
+        from time import time
+
+        self.entries[user_obj["id"]] = (time(), user_obj)
+        self.entries.move_to_end(user_obj["id"])
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @synchronized
+    def invalidate(self, user):
+        self.entries.pop(user, None)
+
+    @synchronized
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+class UserIndex:
+    """
+    Maps usernames to user ids for the whole workspace.  It gets built from a
+    full walk of `iter_users()` the first time somebody asks, after which
+    `update()` keeps it current as users join or change their names.  We only
+    walk the whole workspace again if someone asks for a name we don't know
+    and it's been more than `ttl` seconds since we last did.
+    """
+    def __init__(self, ttl=60*60):
+        self.ttl = ttl
+        self.ids = {}
+        self.names = {}
+        self.built = None
+        self.lock = threading.RLock()
+
+    @synchronized
+    def update(self, user_obj):
+        if 'name' not in user_obj:
+            return
+
+        # If they've renamed themselves, forget the old name
+        old_name = self.names.get(user_obj['id'])
+        if old_name is not None and self.ids.get(old_name) == user_obj['id']:
+            del self.ids[old_name]
+
+        name = user_obj['name'].lower()
+        self.ids[name] = user_obj['id']
+        self.names[user_obj['id']] = name
+
+    @synchronized
+    def rebuild(self, user_cache=None):
+        """
+        Walk the whole workspace again, dropping anyone in `user_cache` on the
+        way past if we're given one.
+        """
+        from time import time
+
+        self.ids, self.names = {}, {}
+        for user_obj in iter_users():
+            self.update(user_obj)
+            if user_cache is not None:
+                user_cache.put(user_obj)
+        self.built = time()
+        logging.info("Indexed %d users", len(self.ids))
+
+    @synchronized
+    def find(self, username):
+        from time import time
+
+        username = username.lower()
+        if username not in self.ids:
+            if self.built is None or time() - self.built > self.ttl:
+                self.rebuild()
+        return self.ids.get(username)
+
+    @synchronized
+    def stats(self):
+        return {'size': len(self.ids)}
+
+class Tenant:
+    """
+    Everything that belongs to one Slack workspace: how we talk to it, who we
+    are there, what we've cached about it and where its groups are kept.  The
+    tenant we're working for right now lives in `current_tenant`.
+    """
+    def __init__(self, name, token=None, transport=None):
+        self.name = name
+        self.token = token
+
+        # `client` is what we connect to RTM with, while `transport` is
+        # whatever `slack_call` sends Web API calls through: anything with an
+        # `api_call(method, **kwargs)` that returns the parsed response.
+        self.client = SlackClient(token) if transport is None else transport
+        if transport is None and SLACK_TRANSPORT == 'pooled':
+            transport = SlackTransport(token)
+        self.transport = transport or self.client
+
+        self.bot_id = None
+        self.bot_name = BOT_NAME
+        self.team_id = None
+        self.im_channels = None
+        self.router = None
+        self.buckets = {}
+        self.user_cache = UserCache()
+        self.user_index = UserIndex()
+        self.db = None
+        self.lock = threading.RLock()
+        self.lookup_lock = threading.Lock()
+
+    def __repr__(self):
+        return "Tenant(%s)"%(self.name)
+
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+tenants = OrderedDict()
+default_tenant = None
+
+def add_tenant(tenant):
+    global default_tenant
+    tenants[tenant.name] = tenant
+    if default_tenant is None or default_tenant.name == tenant.name:
+        default_tenant = tenant
+    return tenant
+
+def set_default_tenant(tenant):
+    """
+    Make `tenant` the one we work for whenever nobody says otherwise, e.g. to
+    point benchmarks at a fake Slack.
+    """
+    global default_tenant
+    tenants[tenant.name] = tenant
+    default_tenant = tenant
+
+def get_tenant():
+    """
+    The tenant we're working for right now, or the first (and usually only)
+    one if nobody has said.
+    """
+    tenant = current_tenant.get()
+    if tenant is None:
+        return default_tenant
+    return tenant
+
+@contextmanager
+def using_tenant(tenant):
+    token = current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_tenant.reset(token)
+
+def each_tenant():
+    """
+    Yield every tenant in turn, each of them current while it's its turn.
+    """
+    for tenant in list(tenants.values()):
+        with using_tenant(tenant):
+            yield tenant
 
-    handler = commands.get(command, handle_unknown)
-    handler(payload)
+def find_tenant(team_id):
+    """
+    Find the tenant for Slack team `team_id`, or `None` if it isn't one of
+    ours.  With just the one tenant, everything is for them.
+    """
+    if len(tenants) == 1:
+        return default_tenant
+    for tenant in tenants.values():
+        if tenant.team_id == team_id:
+            return tenant
+    return None
+
+def submit(pool, func, *args):
+    """
+    `pool.submit(func, *args)`, except that `func` runs in a copy of our
+    context, so it keeps working for the same tenant.
+    """
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+if SLACK_TENANTS:
+    for name, token in SLACK_TENANTS.items():
+        add_tenant(Tenant(name, token))
+else:
+    add_tenant(Tenant('default', SLACK_API_TOKEN))
+
+def get_user(user):
+    """
+    Return the user object for `user`, going through the current tenant's
+    `user_cache` so that repeat lookups never leave the process.
+    """
+    user_cache = get_tenant().user_cache
+    user_obj = user_cache.get(user)
+    if user_obj is None:
+        user_obj = slack_call("users.info", user=user)["user"]
+        user_cache.put(user_obj)
+    return user_obj
+
+def handle_user_event(payload):
+    """
+    Keep `user_cache` honest when Slack tells us a profile changed, or that
+    someone new showed up.  These events carry the full user object, so we
+    just store it rather than waiting for the next miss.
+    """
+    user_obj = payload.get('user')
+    if not isinstance(user_obj, dict) or 'id' not in user_obj:
+        return
+
+    tenant = get_tenant()
+    tenant.user_cache.invalidate(user_obj['id'])
+    tenant.user_cache.put(user_obj)
+    tenant.user_index.update(user_obj)
 
 def get_user_first_name(user):
-    user_obj = slack_call("users.info", user=user)["user"]
+    return first_name(get_user(user))
 
+def first_name(user_obj):
     # If they have filled out their profile to have a first name use that,
     # otherwise fall back on their username:
     if "profile" in user_obj and "first_name" in user_obj["profile"]:
@@ -540,12 +3288,67 @@ def get_user_first_name(user):
     else:
         return user_obj["name"]
 
+# Lookups for `get_users()` that `user_cache` can't answer run on here
+LOOKUP_WORKERS = int(os.environ.get('BRAYERPOT_LOOKUP_WORKERS', 4))
+lookup_pool = ThreadPoolExecutor(LOOKUP_WORKERS, thread_name_prefix='lookup')
+
+def get_users(users):
+    """
+    Look up a whole bunch of users at once.  Whoever `user_cache` doesn't
+    have gets fetched concurrently with `users.info`, or if there are more of
+    them than fit on a single `users.list` page, and they're a good chunk of
+    the workspace, by paging through everybody instead.  Returns the user
+    objects we found by id, and the set of ids we couldn't find.
+    """
+    from math import ceil
+
+    tenant = get_tenant()
+    user_cache = tenant.user_cache
+    found = {}
+    missing = set()
+    for user in set(users):
+        user_obj = user_cache.get(user)
+        if user_obj is None:
+            missing.add(user)
+        else:
+            found[user] = user_obj
+
+    # We don't know how big the workspace is unless we've indexed it, but
+    # it's at least everybody we've cached plus everybody we haven't, so a
+    # small fraction of that is a small fraction of the real thing.  In case
+    # it's a lot bigger, we stop paging once we've covered as many people as
+    # it'd take for the ones we're missing to be a big enough fraction.
+    workspace = max(len(tenant.user_index.ids), user_cache.stats()['size'] + len(missing))
+    if len(missing) > USERS_PAGE_SIZE and len(missing) >= USERS_WALK_FRACTION*workspace:
+        max_pages = ceil(len(missing)/(USERS_WALK_FRACTION*USERS_PAGE_SIZE))
+        try:
+            for user_obj in iter_users(max_pages=max_pages):
+                if user_obj.get('id') in missing:
+                    missing.remove(user_obj['id'])
+                    found[user_obj['id']] = user_obj
+                    user_cache.put(user_obj)
+                    if not missing:
+                        break
+        except RuntimeError:
+            logging.warn("Couldn't page through users, looking up %d one by one", len(missing))
+
+    futures = {user: submit(lookup_pool, get_user, user) for user in missing}
+    failed = set()
+    for user, future in futures.items():
+        try:
+            found[user] = future.result()
+        except (RuntimeError, KeyError):
+            failed.add(user)
+    return found, failed
+
 def get_user_full_name(user):
     try:
-        user_obj = slack_call("users.info", user=user)["user"]
+        user_obj = get_user(user)
     except:
         return user
+    return full_name(user_obj)
 
+def full_name(user_obj):
     # If they have filled out their profile to have a first name use that,
     # otherwise fall back on their username:
     if "profile" in user_obj:
@@ -556,27 +3359,29 @@ def get_user_full_name(user):
     return user_obj["name"]
 
 def find_user_id(username):
-    username = username.lower()
-    users = slack_call("users.list", presence=False)["members"]
-    for u in users:
-        if u["name"].lower() == username:
-            return u["id"]
-    return None
+    """
+    Look up a user id by username, or `None` if there's nobody by that name.
+    """
+    return get_tenant().user_index.find(username)
 
 
-def create_group_chat(users):
+def create_group_chat(users, on_posted=None, first_names=None):
     """
-    Given a list of users, create a group chat with the users
+    Given a list of users, create a group chat with the users.  If given,
+    `on_posted()` gets called as soon as our intro message is up, since from
+    then on there's no taking it back.  Names we've already looked up can be
+    passed in as `first_names`, by user id.
     """
-    from datetime import date
     # Remove myself if I'm included here so I don't show up in names, etc...
     if bot_id() in users:
         users.remove(bot_id())
 
     # Get the user names
-    names = [get_user_first_name(u) for u in users]
+    check_stopping()
+    first_names = first_names or {}
+    names = [first_names[u] if u in first_names else get_user_first_name(u) for u in users]
     names_str = "*, *".join(names[:-1]) + "* and *" + names[-1]
-    date_str = date.today().strftime("%m/%d/%Y")
+    date_str = datetime.date.today().strftime("%m/%d/%Y")
 
     logging.info("Creating group chat between %s", ", ".join(names))
 
@@ -585,6 +3390,7 @@ def create_group_chat(users):
         users=",".join(users + [bot_id()]),
     )["group"]["id"]
     logging.info("  group chat created: %s"%(group_id))
+    check_stopping()
 
     msg = "This is a private group message for *%s* for the week "%(names_str)
     msg += "of %s. Feel free to talk and share prayer requests "%(date_str)
@@ -597,6 +3403,8 @@ def create_group_chat(users):
         text=msg,
         as_user=True
     )
+    if on_posted is not None:
+        on_posted()
 
     # Then immediately leave the group message
     slack_call(
@@ -604,111 +3412,1238 @@ def create_group_chat(users):
         channel=group_id,
     )
 
+# Pairings get created concurrently on `dispatch_pool`, while whole triggers
+# run one at a time on `trigger_pool` so they never hold up the event loop.
+DISPATCH_WORKERS = int(os.environ.get('BRAYERPOT_DISPATCH_WORKERS', 8))
+
+# Who we are when claiming pairings out of a trigger job, and how long a claim
+# lasts before somebody else is allowed to assume we died and take over.
+WORKER_ID = "%s:%d"%(socket.gethostname(), os.getpid())
+TRIGGER_LEASE = 5*60
+dispatch_pool = ThreadPoolExecutor(DISPATCH_WORKERS, thread_name_prefix='dispatch')
+trigger_pool = ThreadPoolExecutor(1, thread_name_prefix='trigger')
+triggers_in_flight = set()
+triggers_lock = threading.Lock()
+
+# Set once we're on our way out (see `drain()`), after which we don't start
+# anything new, and triggers stop partway through
+stopping = threading.Event()
+
+# Pairings that are being created right now, so that `drain()` can wait for
+# them to be done with the database before closing it
+pairings_in_flight = set()
+
+def check_stopping():
+    """
+    Give up on whatever we're in the middle of if we're on our way out, before
+    it gets as far as another Slack call.
+    """
+    if stopping.is_set():
+        raise RuntimeError("On our way out")
+
+def worker_is_gone(worker):
+    """
+    Whether the process behind `worker` (a `WORKER_ID`) is certainly not
+    running any more.  That's us, if we're only just opening the database
+    (some earlier process had our pid), or one on this host whose pid is
+    gone.  We can't tell for other hosts, so they have to wait out their lease.
+    """
+    if worker == WORKER_ID:
+        return True
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, OSError):
+        pass
+    return False
+
+def release_stale_claims(db):
+    """
+    Having just opened `db`, let go of any trigger job pairings claimed by
+    processes that are gone, rather than waiting `TRIGGER_LEASE` for them.
+    """
+    for worker in db.claim_holders():
+        if worker_is_gone(worker):
+            released = db.release_claims(worker)
+            if released:
+                logging.info("Let go of %d pairings %s had claimed", released, worker)
+
+def submit_pairing(group, idx, users, first_names=None):
+    """
+    `create_job_pairing()` on `dispatch_pool`, keeping track of it in
+    `pairings_in_flight` until it's done.
+    """
+    future = submit(dispatch_pool, create_job_pairing, group, idx, users, first_names)
+    with triggers_lock:
+        pairings_in_flight.add(future)
+
+    def done(future):
+        with triggers_lock:
+            pairings_in_flight.discard(future)
+    future.add_done_callback(done)
+    return future
+
+def trigger_in_background(groups, scheduled=False):
+    """
+    Queue up `trigger_weekly_group_chats(groups, scheduled)` for the current
+    tenant on `trigger_pool`, as a single batch, leaving out any of `groups`
+    that are already queued or running.
+    """
+    tenant = get_tenant().name
+    if stopping.is_set():
+        return None
+    with triggers_lock:
+        busy = [g for g in groups if (tenant, g) in triggers_in_flight]
+        groups = [g for g in groups if (tenant, g) not in triggers_in_flight]
+        keys = set((tenant, g) for g in groups)
+        triggers_in_flight.update(keys)
+    if busy:
+        logging.info("Already triggering %s", ", ".join(busy))
+    if not groups:
+        return None
+
+    def run():
+        try:
+            return trigger_weekly_group_chats(groups, scheduled=scheduled)
+        except:
+            logging.exception("Trigger of %s blew up", ", ".join(groups))
+        finally:
+            with triggers_lock:
+                triggers_in_flight.difference_update(keys)
+    return submit(trigger_pool, run)
+
 def check_groups_to_trigger():
-    import datetime
+    """
+    Trigger every group whose deadline has passed, whichever tenant it's
+    for, all of each tenant's in one batch; with everybody on the default
+    schedule, that's usually most of them.  This only looks at the top of the
+    scheduler's heap, so it's cheap enough to call as often as we like.
+    """
+    from time import time
+    if stopping.is_set():
+        return
+    for tenant in each_tenant():
+        get_db()
+
+    due = OrderedDict()
+    for name, group in scheduler.pop_due(time()):
+        due.setdefault(name, []).append(group)
+    for name, groups in due.items():
+        with using_tenant(tenants[name]):
+            trigger_in_background(groups, scheduled=True)
+
+def create_job_pairing(group, idx, users, first_names=None):
+    """
+    Create the group chat for pairing `idx` of `group`'s trigger job, and
+    record how that went.
+    """
     db = get_db()
+    posted = []
 
-    now = get_now()
+    def on_posted():
+        db.set_pairing_state(group, idx, 'done')
+        posted.append(True)
 
-    for group in db.list_all_groups():
-        trigger_date = db.get_group_trigger_date(group)
+    try:
+        create_group_chat(list(users), on_posted, first_names)
+    except:
+        # If we managed to say hello, leaving the chat afterward is just gravy.
+        # If we're on our way out, it stays pending for whoever's next.
+        if posted:
+            return
+        if stopping.is_set():
+            logging.info("Leaving the chat for %s to whoever's next", ", ".join(users))
+            return
+        logging.warn("Could not create group chat for %s", ", ".join(users))
+        db.set_pairing_state(group, idx, 'failed')
+
+def dispatch_pairings(group, claimed):
+    """
+    Create a group chat for each `(index, users)` we've claimed out of
+    `group`'s trigger job, concurrently on `dispatch_pool`.
+    """
+    futures = [submit_pairing(group, idx, users) for idx, users in claimed]
+    for future in futures:
+        future.result()
 
-        # If we are after that date, trigger!
-        if now > trigger_date:
-            trigger_weekly_group_chats(group)
+def run_trigger_jobs(groups, first_names=None):
+    """
+    Work through the trigger jobs of all of `groups` together until none of
+    their pairings are left pending, returning the finished jobs by group.
+    Each round claims pairings across all of them, so that a batch of small
+    groups still keeps every dispatch worker busy.  Anything that some other
+    worker process has claimed, we wait for (or take over once their claim
+    lapses).  If we're `stopping`, we return early, leaving unfinished jobs
+    for whoever opens the database next.
+    """
+    from time import sleep
+    db = get_db()
 
+    pending = list(groups)
+    finished = {}
+    while pending and not stopping.is_set():
+        futures = []
+        for group in pending:
+            room = 4*DISPATCH_WORKERS - len(futures)
+            if room <= 0:
+                break
+            futures += [submit_pairing(group, idx, users, first_names)
+                        for idx, users in db.claim_pairings(group, WORKER_ID, room, TRIGGER_LEASE)]
+        if futures:
+            for future in futures:
+                future.result()
+            continue
 
-def trigger_weekly_group_chats(group_to_trigger=None):
+        for group in list(pending):
+            job = db.get_trigger_job(group)
+            if job is None:
+                logging.warn("Group %s went away partway through its trigger", group)
+                pending.remove(group)
+            elif 'pending' not in job['states']:
+                finished[group] = job
+                pending.remove(group)
+        if pending:
+            sleep(1)
+    return finished
+
+def run_trigger_worker():
     """
-    For each group that we know about, group the participants into 2s and 3s.
+    Help the bot get through big triggers by creating chats for pending
+    pairings out of any trigger job in the database.  This only makes sense
+    with the SQLite engine, which several processes can share.
     """
-    from random import shuffle
+    from time import sleep
+
+    if DB_ENGINE != 'sqlite':
+        logging.error("Trigger workers need BRAYERPOT_DB_ENGINE=sqlite")
+        sys.exit(1)
+
+    logging.info("Trigger worker %s reporting for duty", WORKER_ID)
+    while True:
+        busy = False
+        for tenant in each_tenant():
+            db = get_db()
+            for group in db.list_trigger_jobs():
+                claimed = db.claim_pairings(group, WORKER_ID, 4*DISPATCH_WORKERS, TRIGGER_LEASE)
+                if claimed:
+                    dispatch_pairings(group, claimed)
+                    busy = True
+                    break
+        if not busy:
+            sleep(5)
+
+def trigger_weekly_group_chats(groups=None, seed=None, scheduled=False):
+    """
+    For each of `groups` (a group, a list of them, or by default every group
+    we know about), group the participants into 2s and 3s, avoiding people
+    who've met recently.  Pass a `seed` for reproducible pairings.  If we're
+    `scheduled` to, rather than asked to by somebody, groups that have
+    already triggered this period get left alone.
+
+    The whole lot gets triggered as one batch: every group's pairings are
+    planned up front, everybody in them gets looked up once (however many of
+    the groups they're in), and then their chats all get created together.
+    Returns a dict mapping each group we triggered to its number of pairings,
+    failures and how many seconds the batch had taken when it finished.
+    """
+    from time import monotonic
     db = get_db()
+    start = monotonic()
 
-    groups = [group_to_trigger]
-    if group_to_trigger is None:
+    if groups is None:
         groups = db.list_all_groups()
+    elif isinstance(groups, str):
+        groups = [groups]
+
+    # If we got cut off partway through last time, finish those jobs rather
+    # than planning (and saying hello to) everybody all over again.
+    jobs = {}
+    with db.transaction():
+        for group in groups:
+            job = db.get_trigger_job(group)
+            if job is not None:
+                logging.info("Resuming trigger of group %s, %d of %d pairings left", group,
+                             job['states'].count('pending'), len(job['states']))
+                jobs[group] = job['pairings']
+                continue
+
+            if scheduled:
+                tinfo = db.get_group_times(group)
+                if tinfo is not None and not trigger_is_due(tinfo):
+                    logging.info("Group %s has already triggered this time around", group)
+                    db.schedule_changed(group)
+                    continue
 
-    for group in groups:
-        users = db.get_group(group)
-
-        if len(users) == 1:
-            logging.warn("Group %s is too lonely, not doing anything", group)
+            try:
+                users = db.get_group(group)
+            except KeyError:
+                logging.warn("Group %s has gone away, not triggering it", group)
+                continue
+            if len(users) == 1:
+                logging.warn("Group %s is too lonely, not doing anything", group)
+                continue
+
+            week = current_week()
+            jobs[group] = plan_pairings(users, db.get_pair_history(group), week, seed)
+            db.create_trigger_job(group, week, jobs[group])
+
+    # Look everybody up in one go, so that people in several groups only get
+    # looked up the once
+    everybody = set(user for pairings in jobs.values() for pairing in pairings for user in pairing)
+    everybody.discard(bot_id())
+    users, failed = get_users(everybody)
+    first_names = {user: first_name(user_obj) for user, user_obj in users.items()}
+    if failed:
+        logging.warn("Couldn't look up %d of %d people ahead of time", len(failed), len(everybody))
+    logging.info("Triggering %d groups, %d pairings between %d people", len(jobs),
+                 sum(len(pairings) for pairings in jobs.values()), len(everybody))
+
+    finished = run_trigger_jobs(list(jobs), first_names)
+
+    report = {}
+    for group in jobs:
+        job = finished.get(group)
+        if job is None:
+            if stopping.is_set():
+                logging.info("Leaving the rest of group %s's trigger for later", group)
             continue
 
-        # Split `users` up into groups of 2, if we have an uneven number the
-        # last group will have 3 people
-        shuffle(users)
-        user_groupings = [users[2*idx:2*idx+2] for idx in range(len(users)//2)]
-        if len(users)%2 != 0:
-            user_groupings[-1] += [users[-1]]
+        done = [g for g, state in zip(job['pairings'], job['states']) if state == 'done']
+        failures = job['states'].count('failed')
+        with db.transaction():
+            db.record_pairings(group, done, job['week'])
+            db.finish_trigger_job(group)
+
+            # Set this group as TOTALLY TRIGGERED
+            db.set_group_triggered(group)
+
+        report[group] = {
+            'pairings': len(job['pairings']),
+            'failures': failures,
+            'seconds': monotonic() - start,
+        }
+        metrics.observe('brayerpot_trigger_seconds', report[group]['seconds'])
+        metrics.inc('brayerpot_trigger_pairings_total', len(job['pairings']))
+        metrics.inc('brayerpot_trigger_failures_total', failures)
+        logging.info("Triggered group %s: %d pairings, %d failed, in %.2fs", group,
+                     len(job['pairings']), failures, report[group]['seconds'])
+    return report
+
+def handle_payload(payload):
+    """
+    Figure out whether an RTM payload is something we should act on, and if
+    so, do it.  We pay attention to people saying things like
+    `@prayerbot <command>` in channels, as well as things like `<command>`
+    sent in DMs to prayerbot.
+    """
+    parsed = get_router().route(payload)
+    if parsed is not None:
+        command, args = parsed
+        handle_command(command, payload, args)
+
+# Commands wait in `command_queue` for one of `COMMAND_WORKERS` threads, so
+# that one slow handler doesn't hold up anybody else's.  No more than
+# `COMMAND_QUEUE_SIZE` of them wait at once; past that, people get told
+# we're busy rather than being left hanging.
+COMMAND_WORKERS = int(os.environ.get('BRAYERPOT_COMMAND_WORKERS', 8))
+COMMAND_QUEUE_SIZE = int(os.environ.get('BRAYERPOT_COMMAND_QUEUE_SIZE', 256))
+
+# Who goes first: people DMing us, then people mentioning us in channels,
+# then the admin commands that are slow and that nobody is sat waiting on
+PRIORITY_INTERACTIVE, PRIORITY_MENTION, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = ('interactive', 'mention', 'bulk')
+BULK_COMMANDS = {'dump_groups', 'trigger_chats', 'snapshot', 'compact', 'secret_help'}
+
+def command_priority(command, payload):
+    if command in BULK_COMMANDS:
+        return PRIORITY_BULK
+    if payload.get('channel_type') == 'im' or str(payload.get('channel', '')).startswith('D'):
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_MENTION
+
+def reply_busy(payload):
+    try:
+        slack_call(
+            chat_type(payload),
+            channel=payload['channel'],
+            user=payload['user'],
+            text="Sorry, I'm swamped right now! Try again in a minute or two.",
+            as_user=True
+        )
+    except RuntimeError:
+        pass
+
+class CommandQueue:
+    """
+    A bounded priority queue of commands, worked through by `workers`
+    threads, most important first.  Once `max_size` commands are waiting, a
+    newcomer either bumps the least important one waiting (if it's more
+    important itself) or gets turned away, and whoever loses out gets told
+    we're busy.
+    """
+    def __init__(self, workers, max_size):
+        from itertools import count
+
+        self.workers = workers
+        self.max_size = max_size
+        self.heap = []
+        self.depth = [0]*len(PRIORITY_NAMES)
+        self.seq = count()
+        self.running = 0
+        self.threads = []
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.busy_pool = ThreadPoolExecutor(1, thread_name_prefix='busy')
+
+    def submit(self, priority, payload, func, *args):
+        """
+        Queue up `func(*args)` on behalf of `payload`, returning a future for
+        it.  If we turn it away, that future comes back already cancelled.
+        """
+        from concurrent.futures import Future
+        from heapq import heapify, heappush
+        from time import monotonic
+
+        future = Future()
+        context = contextvars.copy_context()
+        item = (priority, next(self.seq), monotonic(), payload, func, args, future, context)
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name='command-%d'%(len(self.threads)), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+            turned_away = None
+            if len(self.heap) >= self.max_size:
+                turned_away = max(self.heap)
+                if turned_away[0] > priority:
+                    self.heap.remove(turned_away)
+                    heapify(self.heap)
+                    self.depth[turned_away[0]] -= 1
+                else:
+                    turned_away = item
+
+            if turned_away is not item:
+                heappush(self.heap, item)
+                self.depth[priority] += 1
+                self.ready.notify()
+            self.update_gauges()
+
+        if turned_away is not None:
+            self.turn_away(turned_away)
+        return future
+
+    def turn_away(self, item):
+        priority, _, _, payload, func, _, future, context = item
+        metrics.inc('brayerpot_command_busy_total', priority=PRIORITY_NAMES[priority])
+        logging.warn("Too busy for %s (%s)", func.__name__, PRIORITY_NAMES[priority])
+        future.cancel()
+        if payload is not None:
+            self.busy_pool.submit(context.run, reply_busy, payload)
+
+    def drain(self, timeout=None):
+        """
+        Wait for up to `timeout` seconds for everything queued so far to get
+        handled, returning whether it did.
+        """
+        with self.ready:
+            return self.ready.wait_for(lambda: not self.heap and not self.running, timeout)
+
+    def update_gauges(self):
+        for priority, name in enumerate(PRIORITY_NAMES):
+            metrics.set_gauge('brayerpot_command_queue_depth', self.depth[priority], priority=name)
 
-        for grouping in user_groupings:
+    def work(self):
+        from heapq import heappop
+        from time import monotonic
+
+        slack_reserve.fraction = SLACK_TRIGGER_RESERVE
+        while True:
+            with self.ready:
+                while not self.heap:
+                    self.ready.wait()
+                item = heappop(self.heap)
+                self.depth[item[0]] -= 1
+                self.running += 1
+                self.update_gauges()
+
+            priority, _, queued, _, func, args, future, context = item
+            metrics.observe('brayerpot_command_queue_seconds', monotonic() - queued,
+                            priority=PRIORITY_NAMES[priority])
             try:
-                create_group_chat(grouping)
-            except:
-                logging.warn("Could not create group chat for %s", ", ".join(grouping))
+                if future.set_running_or_notify_cancel():
+                    future.set_result(context.run(func, *args))
+            except Exception as e:
+                logging.exception("%s blew up", func.__name__)
+                future.set_exception(e)
+            finally:
+                with self.ready:
+                    self.running -= 1
+                    self.ready.notify_all()
+
+command_queue = CommandQueue(COMMAND_WORKERS, COMMAND_QUEUE_SIZE)
+
+def enqueue_payload(payload):
+    """
+    Like `handle_payload()`, but rather than handling it right here, queue it
+    up on `command_queue`.  This gets called on the event loop, so it only
+    looks at the text, to throw out anything that can't be for us and guess
+    how important the rest is; working out whether it's really for us, which
+    can mean asking Slack which DMs we're in, happens on a command worker.
+    Returns the future for it, or `None` if it can't be a command.
+    """
+    command = None
+    router = get_tenant().router
+    if router is not None:
+        direct = payload.get('channel_type') == 'im' or str(payload.get('channel', '')).startswith('D')
+        parsed = router.parse(payload.get('text', ''), direct=direct)
+        if parsed is None:
+            return None
+        command = parsed[0]
+    return command_queue.submit(command_priority(command, payload), payload, handle_payload, payload)
+
+async def run_in_pool(pool, func, *args):
+    import asyncio
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, contextvars.copy_context().run, func, *args)
+    except Exception:
+        logging.exception("%s blew up", func.__name__)
+
+def handle_bookkeeping_event(payload):
+    """
+    Apply events that just keep our caches up to date, returning `True` if
+    `payload` was one of those.
+    """
+    # Profile updates and new arrivals keep our user cache fresh
+    if payload.get('type', '') in ('user_change', 'team_join'):
+        handle_user_event(payload)
+        return True
 
-        # Set this group as TOTALLY TRIGGERED
-        db.set_group_triggered(group)
+    # As do DMs being opened and closed for our DM index
+    if payload.get('type', '') in ('im_created', 'im_open', 'im_close'):
+        handle_im_event(payload)
+        return True
 
+    return False
 
-def event_loop():
-    from time import time, sleep
-    db = get_db()
+# Set to a path to have every RTM payload we get appended there, along with
+# when we got it, for `replay.py` to play back later
+RECORD_PATH = os.environ.get('BRAYERPOT_RECORD')
+
+class RtmRecorder:
+    """
+    Appends RTM payloads to a gzipped JSON lines file.  Each run starts with
+    a header line per tenant saying who we were there, followed by one
+    `{"ts": ..., "tenant": ..., "payload": ...}` line per payload.  We flush at
+    most every `flush_interval` seconds so that the compression still has
+    something to work with.
+    """
+    def __init__(self, path, flush_interval=1.0):
+        import gzip
+        from time import monotonic
+
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.flush_interval = flush_interval
+        self.last_flush = monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+        for tenant in tenants.values():
+            self.write({'tenant': tenant.name, 'bot_id': tenant.bot_id, 'bot_name': tenant.bot_name})
+
+    def write(self, obj):
+        import json
+        self.file.write(json.dumps(obj, separators=(',', ':')) + '\n')
+
+    @synchronized
+    def record(self, payload):
+        from time import monotonic, time
+
+        self.write({'ts': time(), 'tenant': get_tenant().name, 'payload': payload})
+        self.count += 1
+        if monotonic() - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = monotonic()
+
+    @synchronized
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            logging.info("Recorded %d RTM payloads", self.count)
+
+recorder = None
+
+# While we wait for an older brayerpot to hand over to us, RTM payloads get
+# held here (along with which tenant they're for) rather than handled
+held_payloads = None
+
+def dispatch_rtm_payload(payload):
+    """
+    Deal with a single RTM payload from within the event loop.  Bookkeeping
+    events get applied right away; commands get queued up on
+    `command_queue`, and we hand back the future for them.  Once we're
+    `stopping`, anything else that turns up is somebody else's problem.
+    """
+    if held_payloads is not None:
+        held_payloads.append((get_tenant(), payload))
+        return None
+    if stopping.is_set():
+        return None
+
+    if recorder is not None:
+        recorder.record(payload)
+
+    # Whatever's wrong with this payload, it's no reason to stop listening
+    try:
+        if handle_bookkeeping_event(payload):
+            return None
+
+        if payload.get('text') and seen_events.check(message_key(payload)):
+            return enqueue_payload(payload)
+    except Exception:
+        logging.exception("Couldn't dispatch %s payload", payload.get('type'))
+    return None
+
+# How we hear about what's going on in Slack: `rtm` keeps a websocket open,
+# while `events` runs an HTTP server for the Events API to call us on, which
+# lets several replicas share the load behind a load balancer.
+MODE = os.environ.get('BRAYERPOT_MODE', 'rtm')
+EVENTS_HOST = os.environ.get('BRAYERPOT_EVENTS_HOST', '0.0.0.0')
+EVENTS_PORT = int(os.environ.get('BRAYERPOT_EVENTS_PORT', 3000))
+if 'SLACK_SIGNING_SECRET' not in globals():
+    SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
+
+# Only one replica should be triggering chats; turn this off on the others
+RUN_SCHEDULER = os.environ.get('BRAYERPOT_SCHEDULER', '1') != '0'
+
+def verify_slack_signature(secret, timestamp, body, signature, now=None):
+    """
+    Check an Events API request's `X-Slack-Signature` against its body, and
+    make sure it isn't a replay of something old.
+    """
+    import hashlib
+    import hmac
+    from time import time
+
+    try:
+        if abs((now or time()) - int(timestamp)) > 5*60:
+            return False
+    except (TypeError, ValueError):
+        return False
+
+    base = b"v0:" + timestamp.encode('utf-8') + b":" + body
+    expected = "v0=" + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+class SeenEvents:
+    """
+    Remembers the last `max_size` events we've handled, since Slack retries
+    events it thinks we didn't get, and a message that mentions us shows up
+    as both a `message` and an `app_mention`.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    @synchronized
+    def recent(self, n=1000):
+        """
+        The last `n` keys we've seen, oldest first.
+        """
+        return list(self.seen)[-n:]
+
+    @synchronized
+    def check(self, key):
+        """
+        Return `True` the first time we see `key`, `False` after that.
+        """
+        if key is None:
+            return True
+        if key in self.seen:
+            return False
+        self.seen[key] = True
+        if len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+        return True
+
+seen_events = SeenEvents()
+
+def message_key(payload):
+    """
+    What identifies a message, whether it came over RTM or the Events API.
+    """
+    if payload.get('ts') is None:
+        return None
+    return (payload.get('channel'), payload.get('ts'))
+
+def handle_event(event):
+    """
+    Deal with a single Events API event once we've acknowledged it.  Just like
+    with RTM, commands get queued up on `command_queue`.
+    """
+    if handle_bookkeeping_event(event):
+        return
+
+    if event.get('type') in ('message', 'app_mention') and 'subtype' not in event:
+        if seen_events.check(message_key(event)):
+            enqueue_payload(event)
+
+def start_events_server(host, port):
+    """
+    Listen for Events API callbacks.  Every request gets verified and then
+    acknowledged right away (Slack gives up on us after 3 seconds), with the
+    actual work happening on `command_queue`.
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class EventsHandler(BaseHTTPRequestHandler):
+        def respond(self, code, body=b'', content_type='text/plain'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not verify_slack_signature(SLACK_SIGNING_SECRET,
+                                          self.headers.get('X-Slack-Request-Timestamp'),
+                                          body, self.headers.get('X-Slack-Signature')):
+                metrics.inc('brayerpot_events_rejected_total')
+                return self.respond(401)
+
+            try:
+                payload = json.loads(body.decode('utf-8'))
+            except ValueError:
+                return self.respond(400)
+
+            if payload.get('type') == 'url_verification':
+                return self.respond(200, payload.get('challenge', '').encode('utf-8'))
+
+            # Slack will try again in a bit, by which time whoever's taking
+            # over from us should be listening
+            if stopping.is_set():
+                return self.respond(503)
+
+            self.respond(200)
+            if payload.get('type') == 'event_callback' and 'event' in payload:
+                metrics.inc('brayerpot_events_total', type=payload['event'].get('type', ''))
+                tenant = find_tenant(payload.get('team_id'))
+                if tenant is None:
+                    logging.warn("Got an event for team %s, which isn't one of ours", payload.get('team_id'))
+                elif seen_events.check(payload.get('event_id')):
+                    with using_tenant(tenant):
+                        handle_event(payload['event'])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), EventsHandler)
+    threading.Thread(target=server.serve_forever, name='events', daemon=True).start()
+    logging.info("Listening for Slack events on %s:%d", host, port)
+    return server
+
+async def run_scheduler():
+    """
+    Sleep until the earliest trigger deadline (or until somebody changes the
+    schedule), then kick off whatever is due.
+    """
+    import asyncio
+    from time import time
+
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    scheduler.on_change = lambda: loop.call_soon_threadsafe(wakeup.set)
+
+    while True:
+        deadline = scheduler.next_deadline()
+        timeout = None if deadline is None else max(0, deadline - time())
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        check_groups_to_trigger()
+
+# If set, serve Prometheus metrics on this port, and log a summary of them
+# every `METRICS_LOG_INTERVAL` seconds regardless.
+METRICS_HOST = os.environ.get('BRAYERPOT_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.environ.get('BRAYERPOT_METRICS_PORT')
+METRICS_LOG_INTERVAL = float(os.environ.get('BRAYERPOT_METRICS_LOG_INTERVAL', 15*60))
+
+def collect_metrics():
+    """
+    Copy the numbers we keep track of elsewhere into `metrics`
+    """
+    for name, value in slack_call_stats().items():
+        metrics.set_gauge('brayerpot_slack_' + name, value)
+    if slack_http is not None:
+        for name, value in slack_http.stats().items():
+            metrics.set_gauge('brayerpot_http_' + name, value)
+    for tenant in tenants.values():
+        for name, value in tenant.user_cache.stats().items():
+            metrics.set_gauge('brayerpot_user_cache_' + name, value, tenant=tenant.name)
+        for name, value in tenant.user_index.stats().items():
+            metrics.set_gauge('brayerpot_user_index_' + name, value, tenant=tenant.name)
+        if tenant.db is not None:
+            for name, value in tenant.db.members.stats().items():
+                metrics.set_gauge('brayerpot_membership_' + name, value, tenant=tenant.name)
+            metrics.set_gauge('brayerpot_db_bytes', tenant.db.disk_usage(), tenant=tenant.name)
+
+def start_metrics_server(host, port):
+    """
+    Serve `metrics` in the Prometheus text format from a background thread.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            collect_metrics()
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
+
+async def run_metrics():
+    """
+    Keep an eye on how late the event loop wakes up, and every so often log a
+    summary of where our time has been going.
+    """
+    import asyncio
+    from time import monotonic
+
+    interval = 5
+    last_log = monotonic()
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        metrics.set_gauge('brayerpot_loop_lag_seconds', max(0, monotonic() - start - interval))
+
+        if monotonic() - last_log >= METRICS_LOG_INTERVAL:
+            last_log = monotonic()
+            collect_metrics()
+            logging.info("Metrics summary:\n  %s", "\n  ".join(metrics.summary()))
+
+async def run_db_flusher():
+    """
+    With a `DB_FLUSH_INTERVAL` set, commits only happen when someone writes
+    after the interval is up, so make sure nothing sits around uncommitted
+    for much longer than that.
+    """
+    import asyncio
+
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        for tenant in tenants.values():
+            if tenant.db is not None:
+                await run_in_pool(None, tenant.db.commit_if_due)
+
+async def run_rtm():
+    """
+    Read the current tenant's RTM frames whenever its websocket says it has
+    some, rather than polling it.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    client = get_tenant().client
+    sock = client.server.websocket.sock
+    loop.add_reader(sock.fileno(), readable.set)
+    try:
+        while True:
+            # Each `rtm_read()` only gets us a single frame, and frames that
+            # are already sitting decrypted in the SSL buffer won't make the
+            # socket readable again, so keep going until there's nothing left
+            # (Slack may have already handed us some during the connect)
+            payloads = client.rtm_read()
+            while payloads:
+                for payload in payloads:
+                    dispatch_rtm_payload(payload)
+                await asyncio.sleep(0)
+                payloads = client.rtm_read()
+            await readable.wait()
+            readable.clear()
+    finally:
+        loop.remove_reader(sock.fileno())
+
+# Where a running brayerpot listens for a newer one asking to take over
+# from it.  This lives next to the database by default, since that's the
+# volume that old and new containers both have mounted.
+HANDOFF_SOCKET = os.environ.get('BRAYERPOT_HANDOFF_SOCKET', os.path.join(DB_DIR, 'handoff.sock'))
+
+# How long to let queued commands and running triggers finish when we're
+# asked to go, whether by a newer brayerpot or by a ^C.  A bit under the ten
+# seconds `docker stop` gives us.
+DRAIN_TIMEOUT = float(os.environ.get('BRAYERPOT_DRAIN_TIMEOUT', 8))
+
+def drain(timeout=DRAIN_TIMEOUT):
+    """
+    Stop taking on anything new, give whatever's queued or running up to
+    `timeout` seconds to finish, then commit and close every database.
+    Triggers we cut off keep their trigger job, so whoever opens the database
+    next picks up where we left off.  Pairings that are partway through get
+    to finish whichever Slack call they're in (without retrying it), and
+    record how it went, since the next one could be the intro that nobody
+    would know we'd posted.
+    """
+    from concurrent.futures import wait
+    from time import monotonic, sleep
+
+    stopping.set()
+    deadline = monotonic() + timeout
+    if not command_queue.drain(timeout):
+        logging.warn("Gave up waiting for queued commands to finish")
+    while triggers_in_flight and monotonic() < deadline:
+        sleep(0.1)
+    if triggers_in_flight:
+        logging.warn("Gave up waiting for %d triggers to stop", len(triggers_in_flight))
+
+    with triggers_lock:
+        pairings = list(pairings_in_flight)
+    if pairings:
+        logging.info("Waiting for %d pairings to put down what they're doing", len(pairings))
+        _, unfinished = wait(pairings, timeout=max(0, deadline - monotonic()))
+        if unfinished:
+            logging.warn("Gave up waiting for %d pairings to finish", len(unfinished))
+
+    for tenant in each_tenant():
+        db = tenant.db
+        if db is not None and not db.readonly:
+            released = db.release_claims(WORKER_ID)
+            if released:
+                logging.info("Let go of %d unfinished pairings in %s", released, tenant.name)
+        close_db()
+
+def warm_caches():
+    """
+    Fill the current tenant's caches with who we are and which DMs we're in,
+    which almost every command needs, so that the first ones we handle don't
+    have to wait on Slack for them.  Profiles and the username index get
+    filled in as they're needed, rather than by walking the whole workspace
+    every time we start.
+    """
+    tenant = get_tenant()
+    get_router()
+
+    # The first DM to come in may already have beaten us to it
+    with tenant.lookup_lock:
+        if tenant.im_channels is None:
+            load_im_channels()
+
+async def serve_handoff(path, handed_off):
+    """
+    Listen on `path` for a newer brayerpot asking to take over from us.  When
+    one does, we stop handling anything new and tell it which messages we've
+    already handled, then `drain()`, and tell it that everything's its own.
+    `handed_off` gets set once we have.
+    """
+    import asyncio
+    import json
+
+    async def send(writer, message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        await writer.drain()
 
-    if not slack_client.rtm_connect():
-        logging.error("Could not connect to RTM firehose!")
+    async def handle(reader, writer):
+        try:
+            request = json.loads((await reader.readline()).decode('utf-8') or 'null')
+        except ValueError:
+            request = None
+        if not isinstance(request, dict) or request.get('op') != 'drain' or stopping.is_set():
+            writer.close()
+            return
+
+        logging.info("A newer brayerpot wants to take over, draining...")
+        stopping.set()
+        await send(writer, {'op': 'draining', 'seen': seen_events.recent()})
+        await run_in_pool(None, drain)
+        await send(writer, {'op': 'released'})
+        writer.close()
+        handed_off.set()
+
+    # Whoever was listening here before has handed over to us (or died)
+    if os.path.exists(path):
+        os.unlink(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    server = await asyncio.start_unix_server(handle, path)
+    logging.info("Listening for handoffs on %s", path)
+    return server
+
+async def is_listening(path):
+    """
+    Whether some older brayerpot is listening for handoffs on `path`.  The
+    socket file being there isn't enough to go on, since one that crashed
+    (or, before Python 3.13, one that exited cleanly) leaves it behind.
+    """
+    import asyncio
+
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+async def take_over(path):
+    """
+    If an older brayerpot is listening on `path`, ask it to hand over to us,
+    and wait for it to let go of the databases.  Until then, `held_payloads`
+    should be holding on to whatever RTM sends us, so that nothing gets lost
+    in between.
+    """
+    import asyncio
+    import json
+    from time import monotonic
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except OSError as e:
+        logging.info("Nobody's listening on %s (%s), carrying on", path, e)
+        return
+
+    logging.info("Asking the brayerpot that's already running to hand over...")
+    start = monotonic()
+    writer.write(json.dumps({'op': 'drain'}).encode('utf-8') + b'\n')
+    await writer.drain()
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), DRAIN_TIMEOUT + 30)
+            if not line:
+                logging.warn("Old brayerpot went away without saying goodbye")
+                break
+            message = json.loads(line.decode('utf-8'))
+            if message.get('op') == 'draining':
+                # Don't handle anything it already did
+                for key in message.get('seen', []):
+                    seen_events.check(tuple(key) if isinstance(key, list) else key)
+            elif message.get('op') == 'released':
+                break
+    except asyncio.TimeoutError:
+        logging.warn("Old brayerpot is taking too long to drain, taking over anyway")
+    finally:
+        writer.close()
+
+    metrics.observe('brayerpot_handoff_seconds', monotonic() - start)
+    logging.info("Took over in %.2fs", monotonic() - start)
+
+def connect_rtm():
+    """
+    Open the current tenant's RTM websocket.  We use `rtm.connect` rather
+    than `rtm.start`, which would send along every user and channel in the
+    workspace before we could read a single message.  It still tells us who
+    we are, which saves an `auth.test`.
+    """
+    tenant = get_tenant()
+    if not tenant.client.rtm_connect(with_team_state=False):
+        logging.error("Could not connect to RTM firehose for %s!", tenant.name)
         raise RuntimeError("rtm_connect() failed")
 
+    login = tenant.client.server.login_data or {}
+    if tenant.bot_id is None and 'self' in login:
+        tenant.bot_id = login['self']['id']
+        tenant.bot_name = login['self'].get('name', tenant.bot_name)
+        tenant.team_id = (login.get('team') or {}).get('id')
+        logging.info("Connected to %s as %s (%s)", tenant.name, tenant.bot_id, tenant.bot_name)
+
+async def run_bot():
+    import asyncio
+    from time import perf_counter
+    global recorder, held_payloads
+
+    start = perf_counter()
+    loop = asyncio.get_running_loop()
+
+    # If an older brayerpot is still running, get everything ready alongside
+    # it, and only then ask it to hand over.  Until it does, we only look at
+    # the database, and hold on to whatever RTM sends us.
+    predecessor = await is_listening(HANDOFF_SOCKET)
+    if predecessor:
+        logging.info("Found a brayerpot listening on %s, getting ready to take over", HANDOFF_SOCKET)
+        held_payloads = []
+
+    # Otherwise, open the databases while we connect.  Nothing needs one
+    # until the first command does, and that just waits in `get_db()`.
+    opening = []
+    for tenant in each_tenant():
+        if tenant.token is None:
+            logging.error("No Slack token for %s, can't connect to anything!", tenant.name)
+            sys.exit(1)
+        if predecessor:
+            db = open_db(tenant, readonly=True)
+            if db is not None:
+                scheduler.attach(db, tenant)
+            tenant.db = db
+        else:
+            opening.append(loop.run_in_executor(None, contextvars.copy_context().run, get_db))
+
+    # Every tenant shares this one event loop; each of their RTM tasks picks
+    # up whichever tenant was current when it was created.
+    tasks = [asyncio.ensure_future(run_metrics())]
+    if MODE == 'events':
+        if SLACK_SIGNING_SECRET is None:
+            logging.error("No SLACK_SIGNING_SECRET, can't verify any events!")
+            sys.exit(1)
+    else:
+        for tenant in each_tenant():
+            connect_rtm()
+            tasks.append(asyncio.ensure_future(run_rtm()))
+
+    # We need to know who we are to make sense of any commands, but the rest
+    # can fill itself in while we get on with handling them
+    warming = []
+    for tenant in each_tenant():
+        if predecessor:
+            await run_in_pool(None, warm_caches)
+        else:
+            get_router()
+            warming.append(asyncio.ensure_future(run_in_pool(None, warm_caches)))
+    metrics.set_gauge('brayerpot_startup_seconds', perf_counter() - start, phase='connect')
+    logging.info("Connected in %.2fs", perf_counter() - start)
+
+    if predecessor:
+        await take_over(HANDOFF_SOCKET)
+        for tenant in each_tenant():
+            close_db()
+            get_db()
+
+        held, held_payloads = held_payloads, None
+        logging.info("Catching up on %d payloads that came in while we waited", len(held))
+        for tenant, payload in held:
+            with using_tenant(tenant):
+                dispatch_rtm_payload(payload)
+
+    handed_off = asyncio.Event()
+    try:
+        handoff_server = await serve_handoff(HANDOFF_SOCKET, handed_off)
+    except OSError as e:
+        logging.warn("Can't listen for handoffs on %s: %s", HANDOFF_SOCKET, e)
+        handoff_server = None
+    tasks.append(asyncio.ensure_future(handed_off.wait()))
+
+    if MODE == 'events':
+        start_events_server(EVENTS_HOST, EVENTS_PORT)
+    if RECORD_PATH and MODE != 'events':
+        recorder = RtmRecorder(RECORD_PATH)
+        logging.info("Recording RTM traffic to %s", RECORD_PATH)
     logging.info("All systems operational")
-    last_check = 0
 
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, int(METRICS_PORT))
+
+    # The scheduler wants every database open before it goes looking for
+    # anything to trigger
+    await asyncio.gather(*opening)
+    if opening:
+        metrics.set_gauge('brayerpot_startup_seconds', perf_counter() - start, phase='db')
+        logging.info("Opened every database after %.2fs", perf_counter() - start)
+
+    if RUN_SCHEDULER:
+        tasks.append(asyncio.ensure_future(run_scheduler()))
+    if DB_FLUSH_INTERVAL > 0:
+        tasks.append(asyncio.ensure_future(run_db_flusher()))
     try:
-        # Find <@bot_id> pieces of text:
-        at_bot = "<@" + bot_id() + ">"
-        while True:
-            rtm_data = slack_client.rtm_read()
-
-            # If we received something to process, DEWIT
-            if rtm_data:
-                for payload in rtm_data:
-                    # We pay attention to people saying things like
-                    # `@prayerbot <command>` in channels, as well as things
-                    # like `<command>` sent in DMs to prayerbot.
-                    text = payload.get('text', '')
-                    if not text:
-                        continue
-
-                    if at_bot in text:
-                        command = text.split(at_bot)[1].strip().split()[0].lower()
-                        
-                        # Only pay attention if there is a command
-                        if not command:
-                            continue
-                        handle_command(command, payload)
-                        continue
-
-                    if payload.get('type', '') == 'message':
-                        if is_im_to_me(payload):
-                            command = text.split()[0].lower()
-                            if not command:
-                                continue
-
-                            handle_command(command, payload)
-            else:
-                # Don't burn _all_ the CPUs
-                sleep(0.01)
+        # Other than us handing over, if any of these ever returns, something
+        # has gone horribly wrong
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        if handed_off.is_set():
+            logging.info("Handed over, bye!")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if handoff_server is not None:
+            handoff_server.close()
 
-                # Check once a minute to see if there are any groups to trigger...
-                if time() - last_check > 60:
-                    check_groups_to_trigger()
-                    last_check = time()
+def event_loop():
+    import asyncio
 
+    try:
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         logging.info("Gracefully shutting down...")
+        drain()
+    finally:
+        if recorder is not None:
+            recorder.close()
+        for tenant in tenants.values():
+            if tenant.db is not None:
+                tenant.db.commit()
+
+def run_db_tool(argv):
+    """
+    `python brayerpot.py export|import|snapshot|compact ...`, for looking
+    after a tenant's database by hand.  Exporting and snapshotting only read,
+    so they're fine to run while the bot is up; importing and compacting want
+    it stopped, unless you're on SQLite.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='brayerpot.py')
+    parser.add_argument('--tenant', default=None, help="Which tenant's database (default: the first one)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('export', help="Write everything out as JSON lines").add_argument('path')
+    commands.add_parser('import', help="Load an export into an empty database").add_argument('path')
+    commands.add_parser('snapshot', help="Save a consistent copy of the database").add_argument('path', nargs='?')
+    commands.add_parser('compact', help="Give back the space the database isn't using")
+    args = parser.parse_args(argv)
+
+    tenant = tenants.get(args.tenant) if args.tenant else default_tenant
+    if tenant is None:
+        parser.error("No such tenant %s"%(args.tenant))
+
+    with using_tenant(tenant):
+        db = open_db(tenant, readonly=args.command in ('export', 'snapshot'))
+        if db is None:
+            logging.error("%s doesn't have a database yet", tenant.name)
+            return 1
+
+        try:
+            if args.command == 'export':
+                count = write_records(args.path, db.export_records())
+                logging.info("Exported %d records to %s", count, args.path)
+            elif args.command == 'import':
+                if not db.is_empty():
+                    logging.error("%s's database already has groups in it, not importing over the top", tenant.name)
+                    return 1
+                count = db.import_records(read_records(args.path))
+                logging.info("Imported %d prayer groups from %s", count, args.path)
+            elif args.command == 'snapshot':
+                path = args.path or snapshot_path('.sqlite' if DB_ENGINE == 'sqlite' else '.db')
+                db.snapshot(path)
+                logging.info("Saved a snapshot of %d bytes to %s", file_size(path), path)
+            else:
+                before = db.disk_usage()
+                db.compact()
+                logging.info("Compacted the database from %d to %d bytes", before, db.disk_usage())
+        finally:
+            db.close()
+    return 0
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    event_loop()
+    if sys.argv[1:] == ['trigger-worker']:
+        run_trigger_worker()
+    elif sys.argv[1:2] in (['export'], ['import'], ['snapshot'], ['compact'], ['--tenant']):
+        sys.exit(run_db_tool(sys.argv[1:]))
+    else:
+        event_loop()
@@ -0,0 +1,236 @@
+# fakeslack: a pretend Slack that lives in our own process, for benchmarks
+import threading
+from collections import Counter, deque
+from time import monotonic, sleep
+
+
+class FakeSlack:
+    """
+    An in-process stand-in for the bits of the Slack Web API that brayerpot
+    uses.  Hand it to `brayerpot.set_slack_transport()` and every `slack_call`
+    lands here instead of going over the network.
+
+    Every call sleeps for `latency` seconds first, to pretend to be a network.
+    `rate_limits` maps API method names to a number of calls per minute; go
+    over that and you get `ratelimited` back, with a `Retry-After` header,
+    just like the real thing.
+    """
+    def __init__(self, num_users=0, latency=0.0, rate_limits=None, bot_name='prayerbot', bot_id=None, team_id='T00000000'):
+        self.latency = latency
+        self.team_id = team_id
+        self.rate_limits = rate_limits or {}
+        self.lock = threading.Lock()
+
+        self.users = {}
+        self.ims = {}
+        self.groups = {}
+        self.groups_by_members = {}
+        self.messages = []
+        self.files = []
+        self.calls = Counter()
+        self.ratelimited = Counter()
+        self.recent_calls = {}
+
+        self.bot_id = self.add_user(bot_name, user_id=bot_id)
+        for idx in range(num_users):
+            self.add_user("user%d"%(idx), "User", "Number %d"%(idx))
+
+    def add_user(self, name, first_name=None, last_name=None, user_id=None):
+        """
+        Make up a new user, returning their id.  Pass `user_id` to pick it
+        yourself, e.g. to match up with some recorded traffic.
+        """
+        with self.lock:
+            if user_id is None:
+                user_id = "U%08d"%(len(self.users))
+            profile = {}
+            if first_name is not None:
+                profile['first_name'] = first_name
+            if last_name is not None:
+                profile['last_name'] = last_name
+            self.users[user_id] = {'id': user_id, 'name': name, 'profile': profile}
+            return user_id
+
+    def open_im(self, user, channel=None):
+        """
+        Open a DM between the bot and `user`, returning its channel id.
+        """
+        with self.lock:
+            if channel is None:
+                channel = "D%08d"%(len(self.ims))
+            self.ims[channel] = user
+            return channel
+
+    def is_ratelimited(self, method):
+        limit = self.rate_limits.get(method)
+        if limit is None:
+            return False
+
+        now = monotonic()
+        window = self.recent_calls.setdefault(method, deque())
+        while window and now - window[0] > 60:
+            window.popleft()
+        if len(window) >= limit:
+            return True
+        window.append(now)
+        return False
+
+    def api_call(self, method, **kwargs):
+        sleep(self.latency)
+
+        with self.lock:
+            self.calls[method] += 1
+            if self.is_ratelimited(method):
+                self.ratelimited[method] += 1
+                return {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '1'}}
+
+            handler = getattr(self, method.replace('.', '_'), None)
+            if handler is None:
+                return {'ok': False, 'error': 'unknown_method'}
+            return handler(**kwargs)
+
+    # Everything below here is one Web API method, called with the lock held
+    def users_info(self, user, **kwargs):
+        if user not in self.users:
+            return {'ok': False, 'error': 'user_not_found'}
+        return {'ok': True, 'user': self.users[user]}
+
+    def auth_test(self, **kwargs):
+        return {'ok': True, 'user_id': self.bot_id, 'user': self.users[self.bot_id]['name'], 'team_id': self.team_id}
+
+    def users_list(self, limit=0, cursor=None, **kwargs):
+        # Like Slack, we page through users with an opaque-ish cursor, and
+        # treat a missing or silly limit as "whatever we feel like"
+        limit = int(limit)
+        if limit <= 0 or limit > 1000:
+            limit = 1000
+        try:
+            start = int(cursor or 0)
+        except ValueError:
+            return {'ok': False, 'error': 'invalid_cursor'}
+
+        members = list(self.users.values())[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(self.users) else ''
+        return {'ok': True, 'members': members, 'response_metadata': {'next_cursor': next_cursor}}
+
+    def rtm_connect(self, **kwargs):
+        bot = self.users[self.bot_id]
+        return {
+            'ok': True,
+            'url': 'wss://fakeslack.invalid/websocket',
+            'team': {'id': self.team_id, 'name': 'Fake Slack', 'domain': 'fakeslack'},
+            'self': {'id': bot['id'], 'name': bot['name']},
+        }
+
+    def rtm_start(self, **kwargs):
+        # All of `rtm.connect`, plus the whole workspace
+        login = self.rtm_connect()
+        login.update({
+            'users': list(self.users.values()),
+            'channels': [],
+            'groups': [{'id': group_id, 'members': g['members']} for group_id, g in self.groups.items()],
+            'ims': [{'id': channel, 'user': user} for channel, user in self.ims.items()],
+        })
+        return login
+
+    def im_list(self, **kwargs):
+        ims = [{'id': channel, 'user': user} for channel, user in self.ims.items()]
+        return {'ok': True, 'ims': ims}
+
+    def mpim_open(self, users, **kwargs):
+        members = tuple(sorted(users.split(',')))
+        if any(u not in self.users for u in members):
+            return {'ok': False, 'error': 'user_not_found'}
+
+        # Like Slack, opening the same set of people twice gets you the same chat
+        group_id = self.groups_by_members.get(members)
+        if group_id is None:
+            group_id = "G%08d"%(len(self.groups))
+            self.groups[group_id] = {'members': list(members)}
+            self.groups_by_members[members] = group_id
+        members = list(members)
+        return {'ok': True, 'group': {'id': group_id, 'members': members}}
+
+    def chat_postMessage(self, channel, text, **kwargs):
+        self.messages.append({'channel': channel, 'text': text})
+        return {'ok': True, 'channel': channel}
+
+    def chat_postEphemeral(self, channel, text, user=None, **kwargs):
+        self.messages.append({'channel': channel, 'text': text, 'user': user})
+        return {'ok': True}
+
+    def files_upload(self, channels, content, **kwargs):
+        self.files.append({'channels': channels, 'content': content})
+        return {'ok': True, 'file': {'id': "F%08d"%(len(self.files))}}
+
+    def groups_leave(self, channel, **kwargs):
+        if channel not in self.groups:
+            return {'ok': False, 'error': 'channel_not_found'}
+        return {'ok': True}
+
+class FakeRtmClient:
+    """
+    Just enough of a `SlackClient` for `brayerpot.run_bot()` to connect to
+    RTM through `fake`, after which `rtm_read()` hands back `payloads`, as if
+    they'd been waiting for us.  There's a socket for the event loop to wait
+    on, which never has anything to say; `close()` it once you're done.
+    """
+    def __init__(self, fake, payloads=()):
+        import socket
+        from types import SimpleNamespace
+
+        self.fake = fake
+        self.payloads = list(payloads)
+        self.sockets = socket.socketpair()
+        self.server = SimpleNamespace(login_data=None, websocket=SimpleNamespace(sock=self.sockets[0]))
+
+    def rtm_connect(self, with_team_state=True, **kwargs):
+        method = 'rtm.start' if with_team_state else 'rtm.connect'
+        self.server.login_data = self.fake.api_call(method)
+        return self.server.login_data['ok']
+
+    def rtm_read(self):
+        payloads, self.payloads = self.payloads, []
+        return payloads
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+def serve_http(fake, host='127.0.0.1', port=0):
+    """
+    Serve `fake` over HTTP/1.1 with keep-alive, looking enough like
+    `https://slack.com/api/` for a real HTTP client to talk to.  Returns the
+    server, which is already running on a background thread.
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl
+
+    class Handler(BaseHTTPRequestHandler):
+        # Headers and body go out in separate writes, which on a kept-alive
+        # connection would otherwise sit waiting on a delayed ACK
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            result = fake.api_call(self.path.rsplit('/', 1)[-1], **dict(parse_qsl(body.decode('utf-8'))))
+            headers = result.pop('headers', {})
+            body = json.dumps(result).encode('utf-8')
+
+            self.send_response(429 if result.get('error') == 'ratelimited' else 200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fakeslack-http', daemon=True).start()
+    return server
@@ -0,0 +1,58 @@
+# post_event: play recorded Events API payloads at a brayerpot running in events mode
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from time import time
+
+
+def post_event(url, secret, body):
+    """
+    POST `body` (bytes) to `url`, signed with `secret` the same way Slack would.
+    Returns the HTTP status code and response body.
+    """
+    timestamp = str(int(time()))
+    base = b"v0:" + timestamp.encode('utf-8') + b":" + body
+    signature = "v0=" + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+
+    request = urllib.request.Request(url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': signature,
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Post recorded Slack events to brayerpot")
+    parser.add_argument('files', nargs='+',
+                        help="JSON files, each holding one event payload or a list of them")
+    parser.add_argument('--url', default='http://localhost:3000/')
+    parser.add_argument('--secret', default=os.environ.get('SLACK_SIGNING_SECRET'))
+    args = parser.parse_args(argv)
+
+    if not args.secret:
+        parser.error("need --secret or $SLACK_SIGNING_SECRET")
+
+    failed = 0
+    for path in args.files:
+        with open(path) as f:
+            payloads = json.load(f)
+        if not isinstance(payloads, list):
+            payloads = [payloads]
+
+        for payload in payloads:
+            status, body = post_event(args.url, args.secret, json.dumps(payload).encode('utf-8'))
+            print("%s: %d %s" % (path, status, body.decode('utf-8', 'replace')))
+            failed += status != 200
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# replay: play recorded RTM traffic back through brayerpot, against a fake Slack
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+from collections import defaultdict
+from time import monotonic, perf_counter
+
+# bench keeps brayerpot away from the real database, so it goes first
+from bench import install_fake_slack, report, use_fresh_db
+import brayerpot
+from fakeslack import FakeSlack
+
+
+def read_recording(path):
+    """
+    Yield every line of a recording made with `BRAYERPOT_RECORD`.  If the bot
+    died mid-write the file will end early, which is fine; we stop there.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, OSError, ValueError) as e:
+            logging.warn("Recording %s ends early: %s", path, e)
+
+def load_recording(path, max_gap=60.0, tenant=None):
+    """
+    Returns `(bot_id, bot_name, records)`, where `records` is a list of
+    `(offset, payload)` with `offset` in seconds since the first payload.
+    Quiet spells longer than `max_gap` (overnight, or between two runs that
+    recorded to the same file) get squashed down to `max_gap`.  Only traffic
+    for `tenant` gets played back, or for the first one in the recording if
+    we aren't told which.
+    """
+    bot_id, bot_name = None, 'prayerbot'
+    records = []
+    offset, last_ts = 0.0, None
+    for line in read_recording(path):
+        name = line.get('tenant')
+        if name is not None:
+            if tenant is None:
+                tenant = name
+            elif name != tenant:
+                continue
+
+        if 'payload' not in line:
+            bot_id = line.get('bot_id') or bot_id
+            bot_name = line.get('bot_name') or bot_name
+            continue
+
+        if last_ts is not None:
+            offset += min(max(0.0, line['ts'] - last_ts), max_gap)
+        last_ts = line['ts']
+        records.append((offset, line['payload']))
+    return bot_id, bot_name, records
+
+def fake_slack_for(bot_id, bot_name, records, latency=0.0, rate_limits=None):
+    """
+    Build a `FakeSlack` that knows about everybody and every DM that shows up
+    in `records`, so that brayerpot can look them up like it would for real.
+    """
+    fake = FakeSlack(latency=latency, rate_limits=rate_limits, bot_name=bot_name, bot_id=bot_id)
+    for _, payload in records:
+        user = payload.get('user')
+        if isinstance(user, dict):
+            user = user.get('id')
+        if not isinstance(user, str):
+            continue
+        if user not in fake.users:
+            fake.add_user(user.lower(), user_id=user)
+
+        channel = payload.get('channel')
+        if isinstance(channel, str) and channel.startswith('D') and channel not in fake.ims:
+            fake.open_im(user, channel)
+    return fake
+
+def command_label(payload):
+    """
+    Which command `payload` is, for grouping latencies by.  Anything that
+    only looked like it might be for us gets counted under "(ignored)".
+    """
+    parsed = brayerpot.get_router().route(payload)
+    if parsed is None:
+        return '(ignored)'
+    return parsed[0] if parsed[0] in brayerpot.COMMANDS else 'unknown'
+
+async def play(records, speed):
+    """
+    Feed `records` through `dispatch_rtm_payload()`, `speed` times faster
+    than they were recorded, or as fast as we can if `speed` is `None`.
+    Returns how long it took, and end-to-end latencies by command.  Commands
+    we were too busy for get counted under "(busy)".
+    """
+    latencies = defaultdict(list)
+    futures = []
+    start = monotonic()
+    for offset, payload in records:
+        if speed:
+            delay = start + offset/speed - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        sent = perf_counter()
+        future = brayerpot.dispatch_rtm_payload(payload)
+        if future is not None:
+            label = command_label(payload)
+            future.add_done_callback(lambda f, label=label, sent=sent:
+                                     latencies['(busy)' if f.cancelled() else label].append(perf_counter() - sent))
+            futures.append(asyncio.wrap_future(future))
+
+        # Even flat out, give finished tasks a chance to get cleaned up
+        await asyncio.sleep(0)
+
+    await asyncio.gather(*futures, return_exceptions=True)
+    return monotonic() - start, latencies
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded RTM traffic against a fake Slack")
+    parser.add_argument('recording', help="A file recorded with BRAYERPOT_RECORD set")
+    parser.add_argument('--speed', default='1',
+                        type=lambda s: None if s == 'max' else float(s),
+                        help="How many times faster than real time to play back, or 'max'")
+    parser.add_argument('--tenant', default=None,
+                        help="Which tenant's traffic to play back (default: the first one recorded)")
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help="Squash quiet spells in the recording down to this many seconds")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds of pretend network latency per Slack call")
+    parser.add_argument('--respect-rate-limits', action='store_true',
+                        help="Keep brayerpot's own per-method rate limiting on")
+    parser.add_argument('--engine', default='shelve', choices=['shelve', 'sqlite'])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    bot_id, bot_name, records = load_recording(args.recording, args.max_gap, args.tenant)
+    if not records:
+        parser.error("%s has nothing in it to replay" % (args.recording))
+
+    fake = install_fake_slack(fake_slack_for(bot_id, bot_name, records, args.latency),
+                              args.respect_rate_limits)
+    use_fresh_db(args.engine)
+
+    print("Replaying %d payloads (%.1fs recorded) at %s speed (%s, %.1fms fake latency):" % (
+        len(records), records[-1][0], "max" if args.speed is None else "%gx" % (args.speed),
+        args.engine, args.latency*1e3))
+    elapsed, latencies = asyncio.run(play(records, args.speed))
+
+    handled = sum(len(samples) for samples in latencies.values())
+    print("  %d payloads in %.3fs: %.1f payloads/s, %.1f messages/s, %d slack calls" % (
+        len(records), elapsed, len(records)/elapsed, handled/elapsed, sum(fake.calls.values())))
+    for label in sorted(latencies):
+        report(label, latencies[label])
+
+    # Close the database now, while there's still an interpreter to do it with
+    brayerpot.get_tenant().db = None
+
+if __name__ == "__main__":
+    main()
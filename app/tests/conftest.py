@@ -0,0 +1,75 @@
+# Fixtures for the tests: a pretend Slack for brayerpot to talk to, and brand
+# new databases of either engine to keep its groups in.
+import os
+import sys
+import tempfile
+
+# We're not a package, so make `import brayerpot` work from in here
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep brayerpot from going anywhere near the real database
+os.environ.setdefault('BRAYERPOT_DB_DIR', tempfile.mkdtemp(prefix='brayerpot-test-'))
+
+import pytest
+
+import brayerpot
+from fakeslack import FakeSlack
+
+ENGINES = ('shelve', 'sqlite')
+
+@pytest.fixture
+def new_slack(monkeypatch):
+    """
+    Point brayerpot at a brand new `FakeSlack` with `num_users` people in it,
+    as a tenant that knows nothing about whichever Slack it talked to before.
+    We're testing what we do, not how long Slack makes us wait for it, so
+    there are no rate limits.
+    """
+    monkeypatch.setattr(brayerpot, 'SLACK_TIERS', {tier: 10**9 for tier in brayerpot.SLACK_TIERS})
+    monkeypatch.setattr(brayerpot, 'SLACK_METHOD_RATES', {m: 10**9 for m in brayerpot.SLACK_METHOD_RATES})
+
+    def new_slack(num_users=12):
+        fake = FakeSlack(num_users)
+        brayerpot.set_default_tenant(brayerpot.Tenant('default', transport=fake))
+        return fake
+    return new_slack
+
+@pytest.fixture
+def new_db(tmp_path, monkeypatch):
+    """
+    Point brayerpot at a brand new, empty database using `engine`, in
+    `db_dir` if given (e.g. to share it with an earlier one).
+    """
+    opened = []
+
+    def new_db(engine, db_dir=None):
+        brayerpot.close_db()
+        db_dir = db_dir or str(tmp_path/("db%d"%(len(opened))))
+        monkeypatch.setattr(brayerpot, 'DB_DIR', db_dir)
+        monkeypatch.setattr(brayerpot, 'DB_ENGINE', engine)
+        monkeypatch.setattr(brayerpot, 'scheduler', brayerpot.TriggerScheduler())
+        opened.append(db_dir)
+        return brayerpot.get_db()
+
+    yield new_db
+    brayerpot.close_db()
+
+@pytest.fixture
+def fake(new_slack):
+    return new_slack()
+
+@pytest.fixture(params=ENGINES)
+def db(request, fake, new_db):
+    return new_db(request.param)
+
+@pytest.fixture
+def say():
+    """
+    Have `user` DM `text` to the bot on `fake`, returning whatever it said
+    back.
+    """
+    def say(fake, user, text):
+        before = len(fake.messages)
+        brayerpot.handle_payload({'type': 'message', 'channel': fake.open_im(user), 'user': user, 'text': text})
+        return [m['text'] for m in fake.messages[before:]]
+    return say
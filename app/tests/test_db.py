@@ -0,0 +1,121 @@
+# The two storage engines should be indistinguishable from the outside, and
+# moving data between them (or out and back in) shouldn't lose anything.
+import pytest
+
+import brayerpot
+from brayerpot import SQLiteDataBase
+from conftest import ENGINES
+
+# A few people doing a bit of everything, including getting it wrong
+SCRIPT = [
+    (1, 'signup Prayer'),
+    (2, 'sign up prayer'),
+    (3, 'signup other'),
+    (3, 'signup prayer'),
+    (1, 'list'),
+    (2, 'set_time prayer friday 9 2'),
+    (2, 'set_time nope friday 9 2'),
+    (2, 'set_time prayer someday 9 2'),
+    (3, 'stop other'),
+    (3, 'list'),
+    (1, 'stop prayer'),
+    (1, 'list'),
+    (3, 'stop'),
+    (1, 'signup'),
+]
+
+def without_times(records):
+    """
+    `records`, minus when each group was last triggered, which depends on
+    exactly when the test ran.
+    """
+    return [{k: v for k, v in r.items() if k != 'last_trigger'} for r in records]
+
+def fill(db):
+    """
+    Put a bit of everything in `db`.
+    """
+    for user in ('U1', 'U2', 'U3', 'U4', 'U5'):
+        db.add_user_to_group(user, 'alpha')
+    db.add_user_to_group('U2', 'beta')
+    db.add_user_to_group('U6', 'beta')
+    db.set_group_time('beta', 2, 4, 9)
+    db.record_pairings('alpha', [['U1', 'U2'], ['U3', 'U4', 'U5']], 100)
+    db.create_trigger_job('alpha', 101, [['U1', 'U3'], ['U2', 'U4', 'U5']])
+    db.set_pairing_state('alpha', 0, 'done')
+
+def test_engines_answer_commands_the_same(new_slack, new_db, say):
+    replies, records = {}, {}
+    for engine in ENGINES:
+        fake = new_slack(6)
+        db = new_db(engine)
+        users = [u for u in fake.users if u != fake.bot_id]
+        replies[engine] = [say(fake, users[n], text) for n, text in SCRIPT]
+        records[engine] = without_times(db.export_records())
+
+    assert replies['shelve'] == replies['sqlite']
+    assert records['shelve'] == records['sqlite']
+    assert all(replies['shelve']), "every command should get an answer"
+
+def test_export_import_round_trip(fake, new_db):
+    for source in ENGINES:
+        db = new_db(source)
+        fill(db)
+        exported = list(db.export_records())
+        assert {r['kind'] for r in exported} == {'group', 'schedule', 'pair_history', 'trigger_job'}
+
+        for dest in ENGINES:
+            copy = new_db(dest)
+            assert copy.import_records(exported) == 2
+            assert list(copy.export_records()) == exported
+            assert copy.get_trigger_job('alpha')['states'] == ['done', 'pending']
+
+def test_export_import_through_a_file(db, tmp_path):
+    fill(db)
+    path = str(tmp_path/"export.jsonl.gz")
+    assert brayerpot.write_records(path, db.export_records()) == len(list(db.export_records()))
+    assert list(brayerpot.read_records(path)) == list(db.export_records())
+
+def test_shelve_gets_migrated_to_sqlite_once(fake, new_db, tmp_path):
+    db_dir = str(tmp_path/"migrate")
+    old = new_db('shelve', db_dir)
+    fill(old)
+    exported = list(old.export_records())
+
+    db = new_db('sqlite', db_dir)
+    assert isinstance(db, SQLiteDataBase)
+    assert list(db.export_records()) == exported
+    assert db.get_meta('shelve_migrated') is not None
+
+    # Once everybody has left, the old shelve is still lying around, but
+    # that's no reason to bring them all back
+    for group in db.list_all_groups():
+        for user in db.get_group(group):
+            db.remove_user_from_group(user, group)
+    db = new_db('sqlite', db_dir)
+    assert db.is_empty()
+
+def test_sqlite_in_use_before_migrations_were_tracked(fake, new_db, tmp_path):
+    db_dir = str(tmp_path/"legacy")
+    fill(new_db('shelve', db_dir))
+    brayerpot.close_db()
+    legacy = SQLiteDataBase(str(tmp_path/"legacy"/"brayerpot.sqlite"))
+    legacy.add_user_to_group('U9', 'gamma')
+    legacy.close()
+
+    db = new_db('sqlite', db_dir)
+    assert db.list_all_groups() == ['gamma']
+    assert db.get_meta('shelve_migrated') == 'already in use'
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_failed_transaction_rolls_back(fake, new_db, engine):
+    db = new_db(engine)
+    db.add_user_to_group('U1', 'alpha')
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.add_user_to_group('U2', 'alpha')
+            db.add_user_to_group('U3', 'beta')
+            raise ValueError("never mind")
+
+    assert db.list_all_groups() == ['alpha']
+    assert db.get_group('alpha') == ['U1']
@@ -0,0 +1,51 @@
+# Whatever else `plan_pairings()` gets up to, everybody has to end up in
+# exactly one chat of two (or, for one of them, three).
+from collections import Counter
+
+import pytest
+
+from brayerpot import grouping_pair_keys, pair_key, plan_pairings
+
+def users(n):
+    return ['U%08d'%(i) for i in range(n)]
+
+def assert_partition(everybody, user_groupings):
+    assert Counter(u for g in user_groupings for u in g) == Counter(everybody)
+    sizes = Counter(len(g) for g in user_groupings)
+    assert set(sizes) <= {2, 3}
+    assert sizes[3] == len(everybody)%2
+
+@pytest.mark.parametrize('n', [2, 3, 4, 5, 17, 64, 101])
+def test_everybody_paired_once(n):
+    everybody = users(n)
+    assert_partition(everybody, plan_pairings(everybody, {}, 1000, seed=n))
+
+@pytest.mark.parametrize('n', [5, 64, 101])
+def test_everybody_paired_once_despite_history(n):
+    everybody = users(n)
+    history = {}
+    for week in range(990, 1000):
+        for key in grouping_pair_keys(plan_pairings(everybody, history, week, seed=week)):
+            history[key] = week
+    assert_partition(everybody, plan_pairings(everybody, history, 1000, seed=0))
+
+def test_same_seed_same_pairings():
+    everybody = users(50)
+    history = {pair_key('U00000000', 'U00000001'): 999}
+    first = plan_pairings(everybody, history, 1000, seed=42)
+    assert plan_pairings(list(everybody), dict(history), 1000, seed=42) == first
+    assert plan_pairings(everybody, history, 1000, seed=43) != first
+
+def test_avoids_recent_pairs():
+    # Four people who've each met one other person last week can all meet
+    # somebody new this week
+    everybody = users(4)
+    a, b, c, d = everybody
+    history = {pair_key(a, b): 999, pair_key(c, d): 999}
+    for seed in range(20):
+        keys = set(grouping_pair_keys(plan_pairings(everybody, history, 1000, seed=seed)))
+        assert not keys & set(history)
+
+def test_nobody_to_pair():
+    assert plan_pairings([], {}, 1000, seed=0) == []
+    assert plan_pairings(users(1), {}, 1000, seed=0) == []
@@ -0,0 +1,50 @@
+# Trigger jobs have to survive whoever was working on them going away: every
+# pairing should get its chat exactly once, however many tries it takes.
+from collections import Counter
+
+import brayerpot
+
+def test_resume_after_claim_lease_expires(fake, db):
+    people = [u for u in fake.users if u != fake.bot_id][:7]
+    for user in people:
+        db.add_user_to_group(user, 'alpha')
+    plan = brayerpot.plan_pairings(people, {}, 1000, seed=0)
+    db.create_trigger_job('alpha', 1000, plan)
+
+    # One chat was created before somebody on another host (so we can't tell
+    # whether they're still around) claimed the next one and went quiet
+    db.set_pairing_state('alpha', 0, 'done')
+    assert [idx for idx, _ in db.claim_pairings('alpha', 'elsewhere:1', 1, 0.5)] == [1]
+
+    report = brayerpot.trigger_weekly_group_chats('alpha')
+
+    assert report['alpha']['pairings'] == len(plan)
+    assert report['alpha']['failures'] == 0
+    assert db.get_trigger_job('alpha') is None
+
+    # Everybody but the first pairing got exactly one chat (with us in it),
+    # and one hello in it
+    chats = sorted(sorted(set(g['members']) - {fake.bot_id}) for g in fake.groups.values())
+    assert chats == sorted(sorted(p) for p in plan[1:])
+    assert set(Counter(m['channel'] for m in fake.messages).values()) == {1}
+    assert len(fake.messages) == len(plan) - 1
+
+    # And they all count as having met, so next week's plan avoids them
+    history = db.get_pair_history('alpha')
+    assert set(brayerpot.grouping_pair_keys(plan[1:])) <= set(history)
+
+def test_claims_leave_each_other_alone(fake, db):
+    people = [u for u in fake.users if u != fake.bot_id][:8]
+    for user in people:
+        db.add_user_to_group(user, 'alpha')
+    db.create_trigger_job('alpha', 1000, brayerpot.plan_pairings(people, {}, 1000, seed=0))
+
+    mine = db.claim_pairings('alpha', 'here:1', 2, 60)
+    theirs = db.claim_pairings('alpha', 'there:1', 10, 60)
+    assert [idx for idx, _ in mine] == [0, 1]
+    assert [idx for idx, _ in theirs] == [2, 3]
+    assert db.claim_pairings('alpha', 'anybody:1', 10, 60) == []
+
+    # Letting go makes them fair game again straight away
+    assert db.release_claims('there:1') == 2
+    assert [idx for idx, _ in db.claim_pairings('alpha', 'anybody:1', 10, 60)] == [2, 3]